@@ -1,41 +1,35 @@
+import shutil
 from argparse import ArgumentParser, Namespace
 from os import cpu_count
 from pathlib import Path
+from signal import SIGTERM, signal
+from threading import Event
 
 from colorama import Fore, Style
 
 from python_scripts import pretty_print_bytes
 from python_scripts.logger import Logger
-from python_scripts.opti_dir2.opti_dir2 import (CJXL, DWebp, EnvVar, ImageFixer, Jpeg2Png, JpegOptim, OptimizationMode,
-	optimize_directory, optimize_files, OptimizerFactory, Oxipng)
+from python_scripts.opti_dir2.admission import is_available as admission_available, MemoryModel
+from python_scripts.opti_dir2.dedup import DedupMethod
+from python_scripts.opti_dir2.detect import detect_images
+from python_scripts.opti_dir2.estimate import estimate_files, print_estimate, SAMPLE_SIZE
+from python_scripts.opti_dir2.history import History
+from python_scripts.opti_dir2.journal import Journal, JOURNAL_NAME
+from python_scripts.opti_dir2.manifest import Manifest, MANIFEST_NAME
+from python_scripts.opti_dir2.opti_dir2 import (create_factory, DELETED_IMAGE_FOLDER, DeletedImages, Engine, EnvVar,
+	OptimizationMode, OptimizedImage, optimize_directory, optimize_files, OptimizerFactory, scan_directory,
+	STEP_TIMEOUT)
+from python_scripts.opti_dir2.priority import apply_priority, run_in_scope, RunPriority
+from python_scripts.opti_dir2.quality import QualityGuard
+from python_scripts.opti_dir2.quota import parse_size, SizeBudget
+from python_scripts.opti_dir2.report import RunReport
+from python_scripts.opti_dir2.scheduling import CostModel
+from python_scripts.opti_dir2.server import optimize_on_server, Request, run_settings, serve, ServerError, SOCKET_PATH
+from python_scripts.opti_dir2.watch import DEBOUNCE, watch_directory
 
 LOGGER: Logger = Logger("opti-dir2")
 
 
-def create_factory(mode: OptimizationMode) -> OptimizerFactory:
-	factory: OptimizerFactory = OptimizerFactory()
-	
-	factory.register_preprocessor(None, ImageFixer())
-	
-	factory.register_processor("png", Oxipng())
-	
-	if mode == OptimizationMode.SAFE:
-		factory.register_processor("jpeg", JpegOptim())
-	else:
-		factory.register_processor("jpeg", Jpeg2Png())
-		factory.register_processor("jpeg", Oxipng())
-	factory.register_alias("jpeg", "jpg")
-	
-	if mode != OptimizationMode.SAFE:
-		factory.register_processor("webp", DWebp())
-		factory.register_processor("webp", Oxipng())
-	
-	if mode == OptimizationMode.JXL:
-		factory.register_postprocessor(None, CJXL())
-	
-	return factory
-
-
 def main() -> None:
 	parser: ArgumentParser = ArgumentParser()
 	parser.add_argument("directory", type=str, default=".", nargs="?", help="Where to optimize images")
@@ -58,6 +52,51 @@ def main() -> None:
 		choices=[mode.name.lower() for mode in OptimizationMode],
 		help="The mode controls enabled features"
 	)
+	parser.add_argument(
+		"--target-size",
+		type=str,
+		action="store",
+		dest="target_size",
+		default=None,
+		help="Pick the JXL distance of every image so all of them together take about this much, like 2G (jxl mode)"
+	)
+	parser.add_argument(
+		"--target-bpp",
+		type=float,
+		action="store",
+		dest="target_bpp",
+		default=None,
+		help="Like --target-size, as average bits per pixel (jxl mode)"
+	)
+	parser.add_argument(
+		"--verify",
+		action="store_true",
+		dest="verify",
+		help="Keep the original if a lossy result does not look the same, see MIN_SSIM, MIN_PSNR and MAX_BUTTERAUGLI"
+	)
+	parser.add_argument(
+		"--background",
+		action="store_const",
+		dest="priority",
+		const="background",
+		default="normal",
+		help="Only use idle CPU and disk time: nice 19, SCHED_IDLE and the idle I/O class"
+	)
+	parser.add_argument(
+		"--interactive",
+		action="store_const",
+		dest="priority",
+		const="interactive",
+		help="Yield to the desktop, but keep going: nice 10, SCHED_BATCH and the lowest best-effort I/O"
+	)
+	parser.add_argument(
+		"--cpu-quota",
+		type=int,
+		action="store",
+		dest="cpu_quota",
+		default=None,
+		help="Run in a transient systemd scope which may use this many percent of a core"
+	)
 	parser.add_argument(
 		"-s",
 		"--single",
@@ -65,6 +104,144 @@ def main() -> None:
 		dest="single",
 		help="Only work on a single file"
 	)
+	parser.add_argument(
+		"-r",
+		"--recursive",
+		action="store_true",
+		dest="recursive",
+		help="Also optimize images in subdirectories"
+	)
+	parser.add_argument(
+		"--include",
+		action="append",
+		dest="include",
+		default=[],
+		help="Only optimize images matching this glob, relative to the directory (repeatable)"
+	)
+	parser.add_argument(
+		"--exclude",
+		action="append",
+		dest="exclude",
+		default=[],
+		help="Skip files and directories matching this glob, relative to the directory (repeatable)"
+	)
+	parser.add_argument(
+		"--stream",
+		action="store_true",
+		dest="stream",
+		help="Start optimizing while the directory is still being scanned"
+	)
+	parser.add_argument(
+		"--unordered",
+		action="store_true",
+		dest="unordered",
+		help="Optimize images in directory order instead of the most expensive ones first"
+	)
+	parser.add_argument(
+		"--no-admission",
+		action="store_true",
+		dest="no_admission",
+		help="Start images as soon as a worker is free, instead of waiting for enough memory and idle cores"
+	)
+	parser.add_argument(
+		"--report",
+		type=str,
+		action="store",
+		dest="report",
+		default=None,
+		help="Write per-file and per-step statistics to this file; '.jsonl' is written while running"
+	)
+	parser.add_argument(
+		"--engine",
+		action="store",
+		dest="engine",
+		default="threads",
+		choices=[engine.name.lower() for engine in Engine],
+		help="How steps are run: blocking worker threads or asyncio child processes"
+	)
+	parser.add_argument(
+		"--step-timeout",
+		type=float,
+		action="store",
+		dest="step_timeout",
+		default=None,
+		help="Seconds a step gets before it is retried with a cheaper configuration, more for large images; 0 disables"
+	)
+	parser.add_argument(
+		"-f",
+		"--force",
+		action="store_true",
+		dest="force",
+		help="Optimize images even if the manifest lists them as already optimized"
+	)
+	parser.add_argument(
+		"--manifest",
+		type=str,
+		action="store",
+		dest="manifest",
+		default=None,
+		help=f"The manifest of already optimized images, defaults to '{MANIFEST_NAME}' in the directory"
+	)
+	parser.add_argument(
+		"--by-extension",
+		action="store_true",
+		dest="by_extension",
+		help="Select images by their extension instead of their content"
+	)
+	parser.add_argument(
+		"--dedup",
+		action="store",
+		dest="dedup",
+		default=None,
+		choices=[method.name.lower() for method in DedupMethod],
+		help="Optimize identical images once and reproduce the result for the others (not with --stream)"
+	)
+	parser.add_argument(
+		"--watch",
+		action="store_true",
+		dest="watch",
+		help="Keep running and optimize new images as they arrive; the manifest carries over restarts"
+	)
+	parser.add_argument(
+		"--debounce",
+		type=float,
+		action="store",
+		dest="debounce",
+		default=DEBOUNCE,
+		help="With --watch, wait until a file was left alone for this many seconds"
+	)
+	parser.add_argument(
+		"--server",
+		action="store_true",
+		dest="server",
+		help=f"Let the shared server on '{SOCKET_PATH}' optimize the directory, it is started if needed"
+	)
+	parser.add_argument(
+		"--serve",
+		action="store_true",
+		dest="serve",
+		help="Run the shared server in the foreground; --threads is the size of its pool"
+	)
+	parser.add_argument(
+		"--resume",
+		action="store_true",
+		dest="resume",
+		help="Finish or roll back the images an interrupted run left behind, then continue"
+	)
+	parser.add_argument(
+		"--estimate",
+		action="store_true",
+		dest="estimate",
+		help="Optimize a sample in a scratch directory and predict time and savings; nothing is modified"
+	)
+	parser.add_argument(
+		"--sample-size",
+		type=int,
+		action="store",
+		dest="sample_size",
+		default=SAMPLE_SIZE,
+		help="How many images --estimate optimizes"
+	)
 	args: Namespace = parser.parse_args()
 	args.directory = Path(args.directory).expanduser().resolve()
 	LOGGER.verbose_enabled = args.verbose
@@ -79,9 +256,69 @@ def main() -> None:
 		LOGGER.info("negative amount of threads given, using 1")
 		args.threads = 1
 	
+	if args.cpu_quota is not None:
+		try:
+			run_in_scope(args.cpu_quota)
+		except OSError as exc:
+			LOGGER.error(exc)
+			exit(1)
+	
+	# before the first thread, everything started later inherits it; a server started by this run as well
+	apply_priority(RunPriority[args.priority.upper()])
+	
+	if args.serve:
+		serve(args.threads, args.priority, args.cpu_quota, not args.no_admission)
+		return
+	
 	LOGGER.verbose_log(f"using {args.threads} threads for '{args.directory}'")
 	
-	factory: OptimizerFactory = create_factory(OptimizationMode[args.mode.upper()])  # this is not an issue
+	size_budget: SizeBudget | None = None
+	
+	if args.target_size is not None or args.target_bpp is not None:
+		if args.target_size is not None and args.target_bpp is not None:
+			LOGGER.error("only one of --target-size and --target-bpp can be given")
+			exit(1)
+		
+		# the plan is made from the complete list of images before the first one starts
+		if args.mode != "jxl" or args.watch or args.stream or args.server or args.estimate:
+			LOGGER.error("a target size only works in jxl mode, without --watch, --stream, --server and --estimate")
+			exit(1)
+		
+		try:
+			size_budget = SizeBudget(
+				parse_size(args.target_size) if args.target_size is not None else None,
+				args.target_bpp
+			)
+		except ValueError as exc:
+			LOGGER.error(exc)
+			exit(1)
+	
+	quality_guard: QualityGuard | None = None
+	
+	if args.verify:
+		try:
+			quality_guard = QualityGuard()
+		except ImportError as exc:
+			LOGGER.error(exc)
+			exit(1)
+		
+		# the JPEG XL results have to be decoded to be compared
+		if args.mode in ("jxl", "jxl_best") and shutil.which("djxl") is None:
+			LOGGER.error("--verify needs djxl in jxl modes")
+			exit(1)
+	
+	history: History = History()
+	factory: OptimizerFactory = create_factory(
+		OptimizationMode[args.mode.upper()],  # this is not an issue
+		history,
+		size_budget,
+		quality_guard
+	)
+	
+	missing_tools: set[str] = factory.get_missing_tools()
+	if missing_tools:
+		LOGGER.error(f"{args.mode} mode needs {", ".join(sorted(missing_tools))}, which could not be found")
+		exit(1)
 	
 	if LOGGER.verbose_enabled:
 		registered_file_types: set[str] = factory.get_registered_file_types()
@@ -96,25 +333,211 @@ def main() -> None:
 			f: Path = Path(f"a.{file_type}")
 			
 			LOGGER.verbose_log(f"|> {file_type}:")
-			LOGGER.verbose_log(f"\tpre : {[p.__class__.__name__ for p in factory.get_preprocessors(f)]}")
-			LOGGER.verbose_log(f"\tpro : {[p.__class__.__name__ for p in factory.get_processors(f)]}")
-			LOGGER.verbose_log(f"\tpost: {[p.__class__.__name__ for p in factory.get_postprocessors(f)]}")
+			LOGGER.verbose_log(f"\tpre : {[p.name for p in factory.get_preprocessors(f)]}")
+			LOGGER.verbose_log(f"\tpro : {[p.name for p in factory.get_processors(f)]}")
+			LOGGER.verbose_log(f"\tpost: {[p.name for p in factory.get_postprocessors(f)]}")
 	
-	if args.single:
-		if not args.directory.is_file():
-			LOGGER.error(f"given file '{args.directory}' is not a file")
-			exit(1)
-		if not args.directory.exists():
-			LOGGER.error(f"given file '{args.directory}' does not exist")
-			exit(1)
-		images = optimize_files([args.directory], args.threads, factory)
+	if args.manifest is not None:
+		manifest_file: Path = Path(args.manifest).expanduser().resolve()
+	elif args.single:
+		manifest_file: Path = args.directory.parent / MANIFEST_NAME
 	else:
-		images = optimize_directory(
-			args.directory,
-			args.threads,
-			factory
+		manifest_file: Path = args.directory / MANIFEST_NAME
+	
+	cost_model: CostModel | None = None if args.unordered else CostModel(factory, history)
+	memory_model: MemoryModel | None = None
+	
+	if not args.no_admission:
+		if admission_available():
+			memory_model = MemoryModel(factory, history)
+		else:
+			LOGGER.warn("psutil is not installed, images are started without waiting for memory and idle cores")
+	
+	if args.estimate:
+		if args.single:
+			images = [args.directory]
+		else:
+			file_types: set[str] = factory.get_registered_file_types()
+			images = scan_directory(
+				args.directory,
+				tuple(file_types) if args.by_extension else None,
+				args.recursive,
+				tuple(args.include),
+				tuple(args.exclude)
+			)
+			
+			if not args.by_extension:
+				# nothing may be renamed, the scratch copies are fixed instead
+				images = detect_images(images, file_types, args.threads, rename=False)
+			
+			images = list(images)
+		
+		with Manifest(manifest_file, factory.get_profile(), args.force, read_only=True) as manifest:
+			images = list(manifest.filter(images))
+		
+		if len(images) == 0:
+			LOGGER.info("nothing to optimize")
+			return
+		
+		print_estimate(estimate_files(images, args.threads, factory, args.sample_size, cost_model))
+		history.save()
+		return
+	
+	# the base of the timeouts, see scaled_timeout
+	step_timeout: float | None = args.step_timeout if args.step_timeout is not None else float(STEP_TIMEOUT.value())
+	if step_timeout == 0:
+		step_timeout = None
+	
+	report: RunReport | None = None
+	if args.report is not None:
+		report = RunReport(Path(args.report).expanduser().resolve(), factory, args.threads)
+	
+	# only a complete list of images can be searched for duplicates
+	if args.dedup is not None and (args.stream or args.watch):
+		LOGGER.error("--dedup needs every image up front, it does not work with --stream and --watch")
+		exit(1)
+	
+	if args.server:
+		if args.single or args.watch or args.stream or args.dedup is not None or args.engine != "threads":
+			LOGGER.error("--server only optimizes whole directories, without --single, --watch, --stream and --dedup")
+			exit(1)
+		
+		request: Request = Request(
+			str(args.directory),
+			args.mode,
+			args.recursive,
+			args.include,
+			args.exclude,
+			args.force,
+			str(manifest_file) if args.manifest is not None else None,
+			args.by_extension,
+			args.resume,
+			args.unordered,
+			step_timeout,
+			args.verify,
+			str(DELETED_IMAGE_FOLDER.absolute()),
+			run_settings(args.threads, args.priority, args.cpu_quota, memory_model is not None)
 		)
+		
+		try:
+			images = optimize_on_server(
+				request,
+				args.threads,
+				report=report,
+				priority=args.priority,
+				cpu_quota=args.cpu_quota,
+				admission=not args.no_admission
+			)
+		except ServerError as exc:
+			LOGGER.error(exc)
+			exit(1)
+		
+		if report is not None:
+			report.close()
+		
+		print_summary(images)
+		return
+	
+	# in the working directory, below it images keep their path relative to the directory
+	deleted_images: DeletedImages = DeletedImages(
+		DELETED_IMAGE_FOLDER.absolute(),
+		args.directory.parent if args.single else args.directory
+	)
 	
+	journal: Journal = Journal(manifest_file.with_name(JOURNAL_NAME))
+	unfinished: int = len(journal.unfinished())
+	
+	if unfinished > 0 and not args.resume:
+		LOGGER.error(f"an interrupted run left {unfinished} images unfinished, continue it with --resume")
+		exit(1)
+	
+	with Manifest(manifest_file, factory.get_profile(), args.force) as manifest, journal:
+		if unfinished > 0:
+			finished, rolled_back = journal.recover(manifest, deleted_images)
+			LOGGER.info(f"resuming: finished {finished} interrupted commits, rolled back {rolled_back} images")
+		
+		if args.watch:
+			stop: Event = Event()
+			# systemd and friends stop with SIGTERM; running images are finished first
+			signal(SIGTERM, lambda *_: stop.set())
+			
+			def on_result(image: OptimizedImage) -> None:
+				old_size: str = pretty_print_bytes(image.old_size)
+				LOGGER.log(f"'{image.image}': {old_size} -> {pretty_print_bytes(image.new_size)}")
+				
+				if report is not None:
+					report.add(image)
+			
+			watch_directory(
+				args.directory,
+				args.threads,
+				factory,
+				manifest,
+				args.recursive,
+				args.debounce,
+				journal,
+				stop,
+				on_result,
+				memory_model,
+				step_timeout,
+				deleted_images
+			)
+		elif args.single:
+			if not args.directory.is_file():
+				LOGGER.error(f"given file '{args.directory}' is not a file")
+				exit(1)
+			if not args.directory.exists():
+				LOGGER.error(f"given file '{args.directory}' does not exist")
+				exit(1)
+			images = optimize_files(
+				[args.directory],
+				args.threads,
+				factory,
+				manifest=manifest,
+				cost_model=cost_model,
+				report=report,
+				engine=Engine[args.engine.upper()],
+				step_timeout=step_timeout,
+				journal=journal,
+				dedup=DedupMethod[args.dedup.upper()] if args.dedup is not None else None,
+				memory_model=memory_model,
+				size_budget=size_budget,
+				deleted_images=deleted_images
+			)
+		else:
+			images = optimize_directory(
+				args.directory,
+				args.threads,
+				factory,
+				manifest=manifest,
+				recursive=args.recursive,
+				include=tuple(args.include),
+				exclude=tuple(args.exclude),
+				stream=args.stream,
+				cost_model=cost_model,
+				report=report,
+				engine=Engine[args.engine.upper()],
+				step_timeout=step_timeout,
+				journal=journal,
+				dedup=DedupMethod[args.dedup.upper()] if args.dedup is not None else None,
+				by_extension=args.by_extension,
+				memory_model=memory_model,
+				size_budget=size_budget,
+				deleted_images=deleted_images
+			)
+	
+	history.save()
+	
+	if report is not None:
+		report.close()
+	
+	if args.watch:
+		return
+	
+	print_summary(images)
+
+
+def print_summary(images: list[OptimizedImage]) -> None:
 	if len(images) == 0:
 		LOGGER.info("nothing to optimize")
 		return
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import math
+import os
+from contextlib import contextmanager
+from itertools import count
+from pathlib import Path
+from threading import Condition
+from time import monotonic
+from typing import Iterator
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.detect import pixel_count
+from python_scripts.opti_dir2.history import History
+from python_scripts.opti_dir2.opti_dir2 import CLEAR_LINE, EnvVar, ImageOptimizer, OptimizedImage, OptimizerFactory
+
+# only the admission control looks at the machine, the memory model works without it
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+LOGGER: Logger = Logger("opti-dir2")
+
+# memory in MiB which is never handed out, for everything else running on the machine
+MEMORY_RESERVE: EnvVar = EnvVar("MEMORY_RESERVE", "512")
+
+HISTORY_SECTION: str = "memory"
+# older runs fade out, but a peak is only forgotten slowly
+DECAY: float = 0.98
+# smaller images mostly measure the fixed memory of a step, not the memory per pixel
+MIN_LEARN_PIXELS: int = 1_000_000
+# what every step takes regardless of the image: the binary, its libraries, the buffers of the file
+BASE_MEMORY: int = 32 * 1024 * 1024
+
+# how often the machine is looked at while an image waits
+POLL_INTERVAL: float = 0.5
+# once the oldest waiting image waited this long, nothing else overtakes it
+MAX_OVERTAKE_SECONDS: float = 10.0
+# the time constant of the 1 minute load average
+LOAD_TIME_CONSTANT: float = 60.0
+
+
+# Estimates the peak memory of an image as the largest peak of its steps, each `BASE_MEMORY + b * pixels`.
+# b starts at the BYTES_PER_PIXEL of the step and follows the peaks measured in earlier runs.
+class MemoryModel:
+	def __init__(self, factory: OptimizerFactory, history: History):
+		self.factory = factory
+		self.history = history
+		
+		self._bytes_per_pixel = history.section(HISTORY_SECTION)
+	
+	def chain(self, image: Path) -> list[ImageOptimizer]:
+		return [
+			step.select(image)
+			for step in self.factory.get_preprocessors(image)
+			+ self.factory.get_processors(image)
+			+ self.factory.get_postprocessors(image)
+		]
+	
+	def bytes_per_pixel(self, step: ImageOptimizer) -> float:
+		with self.history.lock:
+			return self._bytes_per_pixel.get(step.name, step.BYTES_PER_PIXEL)
+	
+	def estimate(self, image: Path, pixels: int | None = None) -> int:
+		pixels = pixel_count(image) if pixels is None else pixels
+		
+		return max(
+			(BASE_MEMORY + int(self.bytes_per_pixel(step) * pixels) for step in self.chain(image)),
+			default=BASE_MEMORY
+		)
+	
+	def record(self, image: OptimizedImage, pixels: int) -> None:
+		if not image.success or pixels < MIN_LEARN_PIXELS:
+			return
+		
+		with self.history.lock:
+			for stats in image.steps:
+				# the asyncio engine does not measure its children
+				if stats.max_rss <= 0:
+					continue
+				
+				observed: float = max(stats.max_rss - BASE_MEMORY, 0) / pixels
+				learned: float | None = self._bytes_per_pixel.get(stats.step)
+				
+				# a peak counts right away, swapping is far worse than waiting
+				self._bytes_per_pixel[stats.step] = observed if learned is None else max(learned * DECAY, observed)
+
+
+def is_available() -> bool:
+	return psutil is not None
+
+
+# Only starts an image once its estimated peak memory fits into the available memory and the machine is not
+# busy with other work. Memory which was promised to running images, but which they did not take yet, is
+# counted as used. An image never waits while nothing runs, so an image larger than the machine still gets
+# done, alone. Smaller images may overtake one which waits for memory, but not for long.
+class AdmissionControl:
+	def __init__(self, model: MemoryModel | None = None, cores: int | None = None):
+		if psutil is None:
+			raise ImportError("the admission control needs psutil")
+		
+		self.model = model
+		self.cores = cores or os.cpu_count()
+		self.reserve = int(MEMORY_RESERVE.value()) * 1024 * 1024
+		
+		self.reserved: int = 0
+		self.running: int = 0
+		
+		self._condition: Condition = Condition()
+		self._tickets: Iterator[int] = count()
+		# ticket and the time it started waiting, in order
+		self._waiting: dict[int, float] = { }
+		self._own_load: float = 0.0
+		self._load_updated: float = monotonic()
+		self._process: psutil.Process = psutil.Process()
+	
+	# the children of this process, which includes the pool of the in-process steps
+	def _children_rss(self) -> int:
+		rss: int = 0
+		
+		for child in self._process.children(recursive=True):
+			try:
+				rss += child.memory_info().rss
+			except psutil.Error:
+				pass
+		
+		return rss
+	
+	def free_memory(self) -> int:
+		promised: int = max(self.reserved - self._children_rss(), 0)
+		
+		return psutil.virtual_memory().available - promised - self.reserve
+	
+	# follows the running images the same way the kernel follows runnable tasks, so they can be told apart
+	def _update_own_load(self) -> None:
+		now: float = monotonic()
+		weight: float = math.exp(-(now - self._load_updated) / LOAD_TIME_CONSTANT)
+		
+		self._own_load = self._own_load * weight + self.running * (1 - weight)
+		self._load_updated = now
+	
+	def idle_cores(self) -> float:
+		self._update_own_load()
+		other_load: float = max(psutil.getloadavg()[0] - self._own_load, 0.0)
+		
+		return self.cores - other_load - self.running
+	
+	def _admissible(self, ticket: int, demand: int) -> bool:
+		if self.running == 0:
+			return True
+		
+		oldest: int = next(iter(self._waiting))
+		if ticket != oldest and monotonic() - self._waiting[oldest] > MAX_OVERTAKE_SECONDS:
+			return False
+		
+		return demand <= self.free_memory() and self.idle_cores() >= 1
+	
+	# the model defaults to the one of the controller; a server runs images of several factories
+	def acquire(self, image: Path, pixels: int, model: MemoryModel | None = None) -> int:
+		demand: int = (model or self.model).estimate(image, pixels)
+		
+		with self._condition:
+			ticket: int = next(self._tickets)
+			self._waiting[ticket] = monotonic()
+			
+			try:
+				# the machine changes without telling, so it is looked at again every now and then
+				while not self._admissible(ticket, demand):
+					self._condition.wait(POLL_INTERVAL)
+			finally:
+				del self._waiting[ticket]
+			
+			if demand > self.free_memory():
+				LOGGER.warn(f"{CLEAR_LINE}'{image}' may need {demand // 2 ** 20} MiB, more than is available")
+			
+			self._update_own_load()
+			self.reserved += demand
+			self.running += 1
+		
+		return demand
+	
+	def release(self, demand: int) -> None:
+		with self._condition:
+			self._update_own_load()
+			self.reserved -= demand
+			self.running -= 1
+			self._condition.notify_all()
+	
+	@contextmanager
+	def image(self, image: Path, model: MemoryModel | None = None) -> Iterator[int]:
+		pixels: int = pixel_count(image)
+		demand: int = self.acquire(image, pixels, model)
+		
+		try:
+			yield pixels
+		finally:
+			self.release(demand)
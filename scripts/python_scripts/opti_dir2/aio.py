@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import asyncio
+from asyncio.subprocess import PIPE, Process
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, asynccontextmanager
+from os import stat_result
+from pathlib import Path
+from subprocess import CompletedProcess
+from time import monotonic
+from typing import Any, AsyncIterator, Callable, Coroutine, Iterable, Iterator, TYPE_CHECKING, TypeVar
+
+from python_scripts.opti_dir2.detect import pixel_count
+from python_scripts.opti_dir2.inprocess import size_pool
+from python_scripts.opti_dir2.opti_dir2 import (after_timeout, attempt_step, CommandOptimizer, CoreBudget,
+	DeletedImages, finish_step, granted_threads, ImageJob, ImageOptimizer, MeasuredProcess, OptimizationResult,
+	OptimizedImage, OptimizerFactory, scaled_timeout, StepFailed, THREADS_PER_IMAGE, timed_out, unreadable,
+	using_threads)
+
+if TYPE_CHECKING:
+	from python_scripts.opti_dir2.admission import MemoryModel
+	from python_scripts.opti_dir2.journal import Journal
+	from python_scripts.opti_dir2.manifest import Manifest
+
+_T = TypeVar("_T")
+
+
+# the asyncio counterpart of attempt_step
+async def attempt_step_async(
+	step: ImageOptimizer,
+	image: Path,
+	budget: CoreBudget | None,
+	timeout: float | None
+) -> OptimizationResult:
+	if not isinstance(step, CommandOptimizer):
+		# in-process steps like ImageFixer are cheap, release the GIL or run in the process pool
+		return await asyncio.to_thread(attempt_step, step, image, budget, timeout)
+	
+	with granted_threads(step, image, budget) as threads:
+		target: Path = step.target(image)
+		
+		# built right away, the other images run on this thread as well
+		with using_threads(threads):
+			command: list[str] = [str(argument) for argument in step.command(image, target)]
+		
+		process: Process = await asyncio.create_subprocess_exec(*command, stdout=PIPE, stderr=PIPE)
+		
+		try:
+			stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+		except BaseException as exc:
+			# cancelled or timed out: the child must not outlive its step
+			if process.returncode is None:
+				process.kill()
+				await asyncio.shield(process.wait())
+			
+			if not isinstance(exc, TimeoutError):
+				raise
+			
+			return step.result(
+				image,
+				target,
+				MeasuredProcess(command, -9, "", f"timed out after {timeout:.0f}s", timed_out=True)
+			)
+	
+	return step.result(
+		image,
+		target,
+		CompletedProcess(command, process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace"))
+	)
+
+
+async def run_step_async(
+	step: ImageOptimizer,
+	image: Path,
+	budget: CoreBudget | None = None,
+	timeout: float | None = None
+) -> OptimizationResult:
+	step = step.select(image)
+	input_size: int = image.stat().st_size
+	pixels: int = await asyncio.to_thread(pixel_count, image) if timeout is not None else 0
+	started: float = monotonic()
+	timed_out_configurations: list[str] = []
+	
+	while True:
+		before: stat_result = image.stat()
+		result: OptimizationResult = await attempt_step_async(
+			step,
+			image,
+			budget,
+			scaled_timeout(step, pixels, timeout)
+		)
+		
+		if not timed_out(result):
+			break
+		
+		timed_out_configurations.append(step.configuration)
+		fallback, result = after_timeout(step, image, result, before)
+		
+		if fallback is None:
+			break
+		step = fallback
+	
+	return finish_step(step, result, input_size, started, timed_out_configurations)
+
+
+# A thread cannot be cancelled, it goes on regardless. A cancelled job waits for it, so its cleanup never runs next to
+# a stage or commit which is still busy.
+async def in_thread(function: Callable[..., _T], *arguments: Any) -> _T:
+	running: asyncio.Future[_T] = asyncio.ensure_future(asyncio.to_thread(function, *arguments))
+	
+	try:
+		return await asyncio.shield(running)
+	except asyncio.CancelledError:
+		await asyncio.wait([running])
+		raise
+
+
+async def optimize_image_async(
+	image: Path,
+	factory: OptimizerFactory,
+	timeout: float | None = None,
+	journal: Journal | None = None,
+	deleted_images: DeletedImages | None = None,
+	budget: CoreBudget | None = None
+) -> OptimizedImage:
+	try:
+		job: ImageJob = ImageJob(image, journal, deleted_images)
+	except OSError as exc:
+		return unreadable(image, exc)
+	
+	# everything which copies, moves or deletes files runs on a worker thread, the event loop must never wait on a disk
+	try:
+		for step in factory.get_preprocessors(job.image):
+			await in_thread(job.preprocessed, step, await run_step_async(step, job.image, budget, timeout))
+		
+		await in_thread(job.stage)
+		
+		for step in factory.get_processors(job.staged_image):
+			job.processed(step, await run_step_async(step, job.staged_image, budget, timeout))
+		
+		for step in factory.get_postprocessors(job.staged_image):
+			job.processed(step, await run_step_async(step, job.staged_image, budget, timeout))
+		
+		await in_thread(job.verify, factory.quality_guard, timeout)
+		
+		return await in_thread(job.commit)
+	except (StepFailed, OSError) as exc:
+		return job.failed(exc)
+	finally:
+		await in_thread(job.cleanup)
+
+
+# Takes a core of the budget for an image. The wait runs on one of `waiters`, which do nothing but wait, so the
+# waiting images can never hold up the worker threads the running ones need.
+@asynccontextmanager
+async def image_slot(budget: CoreBudget | None, waiters: ThreadPoolExecutor) -> AsyncIterator[None]:
+	if budget is None:
+		yield
+		return
+	
+	slot: AbstractContextManager[None] = budget.image()
+	entering: asyncio.Future[None] = asyncio.get_running_loop().run_in_executor(waiters, slot.__enter__)
+	
+	try:
+		await asyncio.shield(entering)
+	except asyncio.CancelledError:
+		# the core is taken anyway once the wait is over and has to be given back
+		entering.add_done_callback(lambda entered: entered.cancelled() or slot.__exit__(None, None, None))
+		raise
+	
+	try:
+		yield
+	finally:
+		slot.__exit__(None, None, None)
+
+
+# the asyncio counterpart of iter_optimize_files: no thread per image, only a child process per running step
+async def aiter_optimize_files(
+	images: Iterable[Path],
+	concurrency: int,
+	factory: OptimizerFactory,
+	manifest: Manifest | None = None,
+	on_submit: Callable[[Path], None] | None = None,
+	timeout: float | None = None,
+	journal: Journal | None = None,
+	memory_model: MemoryModel | None = None,
+	deleted_images: DeletedImages | None = None
+) -> AsyncIterator[OptimizedImage]:
+	# an explicitly set THREADS_PER_IMAGE wins over the dynamic distribution, like in iter_optimize_files
+	budget: CoreBudget | None = None if THREADS_PER_IMAGE.is_set() else CoreBudget(concurrency)
+	waiters: ThreadPoolExecutor = ThreadPoolExecutor(concurrency, thread_name_prefix="opti-dir2-budget")
+	admission: AdmissionControl | None = None
+	
+	size_pool(concurrency)
+	
+	if memory_model is not None:
+		from python_scripts.opti_dir2.admission import AdmissionControl
+		
+		admission = AdmissionControl(memory_model)
+	
+	free_slots: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+	# receives every finished task, and None once the producer is done
+	finished: asyncio.Queue[asyncio.Task[OptimizedImage] | None] = asyncio.Queue()
+	tasks: set[asyncio.Task[OptimizedImage]] = set()
+	submitted: int = 0
+	
+	def on_done(task: asyncio.Task[OptimizedImage]) -> None:
+		free_slots.release()
+		tasks.discard(task)
+		finished.put_nowait(task)
+	
+	async def optimize(image: Path) -> OptimizedImage:
+		if budget is not None:
+			budget.queue()
+		
+		async with image_slot(budget, waiters):
+			result: OptimizedImage = await optimize_image_async(image, factory, timeout, journal, deleted_images, budget)
+		
+		if manifest is not None:
+			# hashes the image
+			await asyncio.to_thread(manifest.record, result)
+		
+		return result
+	
+	async def optimize_admitted(image: Path, pixels: int, demand: int) -> OptimizedImage:
+		try:
+			result: OptimizedImage = await optimize(image)
+		finally:
+			admission.release(demand)
+		
+		memory_model.record(result, pixels)
+		
+		return result
+	
+	async def produce() -> None:
+		nonlocal submitted
+		
+		# scanning and sniffing read the disk, the next image is taken on a worker thread
+		pending: Iterator[Path] = iter(images)
+		
+		try:
+			while (image := await asyncio.to_thread(next, pending, None)) is not None:
+				await free_slots.acquire()
+				
+				if on_submit is not None:
+					on_submit(image)
+				
+				if admission is None:
+					work: Coroutine[Any, Any, OptimizedImage] = optimize(image)
+				else:
+					try:
+						# waits on a worker thread, the event loop keeps running the admitted images
+						pixels: int = await asyncio.to_thread(pixel_count, image)
+						demand: int = await asyncio.to_thread(admission.acquire, image, pixels)
+					except OSError as exc:
+						work: Coroutine[Any, Any, OptimizedImage] = asyncio.to_thread(unreadable, image, exc)
+					else:
+						work: Coroutine[Any, Any, OptimizedImage] = optimize_admitted(image, pixels, demand)
+				
+				submitted += 1
+				task: asyncio.Task[OptimizedImage] = asyncio.create_task(work)
+				task.add_done_callback(on_done)
+				tasks.add(task)
+		finally:
+			finished.put_nowait(None)
+	
+	producer: asyncio.Task[None] = asyncio.create_task(produce())
+	
+	try:
+		producing: bool = True
+		yielded: int = 0
+		
+		while producing or yielded < submitted:
+			task: asyncio.Task[OptimizedImage] | None = await finished.get()
+			
+			if task is None:
+				producing = False
+				continue
+			
+			yielded += 1
+			yield task.result()
+	finally:
+		# only does something if the consumer stopped early or was cancelled; this kills the running children
+		producer.cancel()
+		for task in list(tasks):
+			task.cancel()
+		
+		await asyncio.gather(producer, *tasks, return_exceptions=True)
+		waiters.shutdown(wait=False)
+
+
+# drives aiter_optimize_files from synchronous code; Ctrl-C cancels the running steps and kills their children
+def iter_optimize_files_async(
+	images: Iterable[Path],
+	concurrency: int,
+	factory: OptimizerFactory,
+	manifest: Manifest | None = None,
+	on_submit: Callable[[Path], None] | None = None,
+	timeout: float | None = None,
+	journal: Journal | None = None,
+	memory_model: MemoryModel | None = None,
+	deleted_images: DeletedImages | None = None
+) -> Iterator[OptimizedImage]:
+	with asyncio.Runner() as runner:
+		results: AsyncIterator[OptimizedImage] = aiter_optimize_files(
+			images,
+			concurrency,
+			factory,
+			manifest,
+			on_submit,
+			timeout,
+			journal,
+			memory_model,
+			deleted_images
+		)
+		
+		async def next_result() -> Any:
+			return await anext(results)
+		
+		try:
+			while True:
+				try:
+					yield runner.run(next_result())
+				except StopAsyncIteration:
+					break
+		finally:
+			runner.run(results.aclose())
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Callable
+
+from PIL import Image, ImageSequence
+
+from python_scripts.opti_dir2.detect import is_animated
+from python_scripts.opti_dir2.inprocess import InProcessOptimizer
+from python_scripts.opti_dir2.opti_dir2 import (CommandOptimizer, ImageOptimizer, OptimizationResult, Oxipng,
+	replace_file_type)
+
+
+def decode_animation(image: str, target: str) -> None:
+	with Image.open(image) as animation:
+		frames: list[Image.Image] = [frame.copy() for frame in ImageSequence.Iterator(animation)]
+		
+		frames[0].save(
+			target,
+			"PNG",
+			save_all=True,
+			append_images=frames[1:],
+			duration=[frame.info.get("duration", 0) for frame in frames],
+			loop=animation.info.get("loop", 0)
+		)
+
+
+# the frames of an animated WebP as an APNG, which Oxipng and cjxl can work with; lossy frames stay as they are
+class PillowAnimationDecoder(InProcessOptimizer):
+	RELATIVE_COST = 0.5
+	# every frame is held at once
+	BYTES_PER_PIXEL = 64.0
+	
+	def version(self) -> str | None:
+		return f"Pillow {Image.__version__}"
+	
+	def target(self, image: Path) -> Path:
+		return replace_file_type(image, "png")
+	
+	def arguments(self, image: Path, target: Path) -> tuple[Callable[..., None], tuple[Any, ...]]:
+		return decode_animation, (str(image), str(target))
+
+
+# The reductions of Oxipng look at the default image only, a changed color type or palette would break the
+# other frames. Without them, every frame is still recompressed.
+class ApngOxipng(Oxipng):
+	REDUCTIONS = False
+
+
+class Gifsicle(CommandOptimizer):
+	VERSION_COMMAND = ("gifsicle", "--version")
+	RELATIVE_COST = 0.5
+	BYTES_PER_PIXEL = 4.0
+	
+	def command(self, image: Path, target: Path) -> list[Any]:
+		# lossless; frames are cropped to what changes and the color tables are merged
+		return ["gifsicle", "--optimize=3", "--batch", image]
+
+
+# picks the step by whether the image is animated, like SizeSwitch picks it by the size
+class AnimationSwitch(ImageOptimizer):
+	def __init__(self, still: ImageOptimizer, animated: ImageOptimizer):
+		self.still = still
+		self.animated = animated
+		
+		self.MULTITHREADED = still.MULTITHREADED or animated.MULTITHREADED
+		self.RELATIVE_COST = max(still.RELATIVE_COST, animated.RELATIVE_COST)
+		self.BYTES_PER_PIXEL = max(still.BYTES_PER_PIXEL, animated.BYTES_PER_PIXEL)
+	
+	@property
+	def name(self) -> str:
+		return self.still.name
+	
+	def wrapped_steps(self) -> list[ImageOptimizer]:
+		return [self.still, self.animated]
+	
+	def select(self, image: Path) -> ImageOptimizer:
+		return (self.animated if is_animated(image) else self.still).select(image)
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		return self.select(image).optimize(image)
+	
+	def version(self) -> str | None:
+		return f"{self.still.version()} / {self.animated.version()}"
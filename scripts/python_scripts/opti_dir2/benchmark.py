@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import subprocess
+from argparse import ArgumentParser, Namespace
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import Any, Callable
+
+from PIL import Image, ImageDraw
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.history import History, HISTORY_FILE
+from python_scripts.opti_dir2.opti_dir2 import (create_factory, OptimizationMode, OptimizedImage, optimize_files,
+	OptimizerFactory)
+from python_scripts.opti_dir2.scheduling import CostModel
+
+LOGGER: Logger = Logger("opti-dir2-benchmark")
+
+CORPUS_VERSION: int = 1
+RESULTS_FILE: Path = HISTORY_FILE.with_name("benchmark.jsonl")
+
+SIZES: list[tuple[int, int]] = [(48, 48), (320, 240), (1024, 768), (2560, 1440)]
+# format, extension; a mismatch means the file is mislabelled and ImageFixer has to rename it
+FORMATS: list[tuple[str, str]] = [
+	("PNG", "png"),
+	("JPEG", "jpg"),
+	("WEBP", "webp"),
+	("JPEG", "png"),
+	("PNG", "jpg"),
+	("WEBP", "png")
+]
+
+
+def draw_noise(random: Random, size: tuple[int, int]) -> Image.Image:
+	return Image.frombytes("RGB", size, random.randbytes(size[0] * size[1] * 3))
+
+
+def draw_gradient(random: Random, size: tuple[int, int]) -> Image.Image:
+	start: tuple[int, int, int] = (random.randrange(256), random.randrange(256), random.randrange(256))
+	horizontal: Image.Image = Image.linear_gradient("L").resize(size)
+	
+	return Image.merge("RGB", [horizontal.point(lambda v, s=s: (v + s) % 256) for s in start])
+
+
+# flat colours and hard edges, like screenshots and drawings
+def draw_shapes(random: Random, size: tuple[int, int]) -> Image.Image:
+	image: Image.Image = Image.new("RGB", size, (random.randrange(256), random.randrange(256), random.randrange(256)))
+	draw: ImageDraw.ImageDraw = ImageDraw.Draw(image)
+	
+	for _ in range(24):
+		x0, y0 = random.randrange(size[0]), random.randrange(size[1])
+		x1: int = min(x0 + random.randrange(size[0] // 2 + 1), size[0])
+		y1: int = min(y0 + random.randrange(size[1] // 2 + 1), size[1])
+		colour: tuple[int, int, int] = (random.randrange(256), random.randrange(256), random.randrange(256))
+		
+		if random.random() < 0.5:
+			draw.rectangle((x0, y0, x1, y1), fill=colour)
+		else:
+			draw.ellipse((x0, y0, x1, y1), fill=colour)
+	
+	return image
+
+
+CONTENTS: dict[str, Callable[[Random, tuple[int, int]], Image.Image]] = {
+	"noise": draw_noise,
+	"gradient": draw_gradient,
+	"shapes": draw_shapes
+}
+
+
+# the same seed and version always produce the same files
+def generate_corpus(directory: Path, seed: int) -> list[Path]:
+	random: Random = Random(seed)
+	images: list[Path] = []
+	
+	directory.mkdir(parents=True, exist_ok=True)
+	
+	for size in SIZES:
+		for content, draw in CONTENTS.items():
+			for image_format, extension in FORMATS:
+				name: str = f"{content}-{size[0]}x{size[1]}-{image_format.lower()}-as-{extension}"
+				image_path: Path = directory / f"{name}.{extension}"
+				images.append(image_path)
+				
+				# drawn anyway, the following files depend on where the random stream is
+				image: Image.Image = draw(random, size)
+				
+				if not image_path.exists():
+					image.save(image_path, image_format)
+	
+	return images
+
+
+def current_commit() -> str | None:
+	process: subprocess.CompletedProcess = subprocess.run(
+		["git", "rev-parse", "--short", "HEAD"],
+		capture_output=True,
+		text=True,
+		cwd=Path(__file__).parent
+	)
+	
+	return process.stdout.strip() if process.returncode == 0 else None
+
+
+@dataclass
+class BenchmarkResult:
+	commit: str | None
+	date: str
+	corpus: str
+	mode: str
+	threads: int
+	images: int
+	wall_time: float
+	cpu_time: float
+	cpu_utilization: float
+	images_per_second: float
+	bytes_per_second: float
+	old_size: int
+	new_size: int
+	
+	@property
+	def size_change(self) -> float:
+		return self.new_size / self.old_size - 1 if self.old_size > 0 else 0.0
+
+
+def run_benchmark(corpus: list[Path], corpus_id: str, factory: OptimizerFactory, threads: int) -> BenchmarkResult:
+	working_directory: Path = Path.cwd()
+	
+	with TemporaryDirectory(prefix="opti-dir2-benchmark-") as temporary_directory:
+		images: list[Path] = []
+		for image in corpus:
+			shutil.copy2(image, temporary_directory)
+			images.append(Path(temporary_directory) / image.name)
+		
+		# deleted images end up relative to the working directory
+		os.chdir(temporary_directory)
+		
+		try:
+			# a fresh history: the order must not depend on earlier runs on this machine
+			cost_model: CostModel = CostModel(factory, History(Path(temporary_directory) / "history.json"))
+			
+			started: float = monotonic()
+			results: list[OptimizedImage] = optimize_files(images, threads, factory, False, cost_model=cost_model)
+			wall_time: float = monotonic() - started
+		finally:
+			os.chdir(working_directory)
+	
+	cpu_time: float = sum(step.cpu_time for result in results for step in result.steps)
+	old_size: int = sum(result.old_size for result in results)
+	
+	return BenchmarkResult(
+		current_commit(),
+		datetime.now().isoformat(timespec="seconds"),
+		corpus_id,
+		factory.mode.name,
+		threads,
+		len(results),
+		wall_time,
+		cpu_time,
+		cpu_time / (wall_time * threads),
+		len(results) / wall_time,
+		old_size / wall_time,
+		old_size,
+		sum(result.new_size for result in results)
+	)
+
+
+def load_results(file: Path) -> list[dict[str, Any]]:
+	if not file.is_file():
+		return []
+	
+	with open(file, "r") as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+
+# the latest result of the same benchmark, measured on another commit
+def find_baseline(results: list[dict[str, Any]], result: BenchmarkResult) -> dict[str, Any] | None:
+	for previous in reversed(results):
+		if (
+			previous["corpus"] == result.corpus
+			and previous["mode"] == result.mode
+			and previous["threads"] == result.threads
+			and previous["commit"] != result.commit
+		):
+			return previous
+	return None
+
+
+def print_result(result: BenchmarkResult, baseline: dict[str, Any] | None) -> None:
+	comparison: str = ""
+	if baseline is not None:
+		change: float = (result.wall_time / baseline["wall_time"] - 1) * 100
+		comparison = f" | {change:+.1f}% wall vs {baseline["commit"]}"
+	
+	LOGGER.log(
+		f"{result.mode:<8} {result.threads:>3} threads | {result.wall_time:7.2f}s | {result.images_per_second:7.2f} img/s"
+		f" | {result.bytes_per_second / 1024 / 1024:7.2f} MiB/s | cpu {result.cpu_utilization * 100:5.1f}%"
+		f" | size {result.size_change * 100:+.2f}%{comparison}"
+	)
+
+
+def main() -> None:
+	parser: ArgumentParser = ArgumentParser(description="Benchmark opti-dir2 on a generated image corpus")
+	parser.add_argument(
+		"-t",
+		"--threads",
+		type=int,
+		nargs="+",
+		dest="threads",
+		default=sorted({ 1, max(os.cpu_count() // 2, 1), os.cpu_count() }),
+		help="The thread counts to benchmark"
+	)
+	parser.add_argument(
+		"-m",
+		"--mode",
+		nargs="+",
+		dest="modes",
+		default=[mode.name.lower() for mode in OptimizationMode],
+		choices=[mode.name.lower() for mode in OptimizationMode],
+		help="The modes to benchmark"
+	)
+	parser.add_argument("--seed", type=int, default=0, dest="seed", help="Seed of the generated corpus")
+	parser.add_argument(
+		"--corpus",
+		type=str,
+		dest="corpus",
+		default=str(HISTORY_FILE.with_name("benchmark-corpus")),
+		help="Where the generated corpus is kept between runs"
+	)
+	parser.add_argument(
+		"--results",
+		type=str,
+		dest="results",
+		default=str(RESULTS_FILE),
+		help="Results are appended to this file and compared against earlier commits"
+	)
+	args: Namespace = parser.parse_args()
+	
+	corpus_id: str = f"v{CORPUS_VERSION}-seed{args.seed}"
+	corpus: list[Path] = generate_corpus(Path(args.corpus).expanduser() / corpus_id, args.seed)
+	
+	results_file: Path = Path(args.results).expanduser()
+	previous_results: list[dict[str, Any]] = load_results(results_file)
+	skipped: dict[str, set[str]] = { }
+	
+	LOGGER.log(f"corpus {corpus_id}: {len(corpus)} images")
+	
+	for mode_name in args.modes:
+		factory: OptimizerFactory = create_factory(OptimizationMode[mode_name.upper()])
+		
+		missing_tools: set[str] = factory.get_missing_tools()
+		if missing_tools:
+			skipped[mode_name] = missing_tools
+			continue
+		
+		for threads in args.threads:
+			result: BenchmarkResult = run_benchmark(corpus, corpus_id, factory, threads)
+			
+			print_result(result, find_baseline(previous_results, result))
+			
+			results_file.parent.mkdir(parents=True, exist_ok=True)
+			with open(results_file, "a") as f:
+				f.write(json.dumps(asdict(result)) + "\n")
+	
+	for mode_name, missing_tools in skipped.items():
+		LOGGER.warn(f"skipped {mode_name}: missing {", ".join(sorted(missing_tools))}")
+
+
+if __name__ == '__main__':
+	main()
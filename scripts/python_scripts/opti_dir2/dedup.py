@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import auto, Enum
+from fcntl import ioctl
+from pathlib import Path
+from shutil import copy2, copystat
+from tempfile import mkstemp
+from typing import TYPE_CHECKING
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.manifest import file_digest
+from python_scripts.opti_dir2.opti_dir2 import CLEAR_LINE, delete_file, DeletedImages, OptimizedImage, STAGING_PREFIX
+
+if TYPE_CHECKING:
+	from python_scripts.opti_dir2.journal import Journal
+
+LOGGER: Logger = Logger("opti-dir2")
+
+# from linux/fs.h
+FICLONE: int = 0x40049409
+
+
+class DedupMethod(Enum):
+	# an independent copy; shares blocks with the original where the file system supports it
+	REFLINK = auto()
+	COPY = auto()
+	# every duplicate becomes the same file
+	HARDLINK = auto()
+
+
+@dataclass
+class Duplicate:
+	path: Path
+	# the representative or duplicate this one is a hardlink of; it stays one
+	linked_to: Path | None = None
+
+
+# Groups the images by inode first, and only hashes images of the same size. Returns one representative
+# per group, in the original order, and the duplicates of every representative.
+def find_duplicates(images: list[Path], threads: int) -> tuple[list[Path], dict[Path, list[Duplicate]]]:
+	by_inode: dict[tuple[int, int], list[Path]] = { }
+	sizes: dict[tuple[int, int], int] = { }
+	
+	for image in images:
+		stat: os.stat_result = image.stat()
+		by_inode.setdefault((stat.st_dev, stat.st_ino), []).append(image)
+		sizes[(stat.st_dev, stat.st_ino)] = stat.st_size
+	
+	by_size: dict[tuple[int, int], list[tuple[int, int]]] = { }
+	for inode, size in sizes.items():
+		# a reflink or hardlink cannot cross file systems
+		by_size.setdefault((inode[0], size), []).append(inode)
+	
+	to_hash: list[tuple[int, int]] = [inode for inodes in by_size.values() if len(inodes) > 1 for inode in inodes]
+	
+	with ThreadPoolExecutor(threads, thread_name_prefix="opti-dir2-digest") as executor:
+		digests: dict[tuple[int, int], str] = dict(
+			zip(to_hash, executor.map(lambda inode: file_digest(by_inode[inode][0]), to_hash))
+		)
+	
+	groups: dict[tuple[int, int] | tuple[int, str], list[tuple[int, int]]] = { }
+	for inode in by_inode:
+		key: tuple[int, int] | tuple[int, str] = (inode[0], digests[inode]) if inode in digests else inode
+		groups.setdefault(key, []).append(inode)
+	
+	duplicates: dict[Path, list[Duplicate]] = { }
+	for inodes in groups.values():
+		representative, *linked = by_inode[inodes[0]]
+		
+		duplicates[representative] = [Duplicate(path, representative) for path in linked]
+		
+		# the first path of an inode is replicated before its hardlinks
+		for inode in inodes[1:]:
+			first, *linked = by_inode[inode]
+			duplicates[representative] += [Duplicate(first), *(Duplicate(path, first) for path in linked)]
+	
+	representatives: list[Path] = [image for image in images if image in duplicates]
+	duplicate_count: int = len(images) - len(representatives)
+	
+	if duplicate_count > 0:
+		LOGGER.info(f"found {duplicate_count} duplicates, they are reproduced from {len(representatives)} images")
+	
+	return representatives, { image: group for image, group in duplicates.items() if group }
+
+
+def reflink(source: Path, target: Path) -> None:
+	try:
+		with open(source, "rb") as s, open(target, "wb") as t:
+			ioctl(t.fileno(), FICLONE, s.fileno())
+	except OSError:
+		# not supported by the file system
+		copy2(source, target)
+		return
+	
+	copystat(source, target)
+
+
+# reproduces the result of the representative for a duplicate, the same way a commit would, journal included
+# a duplicate which cannot be reproduced fails on its own, the run goes on
+def replicate(
+	result: OptimizedImage,
+	duplicate: Duplicate,
+	method: DedupMethod,
+	deleted_images: DeletedImages | None = None,
+	journal: Journal | None = None
+) -> OptimizedImage:
+	try:
+		return _replicate(result, duplicate, method, deleted_images, journal)
+	except OSError as exc:
+		LOGGER.error(f"{CLEAR_LINE}Could not reproduce '{result.source}' as '{duplicate.path}': {exc}")
+		
+		size: int = duplicate.path.stat().st_size if duplicate.path.exists() else 0
+		return OptimizedImage(duplicate.path, size, size, False, duplicate.path)
+
+
+def _replicate(
+	result: OptimizedImage,
+	duplicate: Duplicate,
+	method: DedupMethod,
+	deleted_images: DeletedImages | None,
+	journal: Journal | None
+) -> OptimizedImage:
+	old_size: int = duplicate.path.stat().st_size
+	
+	# a failed or kept representative leaves its duplicates as they are
+	if not result.success or (result.image == result.source and result.new_size == result.old_size):
+		return OptimizedImage(duplicate.path, old_size, old_size, result.success, duplicate.path)
+	
+	target: Path = duplicate.path.with_suffix(result.image.suffix)
+	
+	if target != duplicate.path and target.exists():
+		LOGGER.warn(f"{CLEAR_LINE}Keeping '{duplicate.path}', '{target}' already exists")
+		return OptimizedImage(duplicate.path, old_size, old_size, False, duplicate.path)
+	
+	mtime: float = duplicate.path.stat().st_mtime
+	
+	# built next to the target, so the replace is atomic
+	handle, temporary_name = mkstemp(prefix=STAGING_PREFIX, dir=duplicate.path.parent)
+	os.close(handle)
+	temporary_file: Path = Path(temporary_name)
+	# a commit which broke off is left to the recovery, like the one of an ImageJob
+	committing: bool = False
+	
+	# the temporary file is the job, and the landing file which is removed if it does not get to its commit
+	if journal is not None:
+		journal.begin(temporary_file, duplicate.path, old_size, temporary_file)
+	
+	try:
+		if duplicate.linked_to is not None:
+			temporary_file.unlink()
+			
+			if duplicate.linked_to == result.source:
+				os.link(result.image, temporary_file)
+			else:
+				# the earlier duplicate already got its new suffix
+				os.link(duplicate.linked_to.with_suffix(result.image.suffix), temporary_file)
+		elif method == DedupMethod.HARDLINK:
+			temporary_file.unlink()
+			os.link(result.image, temporary_file)
+		else:
+			if method == DedupMethod.REFLINK:
+				reflink(result.image, temporary_file)
+			else:
+				copy2(result.image, temporary_file)
+			
+			os.utime(temporary_file, (mtime, mtime))
+		
+		if journal is not None:
+			committing = True
+			journal.commit(temporary_file, duplicate.path, old_size, temporary_file, target)
+		
+		temporary_file.replace(target)
+		
+		if target != duplicate.path:
+			delete_file(duplicate.path, deleted_images)
+		
+		committing = False
+	finally:
+		if not committing:
+			temporary_file.unlink(missing_ok=True)
+			
+			if journal is not None:
+				journal.done(temporary_file, duplicate.path)
+	
+	return OptimizedImage(target, old_size, target.stat().st_size, True, duplicate.path)
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from PIL import Image
+
+from python_scripts.logger import Logger
+
+LOGGER: Logger = Logger("opti-dir2")
+CLEAR_LINE: str = "\r\u001B[0J"
+
+JPEG: bytes = b"\xFF\xD8\xFF"
+PNG: bytes = b"\x89PNG\r\n\x1A\n"
+GIF: tuple[bytes, ...] = (b"GIF87a", b"GIF89a")
+RIFF: bytes = b"RIFF"
+WEBP: bytes = b"WEBP"
+ISO_FTYP: bytes = b"ftyp"
+AVIF_BRANDS: tuple[bytes, ...] = (b"avif", b"avis")
+JXL_CODESTREAM: bytes = b"\xFF\x0A"
+JXL_CONTAINER: bytes = b"\x00\x00\x00\x0CJXL \r\n\x87\n"
+
+# enough for the compatible brands of an ISO media file
+HEADER_LENGTH: int = 32
+# files are sniffed in batches, so a streamed scan is not held up
+BATCH_SIZE: int = 256
+# an image Pillow cannot read the header of is assumed to have 4 bits per pixel
+FALLBACK_PIXELS_PER_BYTE: int = 2
+
+# the extension a file of a detected type gets; while 'jpeg' should be used, everything uses jpg
+EXTENSIONS: dict[str, str] = {
+	"jpeg": "jpg",
+	"png": "png",
+	"webp": "webp",
+	"gif": "gif",
+	"avif": "avif",
+	"jxl": "jxl"
+}
+
+
+def detect_type(header: bytes) -> str | None:
+	if header.startswith(JPEG):
+		return "jpeg"
+	if header.startswith(PNG):
+		return "png"
+	if header.startswith(RIFF) and header[8:12] == WEBP:
+		return "webp"
+	if header.startswith(GIF):
+		return "gif"
+	if header.startswith(JXL_CODESTREAM) or header.startswith(JXL_CONTAINER):
+		return "jxl"
+	
+	if header[4:8] == ISO_FTYP:
+		# major brand, then the compatible brands after the minor version
+		brands: list[bytes] = [header[i:i + 4] for i in range(8, min(int.from_bytes(header[0:4]), len(header)), 4)]
+		del brands[1:2]
+		
+		if any(brand in AVIF_BRANDS for brand in brands):
+			return "avif"
+	
+	return None
+
+
+def sniff(file: Path) -> str | None:
+	try:
+		with open(file, "rb") as f:
+			return detect_type(f.read(HEADER_LENGTH))
+	except OSError:
+		return None
+
+
+def pixel_count(image: Path) -> int:
+	try:
+		# only the header is read
+		with Image.open(image) as opened:
+			return opened.width * opened.height
+	except (OSError, ValueError, Image.DecompressionBombError):
+		pass
+	
+	try:
+		return image.stat().st_size * FALLBACK_PIXELS_PER_BYTE
+	except OSError:
+		# gone since it was found, whatever is done with it next fails on its own
+		return 0
+
+
+# more than one frame, be it a GIF, an APNG or an animated WebP
+def is_animated(image: Path) -> bool:
+	try:
+		with Image.open(image) as opened:
+			return getattr(opened, "is_animated", False)
+	except (OSError, ValueError, Image.DecompressionBombError):
+		return False
+
+
+def matches_extension(file: Path, file_type: str) -> bool:
+	# the factory looks up steps by the exact extension
+	return file.suffix == f".{EXTENSIONS[file_type]}"
+
+
+# renames the file to the extension of its type, unless that would replace another file
+def fix_extension(file: Path, file_type: str) -> Path:
+	if matches_extension(file, file_type):
+		return file
+	
+	target: Path = file.with_suffix(f".{EXTENSIONS[file_type]}")
+	
+	if target.exists():
+		LOGGER.warn(f"{CLEAR_LINE}Not renaming '{file}' to '{target}', it already exists")
+		return file
+	
+	LOGGER.verbose_log(f"{CLEAR_LINE}Found bad file extension: '{file}' -> '{target}'")
+	file.rename(target)
+	
+	return target
+
+
+# Sniffs the header of every file and only keeps those of a type in `file_types`. The headers of a batch are
+# read in parallel, which mostly matters on network file systems and cold disks.
+def detect_images(
+	files: Iterable[Path],
+	file_types: set[str],
+	threads: int,
+	rename: bool = True
+) -> Iterator[Path]:
+	with ThreadPoolExecutor(threads, thread_name_prefix="opti-dir2-sniff") as executor:
+		for batch in batched(files, BATCH_SIZE):
+			for file, file_type in zip(batch, executor.map(sniff, batch)):
+				if file_type is None:
+					LOGGER.verbose_log(f"{CLEAR_LINE}Skipping '{file}', not a known image type")
+					continue
+				
+				if file_type not in file_types:
+					LOGGER.verbose_log(f"{CLEAR_LINE}Skipping '{file}', nothing optimizes {file_type}")
+					continue
+				
+				if not rename:
+					yield file
+					continue
+				
+				try:
+					image: Path = fix_extension(file, file_type)
+				except OSError as exc:
+					# gone since it was sniffed
+					LOGGER.warn(f"{CLEAR_LINE}Skipping '{file}': {exc}")
+					continue
+				
+				# the pipeline is chosen by the extension, so it has to match
+				if matches_extension(image, file_type):
+					yield image
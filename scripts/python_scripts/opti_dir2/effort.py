@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from os.path import getsize
+from pathlib import Path
+from typing import Any
+
+from python_scripts.opti_dir2.detect import pixel_count
+from python_scripts.opti_dir2.history import History
+from python_scripts.opti_dir2.opti_dir2 import EnvVar
+
+# CPU seconds Oxipng may spend on a single image when OXI_OPT_LEVEL is "auto"
+OXIPNG_TIME_BUDGET: EnvVar = EnvVar("OXIPNG_TIME_BUDGET", "10")
+# a higher effort is only used if every additional CPU second saves at least this many bytes
+OXIPNG_MIN_GAIN: EnvVar = EnvVar("OXIPNG_MIN_GAIN", "2048")
+
+HISTORY_SECTION: str = "oxipng-effort"
+# older runs fade out, so the policy follows new Oxipng versions
+DECAY: float = 0.98
+MIN_SAMPLES: int = 3
+# every nth image of a bucket tries an effort which is not known well enough yet
+EXPLORE_EVERY: int = 5
+
+MEGAPIXEL: int = 1_000_000
+
+
+@dataclass(frozen=True)
+class Effort:
+	level: int
+	# in the syntax of `oxipng --filters`
+	filters: str
+	# CPU seconds per megapixel until there are timings
+	prior_seconds: float
+	
+	@property
+	def key(self) -> str:
+		return f"o{self.level}:{self.filters}"
+	
+	def filter_indices(self) -> list[int]:
+		indices: list[int] = []
+		
+		for part in self.filters.split(","):
+			first, _, last = part.partition("-")
+			indices += range(int(first), int(last or first) + 1)
+		
+		return indices
+
+
+# from cheap to expensive; the second one is what a fixed OXI_OPT_LEVEL of 2 does
+EFFORTS: list[Effort] = [
+	Effort(1, "0,5", 0.1),
+	Effort(2, "0-9", 0.5),
+	Effort(3, "0-9", 1.0),
+	Effort(4, "0-9", 2.5),
+	Effort(6, "0-9", 8.0)
+]
+BASELINE: Effort = EFFORTS[1]
+
+
+@dataclass
+class Choice:
+	effort: Effort
+	bucket: str
+	pixels: int
+	input_size: int
+
+
+# Picks the Oxipng effort per image. Every effort is known per bucket of similar pixel counts by its CPU seconds
+# per megapixel and the share of the input it saves. Starting from the cheapest effort, a more expensive one is
+# taken as long as each additional CPU second is expected to save OXIPNG_MIN_GAIN bytes, which maximizes the
+# bytes saved per CPU second at that exchange rate. Efforts over OXIPNG_TIME_BUDGET are never used.
+class OxipngEffort:
+	def __init__(self, history: History):
+		self.history = history
+		
+		self._buckets = history.section(HISTORY_SECTION)
+	
+	@staticmethod
+	def bucket(pixels: int) -> str:
+		return f"{4 ** round(math.log(max(pixels, 1), 4))}px"
+	
+	def _seconds(self, stats: dict[str, Any], effort: Effort) -> float:
+		sums: dict[str, float] | None = stats["efforts"].get(effort.key)
+		
+		if sums is None or sums["n"] < MIN_SAMPLES:
+			return effort.prior_seconds
+		
+		return sums["seconds"] / sums["w"]
+	
+	@staticmethod
+	def _saved(stats: dict[str, Any], effort: Effort) -> float | None:
+		sums: dict[str, float] | None = stats["efforts"].get(effort.key)
+		
+		if sums is None or sums["n"] < MIN_SAMPLES:
+			return None
+		
+		return sums["saved"] / sums["w"]
+	
+	def choose(self, image: Path) -> Choice:
+		pixels: int = pixel_count(image)
+		input_size: int = getsize(image)
+		bucket: str = self.bucket(pixels)
+		megapixels: float = pixels / MEGAPIXEL
+		budget: float = float(OXIPNG_TIME_BUDGET.value())
+		min_gain: float = float(OXIPNG_MIN_GAIN.value())
+		
+		with self.history.lock:
+			stats: dict[str, Any] = self._buckets.setdefault(bucket, { "seen": 0, "efforts": { } })
+			stats["seen"] += 1
+			
+			affordable: list[Effort] = [
+				effort for effort in EFFORTS if self._seconds(stats, effort) * megapixels <= budget
+			] or EFFORTS[:1]
+			unknown: list[Effort] = [effort for effort in affordable if self._saved(stats, effort) is None]
+			
+			if unknown and stats["seen"] % EXPLORE_EVERY == 0:
+				return Choice(unknown[0], bucket, pixels, input_size)
+			
+			known: list[Effort] = [effort for effort in affordable if effort not in unknown]
+			
+			if len(known) == 0:
+				return Choice(BASELINE if BASELINE in affordable else affordable[0], bucket, pixels, input_size)
+			
+			chosen: Effort = known[0]
+			
+			for effort in known[1:]:
+				extra_seconds: float = (self._seconds(stats, effort) - self._seconds(stats, chosen)) * megapixels
+				extra_bytes: float = (self._saved(stats, effort) - self._saved(stats, chosen)) * input_size
+				
+				if extra_bytes >= min_gain * max(extra_seconds, 0.0):
+					chosen = effort
+		
+		return Choice(chosen, bucket, pixels, input_size)
+	
+	def record(self, choice: Choice, output_size: int, cpu_time: float) -> None:
+		if choice.input_size == 0:
+			return
+		
+		with self.history.lock:
+			stats: dict[str, Any] = self._buckets.setdefault(choice.bucket, { "seen": 0, "efforts": { } })
+			sums: dict[str, float] = stats["efforts"].setdefault(
+				choice.effort.key,
+				{ "n": 0, "w": 0, "seconds": 0, "saved": 0 }
+			)
+			
+			for name in ("w", "seconds", "saved"):
+				sums[name] *= DECAY
+			
+			sums["n"] += 1
+			sums["w"] += 1
+			sums["seconds"] += cpu_time / max(choice.pixels / MEGAPIXEL, 1e-3)
+			sums["saved"] += max(choice.input_size - output_size, 0) / choice.input_size
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import math
+import os
+import shutil
+from dataclasses import dataclass, field
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+from python_scripts import pretty_print_bytes
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.opti_dir2 import OptimizedImage, optimize_files, OptimizerFactory
+from python_scripts.opti_dir2.scheduling import CostModel
+
+LOGGER: Logger = Logger("opti-dir2")
+
+SAMPLE_SIZE: int = 100
+
+
+# images of the same format and a similar size behave alike
+def stratum(image: Path, size: int, factory: OptimizerFactory) -> tuple[str, int]:
+	file_type: str = image.suffix[1:].lower()
+	
+	return factory.get_alias(file_type) or file_type, 4 ** round(math.log(max(size, 1), 4))
+
+
+# every stratum gets at least one image, the rest is split by the number of images in it
+def stratified_sample(
+	images: list[Path],
+	sample_size: int,
+	factory: OptimizerFactory,
+	seed: int = 0
+) -> tuple[dict[tuple[str, int], list[Path]], dict[tuple[str, int], list[Path]]]:
+	random: Random = Random(seed)
+	strata: dict[tuple[str, int], list[Path]] = { }
+	
+	for image in images:
+		strata.setdefault(stratum(image, image.stat().st_size, factory), []).append(image)
+	
+	samples: dict[tuple[str, int], list[Path]] = {
+		key: random.sample(members, min(len(members), max(1, round(sample_size * len(members) / len(images)))))
+		for key, members in strata.items()
+	}
+	
+	return strata, samples
+
+
+@dataclass
+class Estimate:
+	images: int
+	sampled: int
+	threads: int
+	old_size: int
+	new_size: float
+	wall_time: float
+	cpu_time: float
+	failed: float
+	# the largest max_rss of a single run of each step
+	peak_memory: dict[str, int] = field(default_factory=dict)
+	# the worst case of `threads` images running at once
+	peak_concurrent_memory: int = 0
+
+
+def estimate_files(
+	images: list[Path],
+	threads: int,
+	factory: OptimizerFactory,
+	sample_size: int = SAMPLE_SIZE,
+	cost_model: CostModel | None = None,
+	seed: int = 0
+) -> Estimate:
+	strata, samples = stratified_sample(images, sample_size, factory, seed)
+	
+	working_directory: Path = Path.cwd()
+	
+	with TemporaryDirectory(prefix="opti-dir2-estimate-") as temporary_directory:
+		# every copy gets its own directory, which also identifies it after renames
+		copies: dict[Path, str] = { }
+		keys: dict[Path, tuple[str, int]] = { }
+		
+		for key, sample in samples.items():
+			for image in sample:
+				# images from different directories may share a name
+				copy: Path = Path(temporary_directory) / str(len(copies)) / image.name
+				copy.parent.mkdir()
+				shutil.copy2(image, copy)
+				copies[copy.parent] = image.name
+				keys[copy.parent] = key
+		
+		# deleted images end up relative to the working directory
+		os.chdir(temporary_directory)
+		
+		try:
+			started: float = monotonic()
+			results: list[OptimizedImage] = optimize_files(
+				[directory / name for directory, name in copies.items()],
+				threads,
+				factory,
+				cost_model=cost_model
+			)
+			elapsed: float = monotonic() - started
+		finally:
+			os.chdir(working_directory)
+	
+	by_stratum: dict[tuple[str, int], list[OptimizedImage]] = { }
+	for result in results:
+		by_stratum.setdefault(keys[result.image.parent], []).append(result)
+	
+	new_size: float = 0.0
+	work: float = 0.0
+	cpu_time: float = 0.0
+	failed: float = 0.0
+	
+	# scaled by bytes rather than count, both size and time mostly depend on the size of an image
+	for key, members in strata.items():
+		population_size: int = sum(image.stat().st_size for image in members)
+		sampled: list[OptimizedImage] = by_stratum.get(key, [])
+		sampled_size: int = sum(result.old_size for result in sampled)
+		
+		if sampled_size == 0:
+			new_size += population_size
+			continue
+		
+		scale: float = population_size / sampled_size
+		
+		new_size += sum(result.new_size for result in sampled) * scale
+		work += sum(result.duration for result in sampled) * scale
+		cpu_time += sum(step.cpu_time for result in sampled for step in result.steps) * scale
+		failed += sum(1 for result in sampled if not result.success) * len(members) / len(sampled)
+	
+	# the sample run shows how well the work spreads over the threads
+	sample_work: float = sum(result.duration for result in results)
+	efficiency: float = min(sample_work / (elapsed * threads), 1.0) if elapsed > 0 and sample_work > 0 else 1.0
+	
+	peak_memory: dict[str, int] = { }
+	for result in results:
+		for step in result.steps:
+			peak_memory[step.step] = max(peak_memory.get(step.step, 0), step.max_rss)
+	
+	image_peaks: list[int] = sorted((max((s.max_rss for s in r.steps), default=0) for r in results), reverse=True)
+	
+	return Estimate(
+		len(images),
+		len(results),
+		threads,
+		sum(image.stat().st_size for image in images),
+		new_size,
+		max(work / (threads * efficiency), max((result.duration for result in results), default=0.0)),
+		cpu_time,
+		failed,
+		peak_memory,
+		sum(image_peaks[:threads])
+	)
+
+
+def print_estimate(estimate: Estimate) -> None:
+	saved: float = estimate.old_size - estimate.new_size
+	percentage: float = saved / estimate.old_size * 100 if estimate.old_size > 0 else 0.0
+	
+	LOGGER.log(f"estimate from {estimate.sampled} of {estimate.images} images:")
+	LOGGER.log(f"\twall time : {estimate.wall_time / 60:.1f} min at {estimate.threads} threads")
+	LOGGER.log(f"\tcpu time  : {estimate.cpu_time / 60:.1f} min")
+	LOGGER.log(
+		f"\tsize      : {pretty_print_bytes(estimate.old_size)} -> {pretty_print_bytes(int(estimate.new_size))}"
+		f" (-{pretty_print_bytes(int(saved))} | -{percentage:.2f}%)"
+	)
+	
+	if estimate.failed > 0:
+		LOGGER.log(f"\tfailures  : ~{round(estimate.failed)}")
+	
+	LOGGER.log(
+		f"\tpeak memory: {pretty_print_bytes(estimate.peak_concurrent_memory)} with {estimate.threads} images at once"
+	)
+	for step, max_rss in sorted(estimate.peak_memory.items()):
+		LOGGER.log(f"\t\t{step:<16}: {pretty_print_bytes(max_rss)}")
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from threading import RLock
+from typing import Any
+
+from python_scripts.logger import Logger
+
+LOGGER: Logger = Logger("opti-dir2")
+
+HISTORY_FILE: Path = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "opti-dir2" / "history.json"
+
+
+# statistics which are carried over from one run to the next, grouped into named sections
+# without a file, they only last for this run
+class History:
+	def __init__(self, file: Path | None = HISTORY_FILE):
+		self.file = file
+		self.lock: RLock = RLock()
+		
+		self._sections: dict[str, dict[str, Any]] = { }
+		
+		if file is not None and file.is_file():
+			try:
+				with open(file, "r") as f:
+					self._sections = json.load(f)
+			except ValueError:
+				LOGGER.warn(f"ignoring broken history file '{file}'")
+	
+	# the returned dict is shared; modify it while holding the lock
+	def section(self, name: str) -> dict[str, Any]:
+		with self.lock:
+			return self._sections.setdefault(name, { })
+	
+	def save(self) -> None:
+		if self.file is None:
+			return
+		
+		with self.lock:
+			self.file.parent.mkdir(parents=True, exist_ok=True)
+			
+			temporary_file: Path = self.file.with_name(f"{self.file.name}.tmp")
+			
+			with open(temporary_file, "w") as f:
+				json.dump(self._sections, f)
+			
+			os.replace(temporary_file, self.file)
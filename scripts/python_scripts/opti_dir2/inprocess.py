@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+from abc import ABC, abstractmethod
+from importlib.metadata import PackageNotFoundError, version
+from multiprocessing.connection import Connection
+from multiprocessing.context import BaseContext
+from os.path import getsize
+from pathlib import Path
+from queue import Empty, Queue
+from resource import getrusage, RUSAGE_SELF
+from subprocess import CompletedProcess
+from threading import Lock
+from typing import Any, Callable, TYPE_CHECKING
+
+from PIL import Image
+
+from python_scripts.opti_dir2.opti_dir2 import (EnvVar, ImageOptimizer, MeasuredProcess, OptimizationResult,
+	OXIPNG_OPTIMIZATION_LEVEL, replace_file_type, step_timeout)
+
+if TYPE_CHECKING:
+	from python_scripts.opti_dir2.effort import Choice, OxipngEffort
+
+try:
+	import oxipng
+except ImportError:
+	oxipng = None
+
+# images up to this size are optimized in-process, 0 disables in-process optimizers
+IN_PROCESS_THRESHOLD: EnvVar = EnvVar("IN_PROCESS_THRESHOLD", str(256 * 1024))
+
+_pool: WorkerPool | None = None
+_pool_size: int | None = None
+_pool_lock: Lock = Lock()
+
+
+# the loop of a worker: runs one function at a time and sends back its measurements or why it failed
+def _serve(connection: Connection) -> None:
+	while True:
+		try:
+			function, arguments = connection.recv()
+		except EOFError:
+			return
+		
+		try:
+			connection.send((True, _measured(function, *arguments)))
+		except Exception as exc:
+			connection.send((False, str(exc)))
+
+
+class _Worker:
+	def __init__(self, context: BaseContext):
+		self.connection, child = context.Pipe()
+		self.process = context.Process(target=_serve, args=(child,), name="opti-dir2-worker", daemon=True)
+		self.process.start()
+		child.close()
+	
+	def kill(self) -> None:
+		self.process.kill()
+		self.process.join()
+		self.connection.close()
+
+
+# Runs in-process steps in worker processes, as most of the work holds the GIL. Every step has a worker of its own
+# while it runs, so a step which times out is killed without taking down the steps of other images, which a
+# ProcessPoolExecutor would. Workers are started on first use and replaced once killed.
+class WorkerPool:
+	def __init__(self, size: int):
+		self.size = size
+		self.closed: bool = False
+		
+		# forking a process with running threads may deadlock
+		self._context: BaseContext = multiprocessing.get_context("forkserver")
+		# None for a worker which is not started yet
+		self._idle: Queue[_Worker | None] = Queue()
+		
+		for _ in range(size):
+			self._idle.put(None)
+	
+	# the CPU time and peak memory of the function, None once the timeout is over and its worker was killed
+	def run(
+		self,
+		function: Callable[..., None],
+		arguments: tuple[Any, ...],
+		timeout: float | None
+	) -> tuple[float, int] | None:
+		worker: _Worker | None = self._idle.get()
+		# a worker which did not answer may still be busy, it is not used again
+		answered: bool = False
+		
+		try:
+			if worker is None:
+				worker = _Worker(self._context)
+			
+			worker.connection.send((function, arguments))
+			
+			if not worker.connection.poll(timeout):
+				return None
+			
+			# EOFError if the worker died, like when the OOM killer picked it
+			succeeded, value = worker.connection.recv()
+			answered = True
+		finally:
+			if worker is not None and (not answered or self.closed):
+				worker.kill()
+				worker = None
+			
+			self._idle.put(worker)
+		
+		if not succeeded:
+			raise RuntimeError(value)
+		
+		return value
+	
+	# busy workers are killed once their step is done
+	def close(self) -> None:
+		self.closed = True
+		
+		while True:
+			try:
+				worker: _Worker | None = self._idle.get_nowait()
+			except Empty:
+				return
+			
+			if worker is not None:
+				worker.kill()
+
+
+# shared by all in-process steps
+def get_pool() -> WorkerPool:
+	global _pool
+	
+	with _pool_lock:
+		if _pool is None:
+			_pool = WorkerPool(_pool_size or os.cpu_count())
+		
+		return _pool
+
+
+# the engines size the pool by their threads, so the in-process steps do not take more cores than the run may use
+def size_pool(size: int) -> None:
+	global _pool, _pool_size
+	
+	with _pool_lock:
+		_pool_size = size
+		
+		if _pool is not None and _pool.size != size:
+			_pool.close()
+			_pool = None
+
+
+# the peak memory of this process since the last reset, None if the kernel does not track it
+def _peak_rss(reset: bool = False) -> int | None:
+	try:
+		if reset:
+			# "5" resets VmHWM, see proc(5)
+			with open("/proc/self/clear_refs", "w") as f:
+				f.write("5")
+		
+		with open("/proc/self/status", "r") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	
+	return None
+
+
+def _measured(function: Callable[..., None], *args: Any) -> tuple[float, int]:
+	before = getrusage(RUSAGE_SELF)
+	has_peak: bool = _peak_rss(reset=True) is not None
+	function(*args)
+	after = getrusage(RUSAGE_SELF)
+	
+	cpu_time: float = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+	
+	# otherwise only the peak of the whole pool worker is known; ru_maxrss is in KiB on Linux
+	return cpu_time, (_peak_rss() if has_peak else None) or after.ru_maxrss * 1024
+
+
+# `--filters 0-9` of the CLI
+OXIPNG_FILTERS: list[str] = ["NoOp", "Sub", "Up", "Average", "Paeth", "MinSum", "Entropy", "Bigrams", "BigEnt", "Brute"]
+
+
+# pyoxipng only takes numbers; "auto" without an OxipngEffort gets the default level of the CLI
+def _oxipng_level() -> int:
+	level: str = OXIPNG_OPTIMIZATION_LEVEL.value()
+	
+	if level.isdigit():
+		return int(level)
+	return 6 if level == "max" else 2
+
+
+def _oxipng(image: str, level: int, filters: list[int]) -> None:
+	# the same options as the CLI: `--opt=level --filters 0-9 --fix`
+	oxipng.optimize(
+		image,
+		level=level,
+		fix_errors=True,
+		filter=[getattr(oxipng.RowFilter, OXIPNG_FILTERS[f]) for f in filters]
+	)
+
+
+def _decode_webp(image: str, target: str) -> None:
+	with Image.open(image) as webp:
+		webp.save(target, "PNG")
+
+
+# runs a module level function in the process pool, failures end up in the process result like for a tool
+class InProcessOptimizer(ImageOptimizer, ABC):
+	def target(self, image: Path) -> Path:
+		return image
+	
+	def is_available(self) -> bool:
+		return True
+	
+	@abstractmethod
+	def arguments(self, image: Path, target: Path) -> tuple[Callable[..., None], tuple[Any, ...]]:
+		pass
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		target: Path = self.target(image)
+		function, arguments = self.arguments(image, target)
+		timeout: float | None = step_timeout()
+		
+		try:
+			# None once the timeout is over, the worker is killed then like the process of a tool would be
+			measured: tuple[float, int] | None = get_pool().run(function, arguments, timeout)
+		except Exception as exc:
+			return OptimizationResult(target, None, CompletedProcess([self.name], 1, "", str(exc)))
+		
+		if measured is None:
+			return OptimizationResult(
+				target,
+				image if target != image else None,
+				MeasuredProcess([self.name], 1, "", f"timed out after {timeout:.0f}s", timed_out=True)
+			)
+		
+		cpu_time, max_rss = measured
+		process: MeasuredProcess = MeasuredProcess([self.name], 0, "", "")
+		process.cpu_time = cpu_time
+		process.max_rss = max_rss
+		
+		return OptimizationResult(target, image if target != image else None, process)
+
+
+# uses the same library as the oxipng CLI, the output is identical as long as the versions match
+class PyOxipng(InProcessOptimizer):
+	BYTES_PER_PIXEL = 16.0
+	
+	# a fixed level overrides both OXI_OPT_LEVEL and the effort, like for Oxipng
+	def __init__(self, effort: OxipngEffort | None = None, level: int | None = None):
+		self.effort = effort if level is None else None
+		self.level = level
+		
+		self._choices: dict[Path, Choice] = { }
+	
+	def _level(self) -> int:
+		return self.level if self.level is not None else _oxipng_level()
+	
+	@property
+	def configuration(self) -> str:
+		return f"{self.name} -o{"auto" if self.effort is not None else self._level()}"
+	
+	def fallback(self) -> ImageOptimizer | None:
+		if self.effort is not None or self._level() > 1:
+			return PyOxipng(level=1)
+		if self._level() == 1:
+			return PyOxipng(level=0)
+		return None
+	
+	def is_available(self) -> bool:
+		return oxipng is not None
+	
+	def version(self) -> str | None:
+		try:
+			return f"pyoxipng {version("pyoxipng")}"
+		except PackageNotFoundError:
+			return None
+	
+	def arguments(self, image: Path, target: Path) -> tuple[Callable[..., None], tuple[Any, ...]]:
+		choice: Choice | None = self._choices.get(image)
+		
+		if choice is None:
+			return _oxipng, (str(image), self._level(), list(range(len(OXIPNG_FILTERS))))
+		
+		return _oxipng, (str(image), choice.effort.level, choice.effort.filter_indices())
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		if self.effort is None:
+			return super().optimize(image)
+		
+		choice: Choice = self.effort.choose(image)
+		self._choices[image] = choice
+		
+		try:
+			result: OptimizationResult = super().optimize(image)
+		finally:
+			del self._choices[image]
+		
+		if not result.has_error():
+			self.effort.record(choice, getsize(result.new_image), result.process.cpu_time)
+		
+		return result
+
+
+# the decoded PNG is optimized by Oxipng afterwards anyway, so the decoder does not matter for the final size
+class PillowDWebp(InProcessOptimizer):
+	RELATIVE_COST = 0.3
+	
+	def version(self) -> str | None:
+		return f"Pillow {Image.__version__}"
+	
+	def target(self, image: Path) -> Path:
+		return replace_file_type(image, "png")
+	
+	def arguments(self, image: Path, target: Path) -> tuple[Callable[..., None], tuple[Any, ...]]:
+		return _decode_webp, (str(image), str(target))
+
+
+# spawning a tool costs more than optimizing a tiny image; those use the in-process optimizer if it is available
+class SizeSwitch(ImageOptimizer):
+	def __init__(self, small: InProcessOptimizer, large: ImageOptimizer):
+		self.small = small
+		self.large = large
+		
+		self.MULTITHREADED = large.MULTITHREADED
+		self.RELATIVE_COST = large.RELATIVE_COST
+		self.BYTES_PER_PIXEL = large.BYTES_PER_PIXEL
+	
+	# both run the same step, just in different places
+	@property
+	def name(self) -> str:
+		return self.large.name
+	
+	def wrapped_steps(self) -> list[ImageOptimizer]:
+		return [self.small, self.large]
+	
+	def select(self, image: Path) -> ImageOptimizer:
+		threshold: int = int(IN_PROCESS_THRESHOLD.value())
+		
+		if threshold > 0 and self.small.is_available() and image.stat().st_size <= threshold:
+			return self.small
+		return self.large
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		return self.select(image).optimize(image)
+	
+	def version(self) -> str | None:
+		return f"{self.small.version() if self.small.is_available() else None} / {self.large.version()}"
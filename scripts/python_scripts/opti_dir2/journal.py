@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.opti_dir2 import delete_file, DeletedImages, OptimizedImage
+
+if TYPE_CHECKING:
+	from python_scripts.opti_dir2.manifest import Manifest
+
+LOGGER: Logger = Logger("opti-dir2")
+
+JOURNAL_NAME: str = ".opti-dir2-journal.jsonl"
+# once it has this many lines, the journal is rewritten with only the jobs which are not done
+COMPACT_LINES: int = 1000
+
+
+@dataclass
+class JournalEntry:
+	# begin: the image was staged; commit: the staged result is about to replace the image; done: nothing is left
+	event: str
+	# the staging directory identifies a job
+	staging: str
+	image: str
+	old_size: int = 0
+	# on begin, the landing file the result may be copied to before the commit
+	staged: str | None = None
+	target: str | None = None
+
+
+# A write-ahead log of the jobs which touch the directory. A job which did not reach `done` was interrupted:
+# before its commit it only left a staging directory behind, which is rolled back. After its commit began,
+# the staged result is complete and the commit is finished instead.
+class Journal:
+	def __init__(self, file: Path):
+		self.file = file
+		
+		self._pending: dict[str, JournalEntry] = { }
+		self._lock: Lock = Lock()
+		self._fd: int | None = None
+		self._lines: int = 0
+	
+	# the jobs an interrupted run left behind
+	def unfinished(self) -> list[JournalEntry]:
+		if not self.file.is_file():
+			return []
+		
+		jobs: dict[str, JournalEntry] = { }
+		
+		with open(self.file, "r") as f:
+			for line in f:
+				try:
+					entry: JournalEntry = JournalEntry(**json.loads(line))
+				except (ValueError, TypeError):
+					# the last line of a killed run may be cut off
+					continue
+				
+				if entry.event == "done":
+					jobs.pop(entry.staging, None)
+				else:
+					jobs[entry.staging] = entry
+		
+		return list(jobs.values())
+	
+	def recover(self, manifest: Manifest | None = None, deleted_images: DeletedImages | None = None) -> tuple[int, int]:
+		finished: int = 0
+		rolled_back: int = 0
+		
+		for entry in self.unfinished():
+			if entry.event == "commit" and self._finish_commit(entry, manifest, deleted_images):
+				finished += 1
+			else:
+				rolled_back += 1
+				
+				# the landing file next to the image, of a job staged in the scratch directory
+				if entry.staged is not None:
+					Path(entry.staged).unlink(missing_ok=True)
+			
+			shutil.rmtree(entry.staging, ignore_errors=True)
+		
+		self.file.unlink(missing_ok=True)
+		
+		return finished, rolled_back
+	
+	@staticmethod
+	def _finish_commit(entry: JournalEntry, manifest: Manifest | None, deleted_images: DeletedImages | None) -> bool:
+		image: Path = Path(entry.image)
+		staged: Path = Path(entry.staged)
+		target: Path = Path(entry.target)
+		
+		if staged.exists():
+			if target != image and target.exists():
+				LOGGER.warn(f"rolling back '{image}', '{target}' already exists")
+				return False
+			
+			staged.replace(target)
+		
+		if not target.exists():
+			LOGGER.warn(f"rolling back '{image}', the result is gone")
+			return False
+		
+		if target != image and image.exists():
+			delete_file(image, deleted_images)
+		
+		LOGGER.verbose_log(f"finished the interrupted commit of '{image}' -> '{target}'")
+		
+		if manifest is not None:
+			manifest.record(OptimizedImage(target, entry.old_size, target.stat().st_size))
+		
+		return True
+	
+	def begin(self, staging: Path, image: Path, old_size: int, landing: Path | None = None) -> None:
+		self._append(JournalEntry("begin", str(staging), str(image), old_size, str(landing) if landing else None))
+	
+	def commit(self, staging: Path, image: Path, old_size: int, staged: Path, target: Path) -> None:
+		# the commit must be on disk before the directory changes
+		self._append(JournalEntry("commit", str(staging), str(image), old_size, str(staged), str(target)), True)
+	
+	def done(self, staging: Path, image: Path) -> None:
+		self._append(JournalEntry("done", str(staging), str(image)))
+	
+	def _append(self, entry: JournalEntry, sync: bool = False) -> None:
+		line: bytes = (json.dumps(asdict(entry)) + "\n").encode()
+		
+		with self._lock:
+			if self._fd is None:
+				self._fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+			
+			os.write(self._fd, line)
+			self._lines += 1
+			
+			if sync:
+				os.fsync(self._fd)
+			
+			if entry.event == "done":
+				self._pending.pop(entry.staging, None)
+				
+				# a run which keeps going, like --watch, would grow it forever
+				if len(self._pending) == 0 or self._lines >= COMPACT_LINES:
+					self._compact()
+			else:
+				self._pending[entry.staging] = entry
+	
+	# only the last entry of a job counts, so that is all which is kept
+	def _compact(self) -> None:
+		if len(self._pending) == 0:
+			os.ftruncate(self._fd, 0)
+		else:
+			temporary_file: Path = self.file.with_name(f"{self.file.name}.tmp")
+			
+			with open(temporary_file, "w") as f:
+				for entry in self._pending.values():
+					f.write(json.dumps(asdict(entry)) + "\n")
+				f.flush()
+				os.fsync(f.fileno())
+			
+			os.replace(temporary_file, self.file)
+			os.close(self._fd)
+			self._fd = os.open(self.file, os.O_WRONLY | os.O_APPEND)
+		
+		self._lines = len(self._pending)
+	
+	# a run which finished every job leaves no journal behind
+	def close(self) -> None:
+		with self._lock:
+			if self._fd is None:
+				return
+			
+			os.close(self._fd)
+			self._fd = None
+			
+			if len(self._pending) == 0:
+				self.file.unlink(missing_ok=True)
+	
+	def __enter__(self) -> Journal:
+		return self
+	
+	def __exit__(self, *_) -> None:
+		self.close()
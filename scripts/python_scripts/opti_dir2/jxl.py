@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import math
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from subprocess import CompletedProcess, DEVNULL, Popen
+from time import monotonic, sleep
+from typing import Any
+
+from PIL import Image
+
+from python_scripts.opti_dir2.detect import is_animated
+from python_scripts.opti_dir2.history import History
+from python_scripts.opti_dir2.opti_dir2 import (CJXL, EnvVar, ImageOptimizer, JXL_DISTANCE, MeasuredProcess,
+	OptimizationResult, replace_file_type, step_threads, step_timeout)
+
+# wall time in seconds all candidates of an image may take; the baseline is only killed by the step timeout
+JXL_TIME_BUDGET: EnvVar = EnvVar("JXL_TIME_BUDGET", "30")
+
+HISTORY_SECTION: str = "jxl-candidates"
+# a bucket picks its winner directly once it has this many full comparisons ...
+MIN_COMPARISONS: int = 5
+# ... and the winner has won this share of them
+MIN_WIN_SHARE: float = 0.8
+# every nth image of a decided bucket still runs all candidates, so a changed encoder is noticed
+EXPLORE_EVERY: int = 10
+POLL_INTERVAL: float = 0.02
+
+
+@dataclass
+class Candidate:
+	name: str
+	arguments: list[Any]
+	# candidates only make sense for some inputs, like transcoding a JPEG
+	jpeg_only: bool = False
+
+
+def candidates(image: Path) -> list[Candidate]:
+	# cjxl transcodes JPEGs losslessly by default, the others have to reencode the pixels
+	distance: list[str] = ["-d", JXL_DISTANCE.value(), *(["--lossless_jpeg=0"] if is_jpeg(image) else [])]
+	
+	# the first one is the baseline, the same as CJXL
+	available: list[Candidate] = [
+		Candidate("e7", [*distance, "-e", "7"]),
+		Candidate("e9", [*distance, "-e", "9"]),
+		Candidate("e7-modular", [*distance, "-e", "7", "--modular=1"]),
+		Candidate("lossless-jpeg", ["--lossless_jpeg=1", "-e", "7"], jpeg_only=True),
+		Candidate("lossless-jpeg-e9", ["--lossless_jpeg=1", "-e", "9"], jpeg_only=True)
+	]
+	
+	return [c for c in available if is_jpeg(image) or not c.jpeg_only]
+
+
+# images with the same input format, similar resolution and similar bits per pixel tend to have the same winner
+def characteristics(image: Path) -> str:
+	try:
+		with Image.open(image) as opened:
+			pixels: int = opened.width * opened.height
+	except (OSError, ValueError):
+		return f"{image.suffix[1:].lower()}:unknown"
+	
+	bits_per_pixel: float = image.stat().st_size * 8 / max(pixels, 1)
+	
+	return (
+		f"{"jpeg" if is_jpeg(image) else image.suffix[1:].lower()}"
+		f":{4 ** round(math.log(max(pixels, 1), 4))}px:{2 ** round(math.log2(max(bits_per_pixel, 1 / 16)))}bpp"
+	)
+
+
+def is_jpeg(image: Path) -> bool:
+	return image.suffix.lower() in (".jpg", ".jpeg")
+
+
+# Encodes an image with several cjxl configurations at once and keeps the smallest result. Up to step_threads()
+# candidates run in parallel, each single threaded. Once JXL_TIME_BUDGET is over, everything but the baseline
+# is killed. The winners are counted per image characteristics, a bucket with a clear winner only runs that one.
+class CJXLCandidates(ImageOptimizer):
+	VERSION_COMMAND = CJXL.VERSION_COMMAND
+	MULTITHREADED = True
+	RELATIVE_COST = 6.0
+	# a few encoders at once
+	BYTES_PER_PIXEL = 120.0
+	LOSSY = True
+	
+	def __init__(self, history: History | None = None):
+		self.history = history
+	
+	def target(self, image: Path) -> Path:
+		return replace_file_type(image, "jxl")
+	
+	def fallback(self) -> ImageOptimizer | None:
+		return CJXL(3)
+	
+	# the candidates are about still images, an animation is always stored losslessly
+	def select(self, image: Path) -> ImageOptimizer:
+		return CJXL() if is_animated(image) else self
+	
+	def select_candidates(self, image: Path, bucket: str) -> list[Candidate]:
+		available: list[Candidate] = candidates(image)
+		
+		if self.history is None:
+			return available
+		
+		with self.history.lock:
+			stats: dict[str, Any] = self.history.section(HISTORY_SECTION).setdefault(
+				bucket,
+				{ "seen": 0, "comparisons": 0, "wins": { } }
+			)
+			stats["seen"] += 1
+			
+			if stats["comparisons"] < MIN_COMPARISONS or stats["seen"] % EXPLORE_EVERY == 0:
+				return available
+			
+			winner, wins = max(stats["wins"].items(), key=lambda item: item[1], default=(None, 0))
+		
+		if wins / stats["comparisons"] < MIN_WIN_SHARE:
+			return available
+		
+		return [c for c in available if c.name == winner] or available
+	
+	def record(self, bucket: str, winner: str) -> None:
+		if self.history is None:
+			return
+		
+		with self.history.lock:
+			stats: dict[str, Any] = self.history.section(HISTORY_SECTION)[bucket]
+			stats["comparisons"] += 1
+			stats["wins"][winner] = stats["wins"].get(winner, 0) + 1
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		target: Path = self.target(image)
+		bucket: str = characteristics(image)
+		selected: list[Candidate] = self.select_candidates(image, bucket)
+		
+		pending: list[Candidate] = list(selected)
+		running: dict[int, tuple[Candidate, Popen, Path]] = { }
+		finished: dict[str, Path] = { }
+		failed: list[str] = []
+		killed: set[str] = set()
+		cpu_time: float = 0.0
+		max_rss: int = 0
+		
+		slots: int = max(int(step_threads()), 1)
+		deadline: float = monotonic() + float(JXL_TIME_BUDGET.value())
+		# unlike the budget, the timeout of the step spares nothing
+		timeout: float | None = step_timeout()
+		hard_deadline: float = monotonic() + timeout if timeout is not None else math.inf
+		timed_out: bool = False
+		
+		try:
+			while pending or running:
+				if monotonic() >= hard_deadline:
+					# the finally kills the rest
+					timed_out = True
+					break
+				
+				while pending and len(running) < slots:
+					candidate: Candidate = pending.pop(0)
+					output: Path = target.with_suffix(f".{candidate.name}.jxl")
+					
+					process: Popen = Popen(
+						["cjxl", *candidate.arguments, "--num_threads=1", image, output],
+						stdout=DEVNULL,
+						stderr=DEVNULL
+					)
+					running[process.pid] = (candidate, process, output)
+				
+				for pid in list(running):
+					reaped, status, usage = os.wait4(pid, os.WNOHANG)
+					if reaped == 0:
+						continue
+					
+					candidate, process, output = running.pop(pid)
+					# Popen must not try to reap the child again
+					process.returncode = os.waitstatus_to_exitcode(status)
+					
+					cpu_time += usage.ru_utime + usage.ru_stime
+					# the candidates run side by side, their peaks add up
+					max_rss += usage.ru_maxrss * 1024
+					
+					if process.returncode == 0 and output.exists():
+						finished[candidate.name] = output
+						continue
+					
+					output.unlink(missing_ok=True)
+					if candidate.name not in killed:
+						failed.append(candidate.name)
+				
+				if monotonic() >= deadline:
+					pending.clear()
+					
+					# the baseline always finishes, otherwise there may be nothing to keep
+					for candidate, process, _ in running.values():
+						if candidate.name not in killed and (candidate is not selected[0] or len(finished) > 0):
+							killed.add(candidate.name)
+							process.kill()
+				
+				sleep(POLL_INTERVAL)
+		finally:
+			for _, process, output in running.values():
+				process.kill()
+				process.wait()
+				output.unlink(missing_ok=True)
+		
+		if len(finished) == 0 and timed_out:
+			return OptimizationResult(
+				target,
+				None,
+				MeasuredProcess(["cjxl"], -9, "", f"timed out after {timeout:.0f}s", timed_out=True)
+			)
+		
+		if len(finished) == 0:
+			return OptimizationResult(
+				target,
+				None,
+				CompletedProcess(["cjxl"], 1, "", f"no candidate succeeded, failed: {", ".join(failed)}")
+			)
+		
+		winner: str = min(finished, key=lambda name: finished[name].stat().st_size)
+		
+		# a candidate which did not make it within the budget has lost, one which failed says nothing
+		if len(selected) > 1 and len(failed) == 0:
+			self.record(bucket, winner)
+		
+		for name, output in finished.items():
+			if name == winner:
+				output.rename(target)
+			else:
+				output.unlink()
+		
+		process: MeasuredProcess = MeasuredProcess(["cjxl", winner], 0, "", "")
+		process.cpu_time = cpu_time
+		process.max_rss = max_rss
+		
+		return OptimizationResult(target, image, process)
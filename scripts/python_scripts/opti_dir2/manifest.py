@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Any, Iterable, Iterator
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.opti_dir2 import OptimizedImage
+
+LOGGER: Logger = Logger("opti-dir2")
+
+MANIFEST_NAME: str = ".opti-dir2-manifest.jsonl"
+
+
+def file_digest(file: Path) -> str:
+	with open(file, "rb") as f:
+		return hashlib.file_digest(f, "blake2b").hexdigest()
+
+
+@dataclass
+class ManifestEntry:
+	path: str
+	size: int
+	mtime: int
+	digest: str
+	profile: dict[str, Any]
+
+
+# append-only: every finished image adds one line, the last line of a path wins
+# an interrupted run leaves at most one broken line behind, which is ignored when loading
+class Manifest:
+	def __init__(self, file: Path, profile: dict[str, Any], force: bool = False, read_only: bool = False):
+		self.file = file
+		self.profile = profile
+		self.force = force
+		# only answers which images are optimized, nothing is written
+		self.read_only = read_only
+		self.skipped: int = 0
+		
+		self._entries: dict[str, ManifestEntry] = { }
+		self._lock: Lock = Lock()
+		self._fd: int | None = None
+		
+		self._load()
+	
+	@staticmethod
+	def _key(image: Path) -> str:
+		return str(image.resolve())
+	
+	def _load(self) -> None:
+		if not self.file.is_file():
+			return
+		
+		with open(self.file, "r") as f:
+			for line in f:
+				try:
+					entry: ManifestEntry = ManifestEntry(**json.loads(line))
+				except (ValueError, TypeError):
+					LOGGER.verbose_log(f"ignoring broken manifest line in '{self.file}'")
+					continue
+				
+				self._entries[entry.path] = entry
+		
+		LOGGER.verbose_log(f"loaded {len(self._entries)} manifest entries from '{self.file}'")
+	
+	def is_optimized(self, image: Path) -> bool:
+		if self.force:
+			return False
+		
+		entry: ManifestEntry | None = self._entries.get(self._key(image))
+		
+		if entry is None or entry.profile != self.profile:
+			return False
+		
+		try:
+			stat: os.stat_result = image.stat()
+		except OSError:
+			return False
+		
+		if stat.st_size != entry.size:
+			return False
+		if stat.st_mtime_ns == entry.mtime:
+			return True
+		
+		# same size, but touched or copied: only the content can tell
+		if file_digest(image) != entry.digest:
+			return False
+		
+		self._append(ManifestEntry(entry.path, entry.size, stat.st_mtime_ns, entry.digest, entry.profile))
+		return True
+	
+	def filter(self, images: Iterable[Path]) -> Iterator[Path]:
+		for image in images:
+			try:
+				optimized: bool = self.is_optimized(image)
+			except OSError as exc:
+				# gone or unreadable since it was found
+				LOGGER.warn(f"skipping '{image}': {exc}")
+				continue
+			
+			if optimized:
+				self.skipped += 1
+				continue
+			
+			yield image
+	
+	def record(self, image: OptimizedImage) -> None:
+		if not image.success:
+			return
+		
+		try:
+			stat: os.stat_result = image.image.stat()
+			digest: str = file_digest(image.image)
+		except OSError:
+			# moved or deleted since it was optimized, it is looked at again if it comes back
+			return
+		
+		self._append(ManifestEntry(self._key(image.image), stat.st_size, stat.st_mtime_ns, digest, self.profile))
+	
+	def _append(self, entry: ManifestEntry) -> None:
+		line: bytes = (json.dumps(asdict(entry)) + "\n").encode()
+		
+		with self._lock:
+			self._entries[entry.path] = entry
+			
+			if self.read_only:
+				return
+			
+			if self._fd is None:
+				self._fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+			
+			os.write(self._fd, line)
+	
+	def close(self) -> None:
+		with self._lock:
+			if self._fd is None:
+				return
+			
+			os.close(self._fd)
+			self._fd = None
+			
+			temporary_file: Path = self.file.with_name(f"{self.file.name}.tmp")
+			
+			with open(temporary_file, "w") as f:
+				for entry in self._entries.values():
+					f.write(json.dumps(asdict(entry)) + "\n")
+				f.flush()
+				os.fsync(f.fileno())
+			
+			os.replace(temporary_file, self.file)
+	
+	def __enter__(self) -> Manifest:
+		return self
+	
+	def __exit__(self, *_) -> None:
+		self.close()
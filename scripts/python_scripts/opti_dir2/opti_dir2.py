@@ -2,21 +2,43 @@ from __future__ import annotations
 
 import shutil
 from abc import ABC, abstractmethod
-from asyncio import Future
+from concurrent.futures import Future
 from concurrent.futures.thread import ThreadPoolExecutor
-from dataclasses import dataclass
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from enum import auto, Enum
-from math import floor
-from os import environ, listdir, utime
-from os.path import getmtime, getsize, islink
-from pathlib import Path
-from subprocess import CompletedProcess, run
-from time import sleep
-from typing import Any, TypeVar
+from functools import cache
+from os import environ, scandir, utime, wait4, waitstatus_to_exitcode
+from os import stat_result
+from os.path import getmtime, getsize
+from pathlib import Path, PurePath
+from queue import Queue
+from resource import struct_rusage
+from subprocess import CompletedProcess, Popen, run, SubprocessError
+from shutil import copy2
+from tempfile import mkdtemp, TemporaryFile
+from threading import BoundedSemaphore, Condition, Event, local, Lock, Thread, Timer
+from time import monotonic, thread_time
+from typing import Any, Callable, Iterable, Iterator, Sized, TYPE_CHECKING, TypeVar
 
 from progress.bar import IncrementalBar
 
+from python_scripts import pretty_print_bytes
 from python_scripts.logger import Logger
+from python_scripts.opti_dir2.detect import detect_images, fix_extension, is_animated, pixel_count, sniff
+
+if TYPE_CHECKING:
+	from python_scripts.opti_dir2.admission import MemoryModel
+	from python_scripts.opti_dir2.dedup import DedupMethod, Duplicate
+	from python_scripts.opti_dir2.effort import Choice, OxipngEffort
+	from python_scripts.opti_dir2.history import History
+	from python_scripts.opti_dir2.journal import Journal
+	from python_scripts.opti_dir2.manifest import Manifest
+	from python_scripts.opti_dir2.quality import QualityGuard, Verdict
+	from python_scripts.opti_dir2.quota import SizeBudget
+	from python_scripts.opti_dir2.report import RunReport
+	from python_scripts.opti_dir2.scheduling import CostModel
 
 LOGGER: Logger = Logger("opti-dir2")
 CLEAR_LINE: str = "\r\u001B[0J"
@@ -64,28 +86,209 @@ class EnvVar:
 		return environ.get(self.name, self.default)
 
 
+# "auto" picks the level and filters per image, see OxipngEffort
 OXIPNG_OPTIMIZATION_LEVEL: EnvVar = EnvVar("OXI_OPT_LEVEL", "2")
 JXL_DISTANCE: EnvVar = EnvVar("JXL_DISTANCE", "1")
 THREADS_PER_IMAGE: EnvVar = EnvVar("THREADS_PER_IMAGE", "1")
+# a result replaces the original only if it is smaller than the original times this ratio
+MAX_SIZE_RATIO: EnvVar = EnvVar("MAX_SIZE_RATIO", "1.0")
+# seconds every step gets before it is killed and retried with its fallback, 0 disables; see scaled_timeout
+STEP_TIMEOUT: EnvVar = EnvVar("STEP_TIMEOUT", "300")
+# additional seconds per megapixel, times the RELATIVE_COST of the step
+STEP_TIMEOUT_PER_MEGAPIXEL: EnvVar = EnvVar("STEP_TIMEOUT_PER_MEGAPIXEL", "30")
 
 DELETED_IMAGE_FOLDER: Path = Path("deleted-images")
+STAGING_PREFIX: str = ".opti-dir2-"
+
+# the threads granted to the step running on the current worker, see CoreBudget, and its timeout
+_step_threads: local = local()
+# picking a free name for a deleted image and moving it there is one step
+_delete_lock: Lock = Lock()
+
+
+# the image as it was handed in to the engine, for steps which treat the images of a run differently; see ImageJob
+# unlike the thread locals, it follows an image of the asyncio engine as well
+current_image: ContextVar[Path | None] = ContextVar("current_image", default=None)
+
+
+def step_threads() -> str:
+	return str(getattr(_step_threads, "value", None) or THREADS_PER_IMAGE.value())
+
+
+# the seconds the step running on the current worker may take, None without a limit
+def step_timeout() -> float | None:
+	return getattr(_step_threads, "timeout", None)
+
+
+# Every running image holds one core. Steps which can use more threads take additional cores, but only from cores
+# nobody else is using and only up to a fair share of what is left to do; once the queue drains, the remaining
+# images get the idle cores. New images wait for a core, so the machine is never oversubscribed.
+class CoreBudget:
+	# smaller images gain nothing from more threads
+	BYTES_PER_THREAD: int = 512 * 1024
+	
+	def __init__(self, cores: int):
+		self.cores = cores
+		self.used: int = 0
+		self.queued: int = 0
+		self.running: int = 0
+		
+		self._condition: Condition = Condition()
+	
+	def queue(self) -> None:
+		with self._condition:
+			self.queued += 1
+	
+	@contextmanager
+	def image(self) -> Iterator[None]:
+		with self._condition:
+			self.queued -= 1
+			self._condition.wait_for(lambda: self.used < self.cores)
+			self.used += 1
+			self.running += 1
+		
+		try:
+			yield
+		finally:
+			with self._condition:
+				self.used -= 1
+				self.running -= 1
+				self._condition.notify_all()
+	
+	@contextmanager
+	def step(self, size: int) -> Iterator[int]:
+		with self._condition:
+			fair_share: int = self.cores // max(self.running + self.queued, 1)
+			wanted: int = min(fair_share, max(size // self.BYTES_PER_THREAD, 1))
+			extra: int = max(min(wanted - 1, self.cores - self.used), 0)
+			self.used += extra
+		
+		try:
+			yield 1 + extra
+		finally:
+			with self._condition:
+				self.used -= extra
+				self._condition.notify_all()
+
+
+# Where replaced originals are moved to. Below the folder they keep their path relative to the root, so images
+# with the same name in different subdirectories do not end up on top of each other.
+@dataclass(frozen=True)
+class DeletedImages:
+	folder: Path
+	root: Path
+	
+	def target(self, file: Path) -> Path:
+		file = file.absolute()
+		
+		# outside of the root, like a single image given by its path
+		relative: Path = file.relative_to(self.root) if file.is_relative_to(self.root) else Path(file.name)
+		target: Path = self.folder / relative
+		number: int = 1
+		
+		# an earlier backup is never overwritten, a later one gets a number
+		while target.exists():
+			target = self.folder / relative.with_name(f"{relative.stem}.{number}{relative.suffix}")
+			number += 1
+		
+		return target
 
 
-def delete_file(file: Path) -> None:
-	if not (DELETED_IMAGE_FOLDER.exists() and DELETED_IMAGE_FOLDER.is_dir()):
-		DELETED_IMAGE_FOLDER.mkdir()
+# without a target, deleted images end up in the working directory
+def delete_file(file: Path, deleted_images: DeletedImages | None = None) -> None:
+	if deleted_images is None:
+		deleted_images = DeletedImages(DELETED_IMAGE_FOLDER.absolute(), Path.cwd())
 	
-	file.rename(DELETED_IMAGE_FOLDER / file.name)
+	with _delete_lock:
+		target: Path = deleted_images.target(file)
+		
+		target.parent.mkdir(parents=True, exist_ok=True)
+		file.rename(target)
 
 
 def replace_file_type(file: Path, target: str) -> Path:
 	return file.with_suffix(f".{target}")
 
 
+@cache
+def tool_version(command: tuple[str, ...]) -> str | None:
+	try:
+		process: CompletedProcess = run(command, **CAPTURE_OUTPUT)
+	except (OSError, SubprocessError):
+		return None
+	
+	# some tools print their version to stderr
+	output: str = (process.stdout or process.stderr).strip()
+	
+	return output.splitlines()[0] if output else None
+
+
+class MeasuredProcess(CompletedProcess):
+	def __init__(
+		self,
+		args: Any,
+		returncode: int,
+		stdout: str,
+		stderr: str,
+		usage: struct_rusage | None = None,
+		timed_out: bool = False
+	):
+		super().__init__(args, returncode, stdout, stderr)
+		
+		self.cpu_time: float = usage.ru_utime + usage.ru_stime if usage is not None else 0.0
+		# ru_maxrss is in KiB on Linux
+		self.max_rss: int = usage.ru_maxrss * 1024 if usage is not None else 0
+		# killed after step_timeout()
+		self.timed_out = timed_out
+
+
+# like `run(..., capture_output=True, text=True)`, but the child is reaped with wait4 to get its resource usage
+# the child is killed once step_timeout() is over
+def run_measured(command: list[Any]) -> MeasuredProcess:
+	timeout: float | None = step_timeout()
+	killed: Event = Event()
+	
+	with TemporaryFile() as stdout, TemporaryFile() as stderr:
+		process: Popen = Popen(command, stdout=stdout, stderr=stderr)
+		
+		def kill() -> None:
+			killed.set()
+			process.kill()
+		
+		timer: Timer | None = Timer(timeout, kill) if timeout is not None else None
+		if timer is not None:
+			timer.start()
+		
+		try:
+			_, status, usage = wait4(process.pid, 0)
+		except BaseException:
+			process.kill()
+			process.wait()
+			raise
+		finally:
+			if timer is not None:
+				timer.cancel()
+		
+		# Popen must not try to reap the child again
+		process.returncode = waitstatus_to_exitcode(status)
+		
+		stdout.seek(0)
+		stderr.seek(0)
+		
+		return MeasuredProcess(
+			command,
+			process.returncode,
+			stdout.read().decode(errors="replace"),
+			stderr.read().decode(errors="replace") + (f"timed out after {timeout:.0f}s" if killed.is_set() else ""),
+			usage,
+			killed.is_set()
+		)
+
+
 class StepFailed(Exception):
 	def __init__(self, step: ImageOptimizer, result: CompletedProcess[Any], image: Path):
 		super().__init__(
-			f"Step {step.__class__.__name__} on '{image}' has failed with {result.returncode}: {result.stderr}"
+			f"Step {step.name} on '{image}' has failed with {result.returncode}: {result.stderr}"
 		)
 
 
@@ -93,6 +296,29 @@ class OptimizationMode(Enum):
 	SAFE = auto()
 	QUALITY = auto()
 	JXL = auto()
+	# like JXL, but tries several encoder configurations per image; JPEGs are transcoded directly
+	JXL_BEST = auto()
+
+
+class Engine(Enum):
+	# a worker thread per running image, blocking on its steps
+	THREADS = auto()
+	# a single event loop, steps are awaited child processes
+	ASYNCIO = auto()
+
+
+@dataclass
+class StepStats:
+	step: str
+	wall_time: float
+	cpu_time: float
+	max_rss: int
+	input_size: int
+	output_size: int
+	# the configurations which were killed after their timeout before this one, see ImageOptimizer.fallback
+	timed_out: list[str] = field(default_factory=list)
+	# nothing finished in time, the step was left out
+	skipped: bool = False
 
 
 @dataclass
@@ -100,6 +326,7 @@ class OptimizationResult:
 	new_image: Path
 	old_image: Path | None
 	process: CompletedProcess[Any]
+	stats: StepStats | None = None
 	
 	def has_error(self) -> bool:
 		return self.process.returncode != 0
@@ -110,101 +337,240 @@ class OptimizedImage:
 	image: Path
 	old_size: int
 	new_size: int
-
+	success: bool = True
+	# the image as it was handed in, before any step renamed or converted it
+	source: Path | None = None
+	duration: float = 0.0
+	steps: list[StepStats] = field(default_factory=list)
+	
 	@property
 	def size_delta(self) -> int:
 		return self.new_size - self.old_size
 
 
 class ImageOptimizer(ABC):
+	# the command used to query the version of the underlying tool, None if there is no tool
+	VERSION_COMMAND: tuple[str, ...] | None = None
+	# whether the step uses step_threads()
+	MULTITHREADED: bool = False
+	# rough cost of this step per megabyte of input, relative to Oxipng; only used until real timings exist
+	RELATIVE_COST: float = 1.0
+	# peak memory of this step per pixel of the image; only used until the peak was measured
+	BYTES_PER_PIXEL: float = 8.0
+	# whether the result may look different from the input, see QualityGuard
+	LOSSY: bool = False
+	
+	@property
+	def name(self) -> str:
+		return self.__class__.__name__
+	
+	# the name and the settings which make it slower or faster
+	@property
+	def configuration(self) -> str:
+		return self.name
+	
 	@abstractmethod
 	def optimize(self, image: Path) -> OptimizationResult:
 		pass
+	
+	# the step which actually handles this image; the engines run and account for that one
+	def select(self, image: Path) -> ImageOptimizer:
+		return self
+	
+	# a cheaper configuration to retry with once this one timed out, None to leave the step out
+	def fallback(self) -> ImageOptimizer | None:
+		return None
+	
+	# the steps a switch picks from with select(), empty for a step which runs itself
+	def wrapped_steps(self) -> list[ImageOptimizer]:
+		return []
+	
+	def version(self) -> str | None:
+		if self.VERSION_COMMAND is None:
+			return None
+		return tool_version(self.VERSION_COMMAND)
 
 
-class Oxipng(ImageOptimizer):
+# a step which runs a single external tool; the engines decide how the command is run
+class CommandOptimizer(ImageOptimizer, ABC):
+	# where the result is written to, the image itself for tools working in place
+	def target(self, image: Path) -> Path:
+		return image
+	
+	@abstractmethod
+	def command(self, image: Path, target: Path) -> list[Any]:
+		pass
+	
+	def result(self, image: Path, target: Path, process: CompletedProcess[Any]) -> OptimizationResult:
+		return OptimizationResult(target, image if target != image else None, process)
+	
 	def optimize(self, image: Path) -> OptimizationResult:
-		process: CompletedProcess = run(
-			[
-				"oxipng",
-				f"--opt={OXIPNG_OPTIMIZATION_LEVEL.value()}",
-				"--preserve",
-				"--filters",
-				"0-9", "--fix",
-				f"--threads={THREADS_PER_IMAGE.value()}",
-				image
-			],
-			**CAPTURE_OUTPUT
-		)
+		target: Path = self.target(image)
 		
-		return OptimizationResult(image, None, process)
-
-
-class JpegOptim(ImageOptimizer):
-	def optimize(self, image: Path) -> OptimizationResult:
-		process: CompletedProcess = run(["jpegoptim", "--preserve", image], **CAPTURE_OUTPUT)
-		return OptimizationResult(image, None, process)
+		return self.result(image, target, run_measured(self.command(image, target)))
 
 
-class CJXL(ImageOptimizer):
-	def optimize(self, image: Path) -> OptimizationResult:
-		target: Path = replace_file_type(image, "jxl")
+class Oxipng(CommandOptimizer):
+	VERSION_COMMAND = ("oxipng", "--version")
+	MULTITHREADED = True
+	BYTES_PER_PIXEL = 16.0
+	# whether Oxipng may change the color type, bit depth and palette
+	REDUCTIONS: bool = True
+	
+	# a fixed level overrides both OXI_OPT_LEVEL and the effort
+	def __init__(self, effort: OxipngEffort | None = None, level: int | None = None):
+		self.effort = effort if level is None else None
+		self.level = level
 		
-		process: CompletedProcess = run(["cjxl", "-d", JXL_DISTANCE.value(), "-e", "7", image, target], **CAPTURE_OUTPUT)
+		# between building the command and its result
+		self._choices: dict[Path, Choice] = { }
+	
+	def _level(self) -> str:
+		if self.level is not None:
+			return str(self.level)
 		
-		return OptimizationResult(target, image, process)
-
-
-class Jpeg2Png(ImageOptimizer):
-	def optimize(self, image: Path) -> OptimizationResult:
-		target: Path = replace_file_type(image, "png")
+		level: str = OXIPNG_OPTIMIZATION_LEVEL.value()
 		
-		process: CompletedProcess = run(
-			["jpeg2png", "--threads", THREADS_PER_IMAGE.value(), image, "--output", target],
-			**CAPTURE_OUTPUT
-		)
+		# "auto" needs an effort, without one it is the default level of Oxipng
+		return "2" if level == "auto" else level
+	
+	@property
+	def configuration(self) -> str:
+		level: str = "auto" if self.effort is not None else self._level()
 		
-		return OptimizationResult(target, image, process)
+		return f"{self.name} -o{level}"
+	
+	def fallback(self) -> ImageOptimizer | None:
+		level: str = self._level()
+		
+		if self.effort is not None or not level.isdigit() or int(level) > 1:
+			return type(self)(level=1)
+		if int(level) == 1:
+			return type(self)(level=0)
+		return None
+	
+	def command(self, image: Path, target: Path) -> list[Any]:
+		level: str = self._level()
+		filters: str = "0-9"
+		
+		if self.effort is not None:
+			choice: Choice = self.effort.choose(image)
+			self._choices[image] = choice
+			level, filters = str(choice.effort.level), choice.effort.filters
+		
+		return [
+			"oxipng",
+			f"--opt={level}",
+			"--preserve",
+			"--filters",
+			filters, "--fix",
+			*([] if self.REDUCTIONS else ["--nx"]),
+			f"--threads={step_threads()}",
+			image
+		]
+	
+	def result(self, image: Path, target: Path, process: CompletedProcess[Any]) -> OptimizationResult:
+		choice: Choice | None = self._choices.pop(image, None)
+		
+		# the asyncio engine does not measure the CPU time of its children
+		if choice is not None and process.returncode == 0 and isinstance(process, MeasuredProcess):
+			self.effort.record(choice, getsize(target), process.cpu_time)
+		
+		return super().result(image, target, process)
 
 
-class DWebp(ImageOptimizer):
-	def optimize(self, image: Path) -> OptimizationResult:
-		target: Path = replace_file_type(image, "png")
+class JpegOptim(CommandOptimizer):
+	VERSION_COMMAND = ("jpegoptim", "--version")
+	RELATIVE_COST = 0.2
+	BYTES_PER_PIXEL = 4.0
+	
+	def command(self, image: Path, target: Path) -> list[Any]:
+		return ["jpegoptim", "--preserve", image]
+
+
+class CJXL(CommandOptimizer):
+	VERSION_COMMAND = ("cjxl", "--version")
+	RELATIVE_COST = 2.0
+	BYTES_PER_PIXEL = 40.0
+	LOSSY = True
+	
+	def target(self, image: Path) -> Path:
+		return replace_file_type(image, "jxl")
+	
+	# with a budget, every image gets the distance it was planned with
+	def __init__(self, effort: int = 7, budget: SizeBudget | None = None):
+		self.effort = effort
+		self.budget = budget
+	
+	@property
+	def configuration(self) -> str:
+		return f"{self.name} -e {self.effort}"
+	
+	def fallback(self) -> ImageOptimizer | None:
+		return { 7: CJXL(3, self.budget), 3: CJXL(1, self.budget) }.get(self.effort)
+	
+	def distance(self, image: Path) -> str:
+		# a lossy animation only gets larger, most of them are GIFs or have been lossy WebPs already
+		# a still GIF has a palette of at most 256 colours, it only gets larger as well
+		if is_animated(image) or image.suffix.lower() == ".gif":
+			return "0"
+		if self.budget is not None:
+			return self.budget.distance(current_image.get())
+		return JXL_DISTANCE.value()
+	
+	def command(self, image: Path, target: Path) -> list[Any]:
+		distance: str = self.distance(image)
 		
-		process: CompletedProcess = run(
-			["dwebp", image, "-o", target],
-			**CAPTURE_OUTPUT
-		)
+		return ["cjxl", "-d", distance, "-e", str(self.effort), image, target]
+
+
+class Jpeg2Png(CommandOptimizer):
+	VERSION_COMMAND = ("jpeg2png", "--version")
+	MULTITHREADED = True
+	RELATIVE_COST = 4.0
+	# works on several floating point copies of the image
+	BYTES_PER_PIXEL = 64.0
+	LOSSY = True
+	
+	def target(self, image: Path) -> Path:
+		return replace_file_type(image, "png")
+	
+	# None for the default of jpeg2png
+	def __init__(self, iterations: int | None = None):
+		self.iterations = iterations
+	
+	@property
+	def configuration(self) -> str:
+		return self.name if self.iterations is None else f"{self.name} -i {self.iterations}"
+	
+	def fallback(self) -> ImageOptimizer | None:
+		return Jpeg2Png(10) if self.iterations is None else None
+	
+	def command(self, image: Path, target: Path) -> list[Any]:
+		iterations: list[Any] = ["--iterations", self.iterations] if self.iterations is not None else []
 		
-		return OptimizationResult(target, image, process)
+		return ["jpeg2png", "--threads", step_threads(), *iterations, image, "--output", target]
 
 
-class ImageFixer(ImageOptimizer):
-	JPEG = b"\xFF\xD8\xFF"
-	PNG = b"\x89\x50\x4E\x47"
-	WEBP_START = b"\x52\x49\x46\x46"
-	WEBP_END = b"\x57\x45\x42\x50"
+class DWebp(CommandOptimizer):
+	VERSION_COMMAND = ("dwebp", "-version")
+	RELATIVE_COST = 0.3
 	
-	# ! this needs to be updated accordingly
-	HEADER_LENGTH: int = len(WEBP_START) * 3
+	def target(self, image: Path) -> Path:
+		return replace_file_type(image, "png")
+	
+	def command(self, image: Path, target: Path) -> list[Any]:
+		return ["dwebp", image, "-o", target]
+
+
+class ImageFixer(ImageOptimizer):
+	RELATIVE_COST = 0.0
+	BYTES_PER_PIXEL = 0.0
 	
 	@classmethod
 	def optimize(cls, image: Path) -> OptimizationResult:
-		with open(image, "rb") as file:
-			header: bytes = file.read(cls.HEADER_LENGTH)
-		
-		if header[0:3] == cls.JPEG:
-			target = image.with_suffix(".jpg")  # while 'jpeg' should be used, everything uses jpg
-		elif header[0:4] == cls.PNG:
-			target = image.with_suffix(".png")
-		elif header[0:4] == cls.WEBP_START and header[8:12] == cls.WEBP_END:
-			target = image.with_suffix(".webp")
-		else:
-			target = image
-		
-		if image != target:
-			LOGGER.verbose_log(f"{CLEAR_LINE}Found bad file extension: '{image}' -> '{target}'")
-			image.rename(target)
+		file_type: str | None = sniff(image)
+		target: Path = fix_extension(image, file_type) if file_type is not None else image
 		
 		# Note: the target *is* the image. The extension was just wrong.
 		# Therefore, there is nothing to delete.
@@ -212,10 +578,16 @@ class ImageFixer(ImageOptimizer):
 
 
 class OptimizerFactory:
-	_preprocessors: dict[str | None, list[ImageOptimizer]] = { }
-	_processors: dict[str | None, list[ImageOptimizer]] = { }
-	_postprocessors: dict[str | None, list[ImageOptimizer]] = { }
-	_aliases: dict[str, str] = { }
+	def __init__(self, mode: OptimizationMode | None = None, quality_guard: QualityGuard | None = None):
+		self.mode = mode
+		# checks the results of lossy steps before they replace anything
+		self.quality_guard = quality_guard
+		
+		# per instance, factories for different modes may exist side by side
+		self._preprocessors: dict[str | None, list[ImageOptimizer]] = { }
+		self._processors: dict[str | None, list[ImageOptimizer]] = { }
+		self._postprocessors: dict[str | None, list[ImageOptimizer]] = { }
+		self._aliases: dict[str, str] = { }
 	
 	def get_registered_file_types(self) -> set[str]:
 		file_types: set[str | None] = set(
@@ -264,6 +636,50 @@ class OptimizerFactory:
 	def register_alias(self, base: str, alias: str) -> None:
 		self._aliases[alias] = base
 	
+	def get_steps(self) -> list[ImageOptimizer]:
+		return [
+			step
+			for source in (self._preprocessors, self._processors, self._postprocessors)
+			for steps in source.values()
+			for step in steps
+		]
+	
+	# the steps which actually run, every switch is replaced by the steps it picks from
+	def get_unwrapped_steps(self) -> list[ImageOptimizer]:
+		steps: list[ImageOptimizer] = []
+		pending: list[ImageOptimizer] = self.get_steps()
+		
+		while pending:
+			step: ImageOptimizer = pending.pop(0)
+			wrapped: list[ImageOptimizer] = step.wrapped_steps()
+			
+			if wrapped:
+				pending = wrapped + pending
+			else:
+				steps.append(step)
+		
+		return steps
+	
+	# tools of registered steps which are not installed
+	def get_missing_tools(self) -> set[str]:
+		return {
+			step.VERSION_COMMAND[0]
+			for step in self.get_unwrapped_steps()
+			if step.VERSION_COMMAND is not None and shutil.which(step.VERSION_COMMAND[0]) is None
+		}
+	
+	def get_tool_versions(self) -> dict[str, str | None]:
+		return { step.name: step.version() for step in self.get_unwrapped_steps() }
+	
+	# everything that changes the output of a run; used to invalidate the manifest
+	def get_profile(self) -> dict[str, Any]:
+		return {
+			"mode": self.mode.name if self.mode is not None else None,
+			"tools": self.get_tool_versions(),
+			# only with a guard, so the manifests of runs without one stay valid
+			**({ "quality_guard": self.quality_guard.settings() } if self.quality_guard is not None else { })
+		}
+	
 	# just for display purposes
 	def get_alias(self, file_type: str) -> str | None:
 		if file_type in self._aliases:
@@ -271,113 +687,756 @@ class OptimizerFactory:
 		return None
 
 
-def optimize_image(image: Path, factory: OptimizerFactory) -> OptimizedImage:
-	to_be_deleted_images: NotNoneList[Path] = NotNoneList()
+# the history lets steps learn from earlier runs
+def create_factory(
+	mode: OptimizationMode,
+	history: History | None = None,
+	size_budget: SizeBudget | None = None,
+	quality_guard: QualityGuard | None = None
+) -> OptimizerFactory:
+	from python_scripts.opti_dir2.animation import AnimationSwitch, ApngOxipng, Gifsicle, PillowAnimationDecoder
+	from python_scripts.opti_dir2.effort import OxipngEffort
+	from python_scripts.opti_dir2.history import History
+	from python_scripts.opti_dir2.inprocess import PillowDWebp, PyOxipng, SizeSwitch
+	from python_scripts.opti_dir2.jxl import CJXLCandidates
+	
+	factory: OptimizerFactory = OptimizerFactory(mode, quality_guard)
+	
+	# a single instance, so its version is only looked up once
+	effort: OxipngEffort | None = None
+	if OXIPNG_OPTIMIZATION_LEVEL.value() == "auto":
+		# without a history, the effort only learns from this run
+		effort = OxipngEffort(history if history is not None else History(None))
+	
+	# an APNG needs the CLI, pyoxipng cannot be told to leave the other frames alone
+	oxipng: ImageOptimizer = AnimationSwitch(SizeSwitch(PyOxipng(effort), Oxipng(effort)), ApngOxipng(effort))
+	
+	factory.register_preprocessor(None, ImageFixer())
+	
+	factory.register_processor("png", oxipng)
+	
+	# GIFs are left alone without it, like before there was a step for them
+	if shutil.which("gifsicle") is not None:
+		factory.register_processor("gif", Gifsicle())
+	
+	if mode == OptimizationMode.SAFE:
+		factory.register_processor("jpeg", JpegOptim())
+	elif mode == OptimizationMode.JXL_BEST:
+		# a JPEG can be transcoded losslessly, decoding it first would throw that away
+		factory.register_processor("jpeg", CJXLCandidates(history))
+	else:
+		factory.register_processor("jpeg", Jpeg2Png())
+		factory.register_processor("jpeg", oxipng)
+	factory.register_alias("jpeg", "jpg")
+	
+	if mode != OptimizationMode.SAFE:
+		factory.register_processor("webp", AnimationSwitch(SizeSwitch(PillowDWebp(), DWebp()), PillowAnimationDecoder()))
+		factory.register_processor("webp", oxipng)
+	
+	if mode == OptimizationMode.JXL:
+		factory.register_postprocessor(None, CJXL(budget=size_budget))
+	elif mode == OptimizationMode.JXL_BEST:
+		# everything else arrives here as PNG, except for GIFs
+		factory.register_postprocessor("png", CJXLCandidates(history))
+		factory.register_postprocessor("gif", CJXL())
+	
+	return factory
+
+
+def step_stats(step: ImageOptimizer, result: OptimizationResult, input_size: int, started: float) -> StepStats:
+	return StepStats(
+		step.name,
+		monotonic() - started,
+		getattr(result.process, "cpu_time", 0.0),
+		getattr(result.process, "max_rss", 0),
+		input_size,
+		getsize(result.new_image) if result.new_image.exists() else 0
+	)
+
+
+# the base timeout of every step grows with the pixels of the image and the cost of the step
+def scaled_timeout(step: ImageOptimizer | QualityGuard, pixels: int, base: float | None) -> float | None:
+	if base is None:
+		return None
 	
-	mtime: float = getmtime(image)
-	original_size: int = getsize(image)
+	return base + float(STEP_TIMEOUT_PER_MEGAPIXEL.value()) * step.RELATIVE_COST * pixels / 1_000_000
+
+
+def timed_out(result: OptimizationResult) -> bool:
+	return getattr(result.process, "timed_out", False)
+
+
+# What follows a step which was killed after its timeout: the fallback of the step is tried next. Without one a
+# step working in place is left out, the image stays as it was. Anything else fails the image, and so does a step
+# which got to change the image in place before it was killed.
+def after_timeout(
+	step: ImageOptimizer,
+	image: Path,
+	result: OptimizationResult,
+	before: stat_result
+) -> tuple[ImageOptimizer | None, OptimizationResult]:
+	LOGGER.warn(f"{CLEAR_LINE}{step.configuration} timed out on '{image}'")
+	
+	in_place: bool = result.new_image == image
+	after: stat_result = image.stat()
+	
+	if in_place and (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+		return None, result
+	
+	fallback: ImageOptimizer | None = step.fallback()
+	
+	if fallback is not None:
+		return fallback, result
+	
+	if in_place:
+		# still marked as timed out, so the stats can tell it was skipped
+		return None, OptimizationResult(
+			image,
+			None,
+			MeasuredProcess(result.process.args, 0, "", result.process.stderr, timed_out=True)
+		)
+	
+	return None, result
+
+
+def finish_step(
+	step: ImageOptimizer,
+	result: OptimizationResult,
+	input_size: int,
+	started: float,
+	timed_out_configurations: list[str]
+) -> OptimizationResult:
+	result.stats = step_stats(step, result, input_size, started)
+	result.stats.timed_out = timed_out_configurations
+	result.stats.skipped = timed_out(result) and not result.has_error()
+	
+	return result
+
+
+# the threads of the budget for a single run of the step, None without a budget or for a single threaded step
+@contextmanager
+def granted_threads(step: ImageOptimizer, image: Path, budget: CoreBudget | None) -> Iterator[int | None]:
+	if budget is None or not step.MULTITHREADED:
+		yield None
+		return
+	
+	with budget.step(getsize(image)) as threads:
+		yield threads
+
+
+# step_threads() answers with the granted threads on the current worker until the block is left
+@contextmanager
+def using_threads(threads: int | None) -> Iterator[None]:
+	_step_threads.value = threads
+	
+	try:
+		yield
+	finally:
+		_step_threads.value = None
+
+
+# a single run of the step, with the threads of the budget and killed after the timeout
+def attempt_step(
+	step: ImageOptimizer,
+	image: Path,
+	budget: CoreBudget | None,
+	timeout: float | None
+) -> OptimizationResult:
+	_step_threads.timeout = timeout
+	
+	try:
+		with granted_threads(step, image, budget) as threads, using_threads(threads):
+			return step.optimize(image)
+	finally:
+		_step_threads.timeout = None
+
+
+# the timeout is the base for scaled_timeout, None runs every step for as long as it takes
+def run_step(
+	step: ImageOptimizer,
+	image: Path,
+	budget: CoreBudget | None = None,
+	timeout: float | None = None
+) -> OptimizationResult:
+	step = step.select(image)
+	input_size: int = getsize(image)
+	pixels: int = pixel_count(image) if timeout is not None else 0
+	started: float = monotonic()
+	timed_out_configurations: list[str] = []
+	
+	while True:
+		before: stat_result = image.stat()
+		result: OptimizationResult = attempt_step(step, image, budget, scaled_timeout(step, pixels, timeout))
+		
+		if not timed_out(result):
+			break
+		
+		timed_out_configurations.append(step.configuration)
+		fallback, result = after_timeout(step, image, result, before)
+		
+		if fallback is None:
+			break
+		step = fallback
+	
+	return finish_step(step, result, input_size, started, timed_out_configurations)
+
+
+# The state of a single image on its way through the steps; the engines only decide how the steps are run.
+# Preprocessors only fix the file itself, so they work in place. Everything else works on a staged copy,
+# the original is only replaced if the result is worth it. The copy is staged in the scratch directory if
+# there is room, then only the result is written next to the image, as a landing file which replaces it.
+class ImageJob:
+	def __init__(self, image: Path, journal: Journal | None = None, deleted_images: DeletedImages | None = None):
+		self.image = image
+		self.source = image
+		self.journal = journal
+		self.deleted_images = deleted_images
+		
+		current_image.set(image)
+		self.started: float = monotonic()
+		self.mtime: float = getmtime(image)
+		self.original_size: int = getsize(image)
+		self.steps: list[StepStats] = []
+		
+		self.staging_directory: Path | None = None
+		self.staged_image: Path | None = None
+		# only when staged on another file system, the replace of the commit must not cross it
+		self.landing_file: Path | None = None
+		self.scratch_reserved: int = 0
+		# whether a lossy step ran, and whether its result was turned down
+		self.lossy: bool = False
+		self.rejected: bool = False
+		# between the journaled commit and its end the directory is in between two states
+		self.committing: bool = False
+	
+	def _check(self, step: ImageOptimizer, result: OptimizationResult) -> None:
+		if result.has_error():
+			raise StepFailed(step, result.process, self.image)
+		
+		if result.stats is not None:
+			self.steps.append(result.stats)
+		
+		self.lossy = self.lossy or step.LOSSY
+	
+	def preprocessed(self, step: ImageOptimizer, result: OptimizationResult) -> None:
+		self._check(step, result)
+		
+		if result.old_image is not None:
+			delete_file(result.old_image, self.deleted_images)
+		self.image = result.new_image
+	
+	def stage(self) -> Path:
+		from python_scripts.opti_dir2.scratch import get_scratch, ScratchSpace
+		
+		scratch: ScratchSpace | None = get_scratch()
+		directory: Path = self.image.parent
+		
+		if scratch is not None:
+			self.scratch_reserved = scratch.reserve(self.image)
+			
+			if self.scratch_reserved > 0:
+				directory = scratch.directory
+		
+		self.staging_directory = Path(mkdtemp(prefix=STAGING_PREFIX, dir=directory))
+		self.staged_image = self.staging_directory / self.image.name
+		
+		if self.staging_directory.stat().st_dev != self.image.parent.stat().st_dev:
+			self.landing_file = self.image.parent / self.staging_directory.name
+		
+		if self.journal is not None:
+			self.journal.begin(self.staging_directory, self.image, self.original_size, self.landing_file)
+		
+		copy2(self.image, self.staged_image)
+		
+		return self.staged_image
+	
+	def processed(self, step: ImageOptimizer, result: OptimizationResult) -> None:
+		self._check(step, result)
+		
+		self.staged_image = result.new_image
+	
+	def _result(self, image: Path, new_size: int, success: bool) -> OptimizedImage:
+		return OptimizedImage(
+			image,
+			self.original_size,
+			new_size,
+			success,
+			self.source,
+			monotonic() - self.started,
+			self.steps
+		)
+	
+	def _worth_it(self, new_size: int) -> bool:
+		return new_size < self.original_size * float(MAX_SIZE_RATIO.value())
+	
+	# the result of lossy steps has to look like the image; this takes a while, so it is not part of the commit
+	# the timeout is the base for scaled_timeout, a check which takes longer keeps the image
+	def verify(self, guard: QualityGuard | None, timeout: float | None = None) -> None:
+		new_size: int = getsize(self.staged_image)
+		
+		if guard is None or not self.lossy or not self._worth_it(new_size):
+			return
+		
+		limit: float | None = scaled_timeout(guard, pixel_count(self.image) if timeout is not None else 0, timeout)
+		started: float = monotonic()
+		cpu_started: float = thread_time()
+		verdict: Verdict = guard.check(self.image, self.staged_image, self.staging_directory, limit)
+		
+		self.steps.append(
+			StepStats(
+				"QualityGuard",
+				monotonic() - started,
+				thread_time() - cpu_started,
+				0,
+				new_size,
+				new_size,
+				["QualityGuard"] if verdict.timed_out else []
+			)
+		)
+		
+		if verdict.timed_out:
+			LOGGER.warn(f"{CLEAR_LINE}Keeping '{self.image}', it could not be verified within {limit:.0f}s")
+			self.rejected = True
+		elif not verdict.accepted:
+			LOGGER.warn(f"{CLEAR_LINE}Keeping '{self.image}', the result does not look the same ({verdict})")
+			self.rejected = True
+	
+	def commit(self) -> OptimizedImage:
+		new_size: int = getsize(self.staged_image)
+		target: Path = self.image.with_name(self.staged_image.name)
+		
+		if not self._worth_it(new_size):
+			LOGGER.verbose_log(f"{CLEAR_LINE}Keeping '{self.image}', the result is not smaller ({new_size} bytes)")
+			return self._result(self.image, self.original_size, True)
+		
+		if self.rejected:
+			return self._result(self.image, self.original_size, True)
+		
+		if target != self.image and target.exists():
+			LOGGER.warn(f"{CLEAR_LINE}Keeping '{self.image}', '{target}' already exists")
+			return self._result(self.image, self.original_size, False)
+		
+		if self.landing_file is not None:
+			copy2(self.staged_image, self.landing_file)
+			self.staged_image = self.landing_file
+		
+		# mtime and atime needs to be set
+		utime(self.staged_image, (self.mtime, self.mtime))
+		
+		if self.journal is not None:
+			self.committing = True
+			self.journal.commit(self.staging_directory, self.image, self.original_size, self.staged_image, target)
+		
+		# the staged result is on the same file system, so this is atomic
+		self.staged_image.replace(target)
+		
+		if target != self.image:
+			delete_file(self.image, self.deleted_images)
+		
+		self.committing = False
+		
+		return self._result(target, new_size, True)
+	
+	def failed(self, exc: Exception) -> OptimizedImage:
+		LOGGER.error(exc)
+		
+		# it may be gone, which is what failed it
+		return self._result(self.image, getsize(self.image) if self.image.exists() else self.original_size, False)
+	
+	def cleanup(self) -> None:
+		if self.staging_directory is None:
+			return
+		
+		shutil.rmtree(self.staging_directory, ignore_errors=True)
+		
+		if self.scratch_reserved > 0:
+			from python_scripts.opti_dir2.scratch import get_scratch
+			
+			get_scratch().release(self.scratch_reserved)
+		
+		# left behind if the commit did not happen; a broken off commit still needs it
+		if self.landing_file is not None and not self.committing:
+			self.landing_file.unlink(missing_ok=True)
+		
+		# a commit which broke off is left to the recovery
+		if self.journal is not None and not self.committing:
+			self.journal.done(self.staging_directory, self.image)
+
+
+# an image which vanished or cannot be read any more since it was found; the run goes on without it
+def unreadable(image: Path, exc: OSError) -> OptimizedImage:
+	LOGGER.error(f"{CLEAR_LINE}Skipping '{image}': {exc}")
+	
+	return OptimizedImage(image, 0, 0, False, image)
+
+
+def optimize_image(
+	image: Path,
+	factory: OptimizerFactory,
+	budget: CoreBudget | None = None,
+	journal: Journal | None = None,
+	timeout: float | None = None,
+	deleted_images: DeletedImages | None = None
+) -> OptimizedImage:
+	try:
+		job: ImageJob = ImageJob(image, journal, deleted_images)
+	except OSError as exc:
+		return unreadable(image, exc)
 	
 	try:
 		# the steps must be separated
 		# a step may change the image, which is not picked up when they're combined
 		# e.g. ImageFixer turning a png into a png
-		for step in factory.get_preprocessors(image):
-			result: OptimizationResult = step.optimize(image)
+		for step in factory.get_preprocessors(job.image):
+			job.preprocessed(step, run_step(step, job.image, budget, timeout))
+		
+		job.stage()
+		
+		for step in factory.get_processors(job.staged_image):
+			job.processed(step, run_step(step, job.staged_image, budget, timeout))
+		
+		for step in factory.get_postprocessors(job.staged_image):
+			job.processed(step, run_step(step, job.staged_image, budget, timeout))
+		
+		job.verify(factory.quality_guard, timeout)
+		
+		return job.commit()
+	except (StepFailed, OSError) as exc:
+		return job.failed(exc)
+	finally:
+		job.cleanup()
+
+
+class ProgressBar(IncrementalBar):
+	suffix = "%(index)d/%(max)d | %(image_rate).1f img/s | %(pretty_byte_rate)s/s | ETA %(pretty_eta)s"
+	
+	# the statistics need some room; the bar gets everything else
+	SUFFIX_WIDTH: int = 52
+	
+	def __init__(self):
+		super().__init__("Progress", max=0, color="cyan")
+		
+		self.total_bytes: int = 0
+		self.done_bytes: int = 0
+		self.started: float = monotonic()
+	
+	# may be called from the producer thread; only the counters are touched
+	def add(self, image: Path) -> None:
+		self.max += 1
+		self.total_bytes += getsize(image)
+	
+	def completed(self, image: OptimizedImage) -> None:
+		self.done_bytes += image.old_size
+		
+		terminal_width: int = shutil.get_terminal_size()[0]
+		self.width = max(terminal_width - len(self.message) - 3 - self.SUFFIX_WIDTH, 10)
+		
+		self.next()
+	
+	def finish(self) -> None:
+		self.color = "green"
+		self.update()
+		super().finish()
+	
+	@property
+	def elapsed_time(self) -> float:
+		return max(monotonic() - self.started, 1e-6)
+	
+	@property
+	def image_rate(self) -> float:
+		return self.index / self.elapsed_time
+	
+	@property
+	def byte_rate(self) -> float:
+		return self.done_bytes / self.elapsed_time
+	
+	@property
+	def pretty_byte_rate(self) -> str:
+		return pretty_print_bytes(int(self.byte_rate))
+	
+	# weighted by bytes: one huge image left is not "almost done"
+	@property
+	def pretty_eta(self) -> str:
+		if self.done_bytes == 0:
+			return "--:--"
+		
+		remaining: int = int(max(self.total_bytes - self.done_bytes, 0) / self.byte_rate)
+		
+		return f"{remaining // 60:02d}:{remaining % 60:02d}"
+
+
+# without file types, every file except hidden ones is returned
+def scan_directory(
+	directory: Path,
+	file_types: tuple[str, ...] | None,
+	recursive: bool = False,
+	include: tuple[str, ...] = (),
+	exclude: tuple[str, ...] = (),
+	root: Path | None = None
+) -> Iterator[Path]:
+	root = root or directory
+	
+	with scandir(directory) as entries:
+		for entry in entries:
+			if entry.is_symlink():
+				continue
 			
-			if result.has_error():
-				raise StepFailed(step, result.process, image)
+			path: Path = Path(entry.path)
+			relative_path: PurePath = path.relative_to(root)
 			
-			to_be_deleted_images.append(result.old_image)
-			image = result.new_image
-		
-		for step in factory.get_processors(image):
-			result: OptimizationResult = step.optimize(image)
+			if any(relative_path.match(pattern) for pattern in exclude):
+				continue
 			
-			if result.has_error():
-				raise StepFailed(step, result.process, image)
+			if entry.is_dir():
+				# never descend into hidden folders or already deleted images
+				if recursive and not entry.name.startswith(".") and entry.name != DELETED_IMAGE_FOLDER.name:
+					yield from scan_directory(path, file_types, recursive, include, exclude, root)
+				continue
 			
-			to_be_deleted_images.append(result.old_image)
-			image = result.new_image
-		
-		for step in factory.get_postprocessors(image):
-			result: OptimizationResult = step.optimize(image)
+			if file_types is None and entry.name.startswith("."):
+				continue
 			
-			if result.has_error():
-				raise StepFailed(step, result.process, image)
+			if file_types is not None and not entry.name.endswith(file_types):
+				continue
 			
-			to_be_deleted_images.append(result.old_image)
-			image = result.new_image
+			if include and not any(relative_path.match(pattern) for pattern in include):
+				continue
+			
+			yield path
+
+
+def iter_optimize_files(
+	images: Iterable[Path],
+	threads: int,
+	factory: OptimizerFactory,
+	manifest: Manifest | None = None,
+	queue_size: int | None = None,
+	on_submit: Callable[[Path], None] | None = None,
+	journal: Journal | None = None,
+	memory_model: MemoryModel | None = None,
+	timeout: float | None = None,
+	deleted_images: DeletedImages | None = None
+) -> Iterator[OptimizedImage]:
+	from python_scripts.opti_dir2.inprocess import size_pool
+	
+	# an explicitly set THREADS_PER_IMAGE wins over the dynamic distribution
+	budget: CoreBudget | None = None if THREADS_PER_IMAGE.is_set() else CoreBudget(threads)
+	admission: AdmissionControl | None = None
+	
+	size_pool(threads)
+	
+	if memory_model is not None:
+		from python_scripts.opti_dir2.admission import AdmissionControl
 		
-		# mtime and atime needs to be set
-		utime(image, (mtime, mtime))
+		admission = AdmissionControl(memory_model)
+	
+	def optimize(image: Path) -> OptimizedImage:
+		if budget is None:
+			return optimize_image(image, factory, journal=journal, timeout=timeout, deleted_images=deleted_images)
 		
-		for to_delete in to_be_deleted_images:
-			delete_file(to_delete)
-	except StepFailed as exc:
-		LOGGER.error(exc)
+		with budget.image():
+			return optimize_image(image, factory, budget, journal, timeout, deleted_images)
 	
-	new_size: int = getsize(image)
+	def work(image: Path) -> OptimizedImage:
+		if admission is None:
+			return optimize(image)
+		
+		try:
+			with admission.image(image) as pixels:
+				result: OptimizedImage = optimize(image)
+		except OSError as exc:
+			return unreadable(image, exc)
+		
+		memory_model.record(result, pixels)
+		
+		return result
 	
-	return OptimizedImage(image, original_size, new_size)
-
-
-def show_progress_bar(tasks: list[Future[Any]]) -> None:
-	all_tasks: int = len(tasks)
+	free_slots: BoundedSemaphore = BoundedSemaphore(queue_size or threads * 2)
+	stop: Event = Event()
+	# receives every finished task, and None once the producer is done
+	finished: Queue[Future[OptimizedImage] | None] = Queue()
+	submitted: int = 0
 	
-	terminal_width: int = shutil.get_terminal_size()[0]
+	def on_done(task: Future[OptimizedImage]) -> None:
+		free_slots.release()
+		
+		if manifest is not None and not task.cancelled() and task.exception() is None:
+			manifest.record(task.result())
+		
+		finished.put(task)
 	
-	progress_bar_offset_base: int = len('Progress |')  # left side
-	progress_bar_offset_numbers: int = 3 + 2 * len(str(all_tasks))  # '| ' and '/' + numbers
+	executor: ThreadPoolExecutor = ThreadPoolExecutor(threads)
 	
-	progress_bar_width: int = terminal_width - progress_bar_offset_base - progress_bar_offset_numbers
+	def produce() -> None:
+		nonlocal submitted
+		
+		try:
+			for image in images:
+				free_slots.acquire()
+				
+				if stop.is_set():
+					break
+				
+				if on_submit is not None:
+					on_submit(image)
+				
+				if budget is not None:
+					budget.queue()
+				
+				submitted += 1
+				executor.submit(work, image).add_done_callback(on_done)
+		finally:
+			finished.put(None)
 	
-	bar: IncrementalBar = IncrementalBar("Progress", max=all_tasks, width=progress_bar_width, color="cyan")
+	producer: Thread = Thread(target=produce, name="opti-dir2-producer", daemon=True)
+	producer.start()
 	
-	while True:
-		done_tasks: int = len(list(filter(lambda task: task.done(), tasks)))
-		
-		bar.goto(done_tasks)
+	try:
+		producing: bool = True
+		yielded: int = 0
 		
-		if done_tasks == all_tasks:
-			bar.color = "green"
-			bar.update()
-			break
+		while producing or yielded < submitted:
+			task: Future[OptimizedImage] | None = finished.get()
+			
+			if task is None:
+				producing = False
+				continue
+			
+			yielded += 1
+			yield task.result()
 		
-		sleep(1)
+		executor.shutdown()
+	finally:
+		# only does something if the consumer stopped early or was interrupted
+		stop.set()
+		executor.shutdown(wait=False, cancel_futures=True)
 
 
 def optimize_files(
-	images: list[Path],
+	images: Iterable[Path],
 	threads: int,
 	factory: OptimizerFactory,
-	do_progress_bar: bool = True
+	do_progress_bar: bool = True,
+	manifest: Manifest | None = None,
+	queue_size: int | None = None,
+	cost_model: CostModel | None = None,
+	report: RunReport | None = None,
+	engine: Engine = Engine.THREADS,
+	step_timeout: float | None = None,
+	journal: Journal | None = None,
+	dedup: DedupMethod | None = None,
+	memory_model: MemoryModel | None = None,
+	size_budget: SizeBudget | None = None,
+	deleted_images: DeletedImages | None = None
 ) -> list[OptimizedImage]:
-	if len(images) == 0:
+	# a streamed input has no length; all that can be done is to keep the queue bounded
+	streaming: bool = not isinstance(images, Sized)
+	# every image which ends up in the output counts for the size budget, even those which are not touched
+	unchanged: list[Path] = []
+	
+	if manifest is not None:
+		found: list[Path] = images if size_budget is not None else []
+		images = manifest.filter(images) if streaming else list(manifest.filter(images))
+		unchanged = sorted(set(found) - set(images))
+		
+		if not streaming and manifest.skipped > 0:
+			LOGGER.info(f"skipping {manifest.skipped} already optimized images")
+	
+	if not streaming and len(images) == 0:
 		return []
 	
-	if not THREADS_PER_IMAGE.is_set() and len(images) < threads:
-		new_threads: int = max(floor(threads / len(images)), 1)
-		if new_threads > 1:
-			THREADS_PER_IMAGE.override(str(new_threads))
-			LOGGER.info(f"override: using {THREADS_PER_IMAGE.value()} threads per image")
+	duplicates: dict[Path, list[Duplicate]] = { }
 	
-	executor: ThreadPoolExecutor = ThreadPoolExecutor(threads)
+	# only a complete list can be searched for duplicates
+	if dedup is not None and not streaming:
+		from python_scripts.opti_dir2.dedup import find_duplicates, replicate
+		
+		images, duplicates = find_duplicates(list(images), threads)
 	
-	try:
-		tasks: list[Future[OptimizedImage]] = []
+	# the plan needs every image, streaming is turned down before
+	if size_budget is not None:
+		size_budget.plan(
+			list(images),
+			threads,
+			factory,
+			{ image: len(copies) + 1 for image, copies in duplicates.items() },
+			unchanged
+		)
+	
+	if cost_model is not None:
+		images = cost_model.schedule_stream(images) if streaming else cost_model.schedule(images)
+	
+	bar: ProgressBar | None = ProgressBar() if do_progress_bar else None
+	on_submit: Callable[[Path], None] | None = None
+	
+	if bar is not None:
+		if streaming:
+			on_submit = bar.add
+		else:
+			for image in images:
+				bar.add(image)
+				
+				for duplicate in duplicates.get(image, []):
+					bar.add(duplicate.path)
+	
+	processed_images: list[OptimizedImage] = []
+	
+	if engine == Engine.ASYNCIO:
+		# imported here, the engine itself builds on this module
+		from python_scripts.opti_dir2.aio import iter_optimize_files_async
 		
-		for image in images:
-			tasks.append(executor.submit(optimize_image, image, factory))
+		results: Iterator[OptimizedImage] = iter_optimize_files_async(
+			images,
+			threads,
+			factory,
+			manifest,
+			on_submit,
+			step_timeout,
+			journal,
+			memory_model,
+			deleted_images
+		)
+	else:
+		results: Iterator[OptimizedImage] = iter_optimize_files(
+			images,
+			threads,
+			factory,
+			manifest,
+			queue_size,
+			on_submit,
+			journal,
+			memory_model,
+			step_timeout,
+			deleted_images
+		)
+	
+	for processed_image in results:
+		if cost_model is not None:
+			cost_model.record(processed_image)
 		
-		executor.shutdown(wait=not do_progress_bar)
+		replicated: list[OptimizedImage] = [
+			replicate(processed_image, duplicate, dedup, deleted_images, journal)
+			for duplicate in duplicates.get(processed_image.source, [])
+		]
 		
-		if do_progress_bar:
-			show_progress_bar(tasks)
-	except KeyboardInterrupt as exc:
-		executor.shutdown(cancel_futures=True)
-		raise exc
+		for image in [processed_image, *replicated]:
+			processed_images.append(image)
+			
+			# the engines only record the images they optimized
+			if manifest is not None and image is not processed_image:
+				manifest.record(image)
+			
+			if report is not None:
+				report.add(image)
+			
+			if bar is not None:
+				bar.completed(image)
+	
+	if bar is not None:
+		bar.finish()
 	
-	processed_images: list[OptimizedImage] = [task.result() for task in tasks]
+	if streaming and manifest is not None and manifest.skipped > 0:
+		LOGGER.info(f"skipped {manifest.skipped} already optimized images")
 	
 	return processed_images
 
@@ -386,14 +1445,51 @@ def optimize_directory(
 	directory: Path,
 	threads: int,
 	factory: OptimizerFactory,
-	do_progress_bar: bool = True
+	do_progress_bar: bool = True,
+	manifest: Manifest | None = None,
+	recursive: bool = False,
+	include: tuple[str, ...] = (),
+	exclude: tuple[str, ...] = (),
+	stream: bool = False,
+	cost_model: CostModel | None = None,
+	report: RunReport | None = None,
+	engine: Engine = Engine.THREADS,
+	step_timeout: float | None = None,
+	journal: Journal | None = None,
+	by_extension: bool = False,
+	dedup: DedupMethod | None = None,
+	memory_model: MemoryModel | None = None,
+	size_budget: SizeBudget | None = None,
+	deleted_images: DeletedImages | None = None
 ) -> list[OptimizedImage]:
-	images: list[Path] = [
-		Path(directory / p) for p in
-		filter(
-			lambda f: f.endswith(tuple(factory.get_registered_file_types())) and not islink(f),
-			listdir(directory)
+	file_types: set[str] = factory.get_registered_file_types()
+	
+	if by_extension:
+		images: Iterable[Path] = scan_directory(directory, tuple(file_types), recursive, include, exclude)
+	else:
+		# mislabelled files are renamed right away, so they are scheduled with the right steps
+		images: Iterable[Path] = detect_images(
+			scan_directory(directory, None, recursive, include, exclude),
+			file_types,
+			threads
 		)
-	]
 	
-	return optimize_files(images, threads, factory, do_progress_bar)
+	if not stream:
+		images = list(images)
+	
+	return optimize_files(
+		images,
+		threads,
+		factory,
+		do_progress_bar,
+		manifest,
+		cost_model=cost_model,
+		report=report,
+		engine=engine,
+		step_timeout=step_timeout,
+		journal=journal,
+		dedup=dedup,
+		memory_model=memory_model,
+		size_budget=size_budget,
+		deleted_images=deleted_images
+	)
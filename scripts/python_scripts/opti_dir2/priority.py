@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import os
+import shutil
+import sys
+from dataclasses import dataclass
+from enum import auto, Enum
+
+from python_scripts.logger import Logger
+
+# the I/O class cannot be set without it
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+LOGGER: Logger = Logger("opti-dir2")
+
+# from linux/ioprio.h
+IOPRIO_CLASS_NONE: int = 0
+IOPRIO_CLASS_RT: int = 1
+IOPRIO_CLASS_BE: int = 2
+IOPRIO_CLASS_IDLE: int = 3
+
+# set once the run was started again inside its own cgroup
+SCOPE_MARKER: str = "OPTI_DIR2_SCOPE"
+
+POLICY_NAMES: dict[int, str] = {
+	os.SCHED_OTHER: "other",
+	os.SCHED_BATCH: "batch",
+	os.SCHED_IDLE: "idle",
+	os.SCHED_FIFO: "fifo",
+	os.SCHED_RR: "rr"
+}
+IO_CLASS_NAMES: dict[int, str] = {
+	IOPRIO_CLASS_NONE: "none",
+	IOPRIO_CLASS_RT: "realtime",
+	IOPRIO_CLASS_BE: "best-effort",
+	IOPRIO_CLASS_IDLE: "idle"
+}
+
+
+class RunPriority(Enum):
+	NORMAL = auto()
+	# someone works at the machine: the run yields to them, but still gets its share
+	INTERACTIVE = auto()
+	# only what nobody else wants, the run may stand still while the machine is busy
+	BACKGROUND = auto()
+
+
+@dataclass(frozen=True)
+class PrioritySettings:
+	nice: int
+	io_class: int
+	# None for classes without levels
+	io_level: int | None
+	policy: int
+
+
+SETTINGS: dict[RunPriority, PrioritySettings] = {
+	RunPriority.INTERACTIVE: PrioritySettings(10, IOPRIO_CLASS_BE, 7, os.SCHED_BATCH),
+	RunPriority.BACKGROUND: PrioritySettings(19, IOPRIO_CLASS_IDLE, None, os.SCHED_IDLE)
+}
+
+
+# Linux applies all of these to the calling thread, and new threads and processes inherit them from the thread
+# which creates them. Applied before the first thread starts, every worker, the process pool and every child
+# tool runs with them.
+def apply_priority(priority: RunPriority) -> None:
+	if priority == RunPriority.NORMAL:
+		return
+	
+	settings: PrioritySettings = SETTINGS[priority]
+	
+	try:
+		# only ever lowered, which needs no privileges
+		os.setpriority(os.PRIO_PROCESS, 0, max(settings.nice, os.getpriority(os.PRIO_PROCESS, 0)))
+		os.sched_setscheduler(0, settings.policy, os.sched_param(0))
+	except OSError as exc:
+		LOGGER.warn(f"could not lower the priority: {exc}")
+	
+	if psutil is None:
+		LOGGER.warn("could not lower the I/O priority: psutil is not installed")
+	else:
+		try:
+			if settings.io_level is None:
+				psutil.Process().ionice(settings.io_class)
+			else:
+				psutil.Process().ionice(settings.io_class, settings.io_level)
+		except (OSError, psutil.Error) as exc:
+			LOGGER.warn(f"could not lower the I/O priority: {exc}")
+	
+	LOGGER.verbose_log(f"running with {describe_priority()}")
+
+
+# what `ps`, `chrt` and `ionice` would show for the process
+def describe_priority(pid: int = 0) -> str:
+	policy: int = os.sched_getscheduler(pid)
+	io: str = "unknown"
+	
+	if psutil is not None:
+		io_class, io_level = psutil.Process(pid or os.getpid()).ionice()
+		io = f"{IO_CLASS_NAMES.get(io_class, str(io_class))} {io_level}"
+	
+	return (
+		f"nice {os.getpriority(os.PRIO_PROCESS, pid)}, scheduler {POLICY_NAMES.get(policy, str(policy))}, I/O {io}"
+	)
+
+
+# Starts the run again in a transient systemd scope, a cgroup which may use `cpu_quota` percent of a core. Does not
+# return unless the run already is in its scope.
+def run_in_scope(cpu_quota: int) -> None:
+	if os.environ.get(SCOPE_MARKER) is not None:
+		return
+	
+	if shutil.which("systemd-run") is None:
+		raise OSError("a CPU quota needs systemd-run")
+	
+	os.environ[SCOPE_MARKER] = str(cpu_quota)
+	os.execvp(
+		"systemd-run",
+		[
+			"systemd-run",
+			"--user",
+			"--scope",
+			"--quiet",
+			f"--property=CPUQuota={cpu_quota}%",
+			"--",
+			*sys.orig_argv
+		]
+	)
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import math
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from subprocess import CompletedProcess, DEVNULL, PIPE, run, TimeoutExpired
+from time import monotonic
+from typing import Any
+
+from PIL import Image
+
+from python_scripts.opti_dir2.opti_dir2 import EnvVar
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# the lowest structural similarity of the luma a lossy result may have, 1 is identical
+MIN_SSIM: EnvVar = EnvVar("MIN_SSIM", "0.95")
+# the lowest PSNR in dB over all channels a lossy result may have
+MIN_PSNR: EnvVar = EnvVar("MIN_PSNR", "32")
+# the highest butteraugli distance a lossy result may have, empty to not run butteraugli_main
+MAX_BUTTERAUGLI: EnvVar = EnvVar("MAX_BUTTERAUGLI", "")
+
+# larger images are compared downsampled, small artifacts of a large image are not visible anyway
+MAX_PIXELS: int = 4_000_000
+# the window of the SSIM, like scikit-image
+WINDOW: int = 7
+C1: float = (0.01 * 255) ** 2
+C2: float = (0.03 * 255) ** 2
+# ITU-R BT.601
+LUMA: tuple[float, float, float] = (0.299, 0.587, 0.114)
+
+
+@dataclass
+class Verdict:
+	ssim: float
+	psnr: float
+	butteraugli: float | None
+	accepted: bool
+	# the comparison did not finish in time, which never accepts the result
+	timed_out: bool = False
+	
+	def __str__(self) -> str:
+		butteraugli: str = f", butteraugli {self.butteraugli:.2f}" if self.butteraugli is not None else ""
+		
+		return f"SSIM {self.ssim:.4f}, PSNR {self.psnr:.1f} dB{butteraugli}"
+
+
+# the seconds left until the deadline, None without one
+def remaining(deadline: float | None) -> float | None:
+	return max(deadline - monotonic(), 0.0) if deadline is not None else None
+
+
+def decode(image: Path, directory: Path, deadline: float | None = None) -> Image.Image:
+	# Pillow does not read JPEG XL
+	if image.suffix.lower() == ".jxl":
+		png: Path = directory / f"{image.stem}.verify.png"
+		process: CompletedProcess = run(
+			["djxl", image, png],
+			stdout=DEVNULL,
+			stderr=DEVNULL,
+			timeout=remaining(deadline)
+		)
+		
+		if process.returncode != 0:
+			raise OSError(f"djxl failed with {process.returncode}")
+		
+		image = png
+	
+	with Image.open(image) as opened:
+		return opened.convert("RGBA")
+
+
+# premultiplied, so a changed color of an invisible pixel does not count
+def to_array(image: Image.Image) -> numpy.ndarray:
+	factor: int = math.ceil(math.sqrt(image.width * image.height / MAX_PIXELS))
+	
+	if factor > 1:
+		image = image.reduce(factor)
+	
+	pixels: numpy.ndarray = numpy.asarray(image, dtype=numpy.float64)
+	pixels[..., :3] *= pixels[..., 3:] / 255
+	
+	return pixels
+
+
+# the mean of every window which fits into the image, from a summed-area table
+def window_mean(values: numpy.ndarray, size: int) -> numpy.ndarray:
+	table: numpy.ndarray = numpy.pad(values.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+	
+	return (table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]) / size ** 2
+
+
+def ssim(original: numpy.ndarray, result: numpy.ndarray) -> float:
+	x: numpy.ndarray = original[..., :3] @ LUMA
+	y: numpy.ndarray = result[..., :3] @ LUMA
+	size: int = min(WINDOW, *x.shape)
+	
+	mean_x: numpy.ndarray = window_mean(x, size)
+	mean_y: numpy.ndarray = window_mean(y, size)
+	variance_x: numpy.ndarray = window_mean(x * x, size) - mean_x ** 2
+	variance_y: numpy.ndarray = window_mean(y * y, size) - mean_y ** 2
+	covariance: numpy.ndarray = window_mean(x * y, size) - mean_x * mean_y
+	
+	similarity: numpy.ndarray = (
+		(2 * mean_x * mean_y + C1) * (2 * covariance + C2)
+		/ ((mean_x ** 2 + mean_y ** 2 + C1) * (variance_x + variance_y + C2))
+	)
+	
+	return float(similarity.mean())
+
+
+def psnr(original: numpy.ndarray, result: numpy.ndarray) -> float:
+	error: float = float(numpy.mean((original - result) ** 2))
+	
+	return math.inf if error == 0 else 10 * math.log10(255 ** 2 / error)
+
+
+def butteraugli(original: Image.Image, result: Image.Image, directory: Path, deadline: float | None = None) -> float:
+	files: list[Path] = [directory / "original.verify.png", directory / "result.verify.png"]
+	original.save(files[0])
+	result.save(files[1])
+	
+	process: CompletedProcess = run(
+		["butteraugli_main", *files],
+		stdout=PIPE,
+		stderr=DEVNULL,
+		text=True,
+		timeout=remaining(deadline)
+	)
+	
+	if process.returncode != 0:
+		raise OSError(f"butteraugli_main failed with {process.returncode}")
+	
+	# the first line is the max norm
+	return float(process.stdout.split()[0])
+
+
+# Compares the result of the lossy steps with the image it replaces. The result is only kept if it is close
+# enough by every metric; one that cannot be decoded is never kept.
+class QualityGuard:
+	# the timeout of a check grows like the one of a step, see scaled_timeout
+	RELATIVE_COST: float = 1.0
+	
+	def __init__(self):
+		if numpy is None:
+			raise ImportError("the quality guard needs NumPy")
+		
+		self.min_ssim = float(MIN_SSIM.value())
+		self.min_psnr = float(MIN_PSNR.value())
+		self.max_butteraugli = float(MAX_BUTTERAUGLI.value()) if MAX_BUTTERAUGLI.value() != "" else None
+		
+		if self.max_butteraugli is not None and shutil.which("butteraugli_main") is None:
+			raise ImportError("MAX_BUTTERAUGLI needs butteraugli_main")
+	
+	# part of the profile, a stricter guard may keep other results
+	def settings(self) -> dict[str, Any]:
+		return { "min_ssim": self.min_ssim, "min_psnr": self.min_psnr, "max_butteraugli": self.max_butteraugli }
+	
+	# The directory takes the decoded files. The tools are killed once the timeout is over; the comparison itself
+	# works on a downsampled image, it does not take long.
+	def check(self, original: Path, result: Path, directory: Path, timeout: float | None = None) -> Verdict:
+		deadline: float | None = monotonic() + timeout if timeout is not None else None
+		score: float | None = None
+		
+		try:
+			original_image: Image.Image = decode(original, directory, deadline)
+			result_image: Image.Image = decode(result, directory, deadline)
+			
+			if original_image.size != result_image.size:
+				return Verdict(0.0, 0.0, None, False)
+			
+			if self.max_butteraugli is not None:
+				score = butteraugli(original_image, result_image, directory, deadline)
+		except TimeoutExpired:
+			return Verdict(0.0, 0.0, None, False, True)
+		except (OSError, ValueError, Image.DecompressionBombError):
+			return Verdict(0.0, 0.0, None, False)
+		
+		original_pixels: numpy.ndarray = to_array(original_image)
+		result_pixels: numpy.ndarray = to_array(result_image)
+		
+		similarity: float = ssim(original_pixels, result_pixels)
+		noise: float = psnr(original_pixels, result_pixels)
+		
+		return Verdict(
+			similarity,
+			noise,
+			score,
+			similarity >= self.min_ssim and noise >= self.min_psnr and (score is None or score <= self.max_butteraugli)
+		)
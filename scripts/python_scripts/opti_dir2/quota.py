@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import heapq
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from shutil import copy2
+from subprocess import CompletedProcess, DEVNULL, run
+from tempfile import TemporaryDirectory
+
+from PIL import Image
+
+from python_scripts import pretty_print_bytes
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.animation import decode_animation
+from python_scripts.opti_dir2.detect import is_animated, pixel_count
+from python_scripts.opti_dir2.opti_dir2 import (EnvVar, JXL_DISTANCE, OptimizationResult, OptimizerFactory, run_step,
+	StepFailed)
+
+LOGGER: Logger = Logger("opti-dir2")
+
+# the effort of the probes; the same as CJXL makes the planned sizes exact, a lower one is faster but only close
+JXL_PROBE_EFFORT: EnvVar = EnvVar("JXL_PROBE_EFFORT", "7")
+
+# from the best quality to the smallest file
+DISTANCES: list[float] = [0.5, 1.0, 1.5, 2.0, 3.0, 4.0, 6.0]
+# what cjxl reads itself, everything else is probed as a PNG
+CJXL_INPUTS: set[str] = { ".png", ".jpg", ".jpeg", ".gif" }
+
+UNITS: dict[str, int] = { "": 1, "k": 2 ** 10, "m": 2 ** 20, "g": 2 ** 30, "t": 2 ** 40 }
+
+
+# like 500M or 1.5G, in powers of 1024
+def parse_size(text: str) -> int:
+	match: re.Match | None = re.fullmatch(r"\s*([0-9.]+)\s*([kmgt]?)i?b?\s*", text.lower())
+	
+	if match is None:
+		raise ValueError(f"'{text}' is not a size")
+	
+	return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+@dataclass
+class Probe:
+	image: Path
+	pixels: int
+	original_size: int
+	# the size of the JXL per distance, empty if cjxl failed or the image stays as it is
+	sizes: dict[float, int]
+	# the image and its duplicates, which end up as files of the same size
+	copies: int = 1
+	
+	# the original is kept if the JXL is not smaller
+	def size(self, index: int) -> int:
+		return min(self.sizes[DISTANCES[index]], self.original_size) * self.copies
+
+
+# what the pipeline hands to cjxl: the image after the processors of the factory, so a JPEG is decoded by jpeg2png
+def encoder_input(image: Path, factory: OptimizerFactory, directory: Path) -> Path:
+	source: Path = directory / image.name
+	copy2(image, source)
+	
+	for step in factory.get_processors(source):
+		result: OptimizationResult = run_step(step, source)
+		
+		if result.has_error():
+			raise StepFailed(step, result.process, image)
+		
+		source = result.new_image
+	
+	return source
+
+
+def probe(image: Path, factory: OptimizerFactory, copies: int = 1) -> Probe:
+	sizes: dict[float, int] = { }
+	
+	with TemporaryDirectory(prefix=".opti-dir2-probe-") as directory:
+		try:
+			source: Path = encoder_input(image, factory, Path(directory))
+			# CJXL stores animations and GIFs losslessly, whatever the plan says
+			lossless: bool = is_animated(source) or source.suffix.lower() == ".gif"
+			
+			if source.suffix.lower() not in CJXL_INPUTS:
+				converted: Path = Path(directory) / "probe.png"
+				
+				if is_animated(source):
+					decode_animation(str(source), str(converted))
+				else:
+					with Image.open(source) as opened:
+						opened.save(converted)
+				
+				source = converted
+			
+			for distance in [0.0] if lossless else DISTANCES:
+				output: Path = Path(directory) / f"{distance}.jxl"
+				
+				process: CompletedProcess = run(
+					["cjxl", "-d", str(distance), "-e", JXL_PROBE_EFFORT.value(), "--num_threads=1", source, output],
+					stdout=DEVNULL,
+					stderr=DEVNULL
+				)
+				
+				if process.returncode != 0:
+					raise OSError(f"cjxl failed with {process.returncode}")
+				
+				sizes[distance] = output.stat().st_size
+			
+			if lossless:
+				sizes = dict.fromkeys(DISTANCES, sizes[0.0])
+		except (OSError, ValueError, StepFailed) as exc:
+			LOGGER.warn(f"could not probe '{image}', it gets the fixed distance: {exc}")
+			sizes = { }
+	
+	return Probe(image, pixel_count(image), image.stat().st_size, sizes, copies)
+
+
+# Spreads a total size over the images of a run by picking the JXL distance of every image. All images start at
+# the largest distance, then the step to the next smaller distance which buys the most quality per byte is taken,
+# as long as it fits. The quality of a step is the distance it saves times the pixels it saves it on. The images
+# are probed at every distance first, the plan is made before the first image is optimized.
+class SizeBudget:
+	def __init__(self, target_size: int | None = None, target_bpp: float | None = None):
+		self.target_size = target_size
+		self.target_bpp = target_bpp
+		
+		# the original path of every planned image
+		self.distances: dict[Path, float] = { }
+	
+	def target(self, probes: list[Probe]) -> int:
+		if self.target_size is not None:
+			return self.target_size
+		
+		return int(self.target_bpp * sum(p.pixels * p.copies for p in probes) / 8)
+	
+	@staticmethod
+	def allocate(probes: list[Probe], target: int) -> tuple[dict[Path, float], int]:
+		planned: list[Probe] = [p for p in probes if p.sizes]
+		# images which are not optimized or could not be probed are expected to stay as they are
+		fixed: int = sum(p.original_size * p.copies for p in probes if not p.sizes)
+		
+		chosen: dict[Path, int] = { p.image: len(DISTANCES) - 1 for p in planned }
+		total: int = fixed + sum(p.size(chosen[p.image]) for p in planned)
+		
+		if total > target:
+			LOGGER.warn(f"even the smallest files take {pretty_print_bytes(total)}, more than the target")
+		
+		# quality per byte of the next step of every image, the best first
+		steps: list[tuple[float, int, Probe]] = []
+		
+		def push(number: int, p: Probe) -> None:
+			index: int = chosen[p.image]
+			if index == 0:
+				return
+			
+			quality: float = (DISTANCES[index] - DISTANCES[index - 1]) * p.pixels * p.copies
+			cost: int = p.size(index - 1) - p.size(index)
+			
+			heapq.heappush(steps, (-quality / cost if cost > 0 else -float("inf"), number, p))
+		
+		for number, p in enumerate(planned):
+			push(number, p)
+		
+		while steps:
+			_, number, p = heapq.heappop(steps)
+			index: int = chosen[p.image]
+			cost: int = p.size(index - 1) - p.size(index)
+			
+			# a step which does not fit is gone for good, a later and smaller one of another image may still fit
+			if total + cost > target:
+				continue
+			
+			chosen[p.image] = index - 1
+			total += cost
+			push(number, p)
+		
+		return { image: DISTANCES[index] for image, index in chosen.items() }, total
+	
+	# `copies` is the number of files every image ends up as, with its duplicates; the `unchanged` images, like
+	# those optimized by an earlier run, are not touched but still take up their part of the total
+	def plan(
+		self,
+		images: list[Path],
+		threads: int,
+		factory: OptimizerFactory,
+		copies: dict[Path, int] | None = None,
+		unchanged: list[Path] | None = None
+	) -> None:
+		copies = copies or { }
+		
+		LOGGER.info(f"probing {len(images)} images at {len(DISTANCES)} distances")
+		
+		with ThreadPoolExecutor(threads) as executor:
+			probes: list[Probe] = list(executor.map(lambda image: probe(image, factory, copies.get(image, 1)), images))
+		
+		for image in unchanged or []:
+			try:
+				probes.append(Probe(image, pixel_count(image), image.stat().st_size, { }))
+			except OSError:
+				# gone, it takes up nothing
+				pass
+		
+		target: int = self.target(probes)
+		self.distances, total = self.allocate(probes, target)
+		
+		LOGGER.info(f"planned {pretty_print_bytes(total)} of {pretty_print_bytes(target)}")
+		
+		for distance in DISTANCES:
+			count: int = sum(1 for d in self.distances.values() if d == distance)
+			
+			if count > 0:
+				LOGGER.verbose_log(f"\tdistance {distance}: {count} images")
+	
+	# for cjxl; images which were not planned get JXL_DISTANCE
+	def distance(self, image: Path | None) -> str:
+		return str(self.distances.get(image, JXL_DISTANCE.value()))
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import json
+from dataclasses import asdict
+from pathlib import Path
+from statistics import quantiles
+from threading import Lock
+from time import monotonic
+from typing import Any, TextIO
+
+from python_scripts.opti_dir2.opti_dir2 import EnvVar, OptimizedImage, OptimizerFactory
+
+SLOWEST_FILES: int = 20
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+	if len(values) == 0:
+		return { }
+	if len(values) == 1:
+		return { "p50": values[0], "p90": values[0], "p99": values[0], "max": values[0] }
+	
+	cuts: list[float] = quantiles(values, n=100, method="inclusive")
+	
+	return { "p50": cuts[49], "p90": cuts[89], "p99": cuts[98], "max": max(values) }
+
+
+def image_record(image: OptimizedImage) -> dict[str, Any]:
+	return {
+		"image": str(image.image),
+		"source": str(image.source) if image.source is not None else None,
+		"success": image.success,
+		"old_size": image.old_size,
+		"new_size": image.new_size,
+		"wall_time": image.duration,
+		"cpu_time": sum(step.cpu_time for step in image.steps),
+		"steps": [asdict(step) for step in image.steps]
+	}
+
+
+# A `.jsonl` report gets one line per file as soon as it is done, followed by a summary line.
+# Anything else gets a single JSON document, written once the run is over.
+class RunReport:
+	def __init__(self, file: Path, factory: OptimizerFactory, threads: int):
+		self.file = file
+		self.factory = factory
+		self.threads = threads
+		
+		self.images: list[OptimizedImage] = []
+		self.started: float = monotonic()
+		self._closed: bool = False
+		self._lock: Lock = Lock()
+		self._stream: TextIO | None = open(file, "w") if file.suffix == ".jsonl" else None
+	
+	def add(self, image: OptimizedImage) -> None:
+		with self._lock:
+			self.images.append(image)
+			
+			if self._stream is not None:
+				self._stream.write(json.dumps({ "type": "file", **image_record(image) }) + "\n")
+				self._stream.flush()
+	
+	def summary(self) -> dict[str, Any]:
+		steps: dict[str, list] = { }
+		for image in self.images:
+			for step in image.steps:
+				steps.setdefault(step.step, []).append(step)
+		
+		step_summaries: dict[str, dict[str, Any]] = {
+			name: {
+				"count": len(stats),
+				"wall_time": sum(s.wall_time for s in stats),
+				"cpu_time": sum(s.cpu_time for s in stats),
+				"wall_time_percentiles": percentiles([s.wall_time for s in stats]),
+				"max_rss": max(s.max_rss for s in stats),
+				"input_size": sum(s.input_size for s in stats),
+				"output_size": sum(s.output_size for s in stats),
+				"timed_out": sum(len(s.timed_out) for s in stats),
+				"skipped": sum(1 for s in stats if s.skipped)
+			}
+			for name, stats in steps.items()
+		}
+		
+		slowest: list[OptimizedImage] = sorted(self.images, key=lambda i: i.duration, reverse=True)[:SLOWEST_FILES]
+		
+		return {
+			"profile": self.factory.get_profile(),
+			"environment": { var.name: var.value() for var in EnvVar.registered_envvars },
+			"threads": self.threads,
+			"elapsed": monotonic() - self.started,
+			"images": len(self.images),
+			"failed": sum(1 for i in self.images if not i.success),
+			"old_size": sum(i.old_size for i in self.images),
+			"new_size": sum(i.new_size for i in self.images),
+			"wall_time": sum(i.duration for i in self.images),
+			"cpu_time": sum(s["cpu_time"] for s in step_summaries.values()),
+			"wall_time_percentiles": percentiles([i.duration for i in self.images]),
+			"steps": step_summaries,
+			"slowest": [{ "image": str(i.image), "wall_time": i.duration } for i in slowest],
+			# every step which ran out of time, and what it ended up as
+			"fallbacks": [
+				{
+					"image": str(i.image),
+					"timed_out": s.timed_out,
+					"result": "skipped" if s.skipped else s.step if i.success else "failed"
+				}
+				for i in self.images
+				for s in i.steps
+				if s.timed_out
+			]
+		}
+	
+	def close(self) -> None:
+		with self._lock:
+			if self._closed:
+				return
+			self._closed = True
+			
+			if self._stream is not None:
+				self._stream.write(json.dumps({ "type": "summary", **self.summary() }) + "\n")
+				self._stream.close()
+				return
+			
+			with open(self.file, "w") as f:
+				json.dump({ "files": [image_record(i) for i in self.images], "summary": self.summary() }, f, indent="\t")
+	
+	def __enter__(self) -> RunReport:
+		return self
+	
+	def __exit__(self, *_) -> None:
+		self.close()
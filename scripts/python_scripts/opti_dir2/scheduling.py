@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import heapq
+from itertools import count
+from os.path import getsize
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from python_scripts.opti_dir2.history import History
+from python_scripts.opti_dir2.opti_dir2 import ImageOptimizer, OptimizedImage, OptimizerFactory
+
+# older runs fade out, so the model follows new tool versions and settings
+DECAY: float = 0.98
+MIN_SAMPLES: int = 5
+
+# used until there are enough timings: spawning a step and working on a megabyte with a relative cost of 1
+PRIOR_SECONDS_PER_STEP: float = 0.05
+PRIOR_SECONDS_PER_MEGABYTE: float = 0.5
+
+MEGABYTE: int = 1024 * 1024
+# how many upcoming images of a stream are considered when picking the next one
+STREAM_WINDOW: int = 256
+
+
+# Estimates the seconds an image takes as `a + b * size`, per processing chain.
+# The linear fit is calibrated with the timings of earlier runs; there is a noticeable fixed cost for spawning
+# processes, which a plain "seconds per byte" would hide.
+class CostModel:
+	def __init__(self, factory: OptimizerFactory, history: History):
+		self.factory = factory
+		self.history = history
+		
+		self._timings = history.section("timings")
+	
+	def chain(self, image: Path) -> list[ImageOptimizer]:
+		return (
+			self.factory.get_preprocessors(image)
+			+ self.factory.get_processors(image)
+			+ self.factory.get_postprocessors(image)
+		)
+	
+	def chain_key(self, image: Path) -> str:
+		return f"{image.suffix[1:].lower()}:{"+".join(step.name for step in self.chain(image))}"
+	
+	def estimate(self, image: Path, size: int | None = None) -> float:
+		size = getsize(image) if size is None else size
+		
+		fit: tuple[float, float] | None = self._fit(self.chain_key(image))
+		
+		if fit is None:
+			chain: list[ImageOptimizer] = self.chain(image)
+			relative_cost: float = sum(step.RELATIVE_COST for step in chain)
+			
+			return PRIOR_SECONDS_PER_STEP * len(chain) + relative_cost * PRIOR_SECONDS_PER_MEGABYTE * size / MEGABYTE
+		
+		intercept, slope = fit
+		
+		return max(intercept + slope * size / MEGABYTE, 0.0)
+	
+	def _fit(self, key: str) -> tuple[float, float] | None:
+		with self.history.lock:
+			sums: dict[str, float] | None = self._timings.get(key)
+			
+			if sums is None or sums["n"] < MIN_SAMPLES:
+				return None
+			
+			w, x, y, xx, xy = sums["w"], sums["x"], sums["y"], sums["xx"], sums["xy"]
+		
+		variance: float = w * xx - x * x
+		
+		# every image had the same size, so there is no slope to be found
+		if variance <= 1e-12:
+			return y / w, 0.0
+		
+		slope: float = max((w * xy - x * y) / variance, 0.0)
+		intercept: float = max((y - slope * x) / w, 0.0)
+		
+		return intercept, slope
+	
+	def record(self, image: OptimizedImage) -> None:
+		if not image.success or image.source is None:
+			return
+		
+		key: str = self.chain_key(image.source)
+		size: float = image.old_size / MEGABYTE
+		
+		with self.history.lock:
+			sums: dict[str, float] = self._timings.setdefault(key, { "n": 0, "w": 0, "x": 0, "y": 0, "xx": 0, "xy": 0 })
+			
+			for name in ("w", "x", "y", "xx", "xy"):
+				sums[name] *= DECAY
+			
+			sums["n"] += 1
+			sums["w"] += 1
+			sums["x"] += size
+			sums["y"] += image.duration
+			sums["xx"] += size * size
+			sums["xy"] += size * image.duration
+	
+	# longest processing time first: the expensive images must not be the last ones to start
+	def schedule(self, images: list[Path]) -> list[Path]:
+		return sorted(images, key=self.estimate, reverse=True)
+	
+	# the same for streams, but only within a window of upcoming images
+	def schedule_stream(self, images: Iterable[Path], window: int = STREAM_WINDOW) -> Iterator[Path]:
+		pending: list[tuple[float, int, Path]] = []
+		order: Iterator[int] = count()
+		
+		for image in images:
+			heapq.heappush(pending, (-self.estimate(image), next(order), image))
+			
+			if len(pending) > window:
+				yield heapq.heappop(pending)[2]
+		
+		while pending:
+			yield heapq.heappop(pending)[2]
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import shutil
+from pathlib import Path
+from threading import Lock
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.detect import pixel_count
+from python_scripts.opti_dir2.opti_dir2 import CLEAR_LINE, EnvVar
+
+LOGGER: Logger = Logger("opti-dir2")
+
+# where the steps of an image work, ideally RAM backed; empty to work next to the images
+SCRATCH_DIRECTORY: EnvVar = EnvVar("SCRATCH_DIRECTORY", "/dev/shm")
+# MiB all images together may use in the scratch directory at once
+SCRATCH_SIZE: EnvVar = EnvVar("SCRATCH_SIZE", "1024")
+
+# a decoded intermediate, like the PNG of Jpeg2Png, takes at most about this much per pixel
+BYTES_PER_PIXEL: int = 4
+# the intermediate and the result of the next step exist at the same time
+INTERMEDIATES: int = 2
+
+_scratch: ScratchSpace | None = None
+_scratch_lock: Lock = Lock()
+
+
+# Hands out room in the scratch directory. An image only works there if everything its steps may write fits,
+# otherwise it works next to itself like before.
+class ScratchSpace:
+	def __init__(self, directory: Path, size: int):
+		self.directory = directory
+		self.size = size
+		self.used: int = 0
+		
+		self._lock: Lock = Lock()
+	
+	@staticmethod
+	def demand(image: Path) -> int:
+		return image.stat().st_size + pixel_count(image) * BYTES_PER_PIXEL * INTERMEDIATES
+	
+	# the reserved bytes, 0 if the image does not fit
+	def reserve(self, image: Path) -> int:
+		demand: int = self.demand(image)
+		
+		with self._lock:
+			if self.used + demand > self.size or demand > shutil.disk_usage(self.directory).free:
+				LOGGER.verbose_log(f"{CLEAR_LINE}'{image}' does not fit into '{self.directory}', working on disk")
+				return 0
+			
+			self.used += demand
+		
+		return demand
+	
+	def release(self, reserved: int) -> None:
+		with self._lock:
+			self.used -= reserved
+
+
+def get_scratch() -> ScratchSpace | None:
+	global _scratch
+	
+	with _scratch_lock:
+		directory: str = SCRATCH_DIRECTORY.value()
+		
+		if _scratch is None and directory != "" and Path(directory).is_dir():
+			_scratch = ScratchSpace(Path(directory), int(SCRATCH_SIZE.value()) * 1024 * 1024)
+		
+		return _scratch
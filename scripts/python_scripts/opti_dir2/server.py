@@ -0,0 +1,619 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from queue import Empty, Queue
+from signal import SIGINT, SIGTERM, signal
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from threading import Condition, Event, Thread
+from time import monotonic, sleep
+from typing import Any, BinaryIO, TYPE_CHECKING
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.admission import AdmissionControl, is_available as admission_available, MemoryModel
+from python_scripts.opti_dir2.detect import detect_images
+from python_scripts.opti_dir2.history import History
+from python_scripts.opti_dir2.journal import Journal, JOURNAL_NAME
+from python_scripts.opti_dir2.manifest import Manifest, MANIFEST_NAME
+from python_scripts.opti_dir2.opti_dir2 import (CLEAR_LINE, CoreBudget, create_factory, DELETED_IMAGE_FOLDER,
+	DeletedImages, EnvVar, OptimizationMode, OptimizedImage, optimize_image, OptimizerFactory, ProgressBar,
+	scan_directory, StepStats)
+from python_scripts.opti_dir2.scheduling import CostModel
+
+if TYPE_CHECKING:
+	from python_scripts.opti_dir2.report import RunReport
+
+LOGGER: Logger = Logger("opti-dir2")
+
+SOCKET_PATH: Path = (
+	Path(os.environ["XDG_RUNTIME_DIR"]) / "opti-dir2.sock"
+	if "XDG_RUNTIME_DIR" in os.environ
+	else Path(tempfile.gettempdir()) / f"opti-dir2-{os.getuid()}.sock"
+)
+# seconds the server keeps running without any client
+SERVER_IDLE_TIMEOUT: EnvVar = EnvVar("SERVER_IDLE_TIMEOUT", "60")
+# how long a client waits for a server it started
+STARTUP_TIMEOUT: float = 10.0
+POLL_INTERVAL: float = 0.5
+
+
+class ServerError(Exception):
+	pass
+
+
+# everything a client tells the server about a directory; the options mean the same as on the command line
+@dataclass
+class Request:
+	directory: str
+	mode: str
+	recursive: bool = False
+	include: list[str] = field(default_factory=list)
+	exclude: list[str] = field(default_factory=list)
+	force: bool = False
+	manifest: str | None = None
+	by_extension: bool = False
+	resume: bool = False
+	unordered: bool = False
+	step_timeout: float | None = None
+	verify: bool = False
+	# the deleted images folder of the client, in its working directory; the server's one without it
+	deleted_images: str | None = None
+	# see run_settings
+	settings: dict[str, Any] = field(default_factory=dict)
+
+
+# What a run takes from its environment and command line besides the request. The server cannot change them per
+# request, so a request has to agree with the server on all of them.
+def run_settings(
+	threads: int,
+	priority: str = "normal",
+	cpu_quota: int | None = None,
+	admission: bool = True
+) -> dict[str, Any]:
+	return {
+		"threads": threads,
+		# whether images wait for memory and idle cores, see AdmissionControl
+		"admission": admission,
+		# the whole server runs with them, see apply_priority and run_in_scope
+		"priority": priority,
+		"cpu quota": cpu_quota,
+		**{ var.name: var.value() for var in EnvVar.registered_envvars if var is not SERVER_IDLE_TIMEOUT }
+	}
+
+
+# what the request wants differently; settings only one side knows of are not compared
+def differing_settings(server: dict[str, Any], request: dict[str, Any]) -> list[str]:
+	return [
+		f"{name} is '{request[name]}' instead of '{value}'"
+		for name, value in server.items()
+		if name in request and request[name] != value
+	]
+
+
+def encode_image(image: OptimizedImage) -> dict[str, Any]:
+	return {
+		**asdict(image),
+		"image": str(image.image),
+		"source": str(image.source) if image.source is not None else None
+	}
+
+
+def decode_image(data: dict[str, Any]) -> OptimizedImage:
+	return OptimizedImage(
+		**{
+			**data,
+			"image": Path(data["image"]),
+			"source": Path(data["source"]) if data["source"] is not None else None,
+			"steps": [StepStats(**step) for step in data["steps"]]
+		}
+	)
+
+
+def send(stream: BinaryIO, message: dict[str, Any]) -> None:
+	stream.write((json.dumps(message) + "\n").encode())
+	stream.flush()
+
+
+# a client only sends its request, anything readable after that is the end of the connection
+def client_gone(connection: socket.socket) -> bool:
+	readable, _, _ = select.select([connection], [], [], 0)
+	
+	return len(readable) > 0 and connection.recv(1, socket.MSG_PEEK) == b""
+
+
+# the images of one client, from its manifest and journal until the last result was sent
+class Submission:
+	def __init__(
+		self,
+		images: list[Path],
+		factory: OptimizerFactory,
+		manifest: Manifest,
+		journal: Journal,
+		memory_model: MemoryModel,
+		cost_model: CostModel | None,
+		timeout: float | None = None,
+		deleted_images: DeletedImages | None = None
+	):
+		self.pending: deque[Path] = deque(images)
+		self.factory = factory
+		self.manifest = manifest
+		self.journal = journal
+		self.memory_model = memory_model
+		self.cost_model = cost_model
+		self.timeout = timeout
+		self.deleted_images = deleted_images
+		
+		self.running: int = 0
+		# the client went away or the server stops; images which did not start yet are dropped
+		self.cancelled: bool = False
+		# when an image of this submission was started last; the longest waiting one goes first
+		self.served: float = 0.0
+		# None once the server stops
+		self.results: Queue[OptimizedImage | None] = Queue()
+
+
+# One pool of workers for every client. Whenever a worker is free, the next image comes from the submission
+# with the fewest running images, so a large directory does not hold up a small one submitted later. Cores,
+# memory and the history are shared the same way a single run shares them between its images.
+class JobServer(ThreadingUnixStreamServer):
+	daemon_threads = True
+	
+	def __init__(
+		self,
+		path: Path,
+		threads: int,
+		priority: str = "normal",
+		cpu_quota: int | None = None,
+		admission: bool = True
+	):
+		super().__init__(str(path), JobHandler)
+		
+		self.path = path
+		self.threads = threads
+		self.priority = priority
+		self.cpu_quota = cpu_quota
+		self.history: History = History()
+		self.budget: CoreBudget = CoreBudget(threads)
+		self.admission: AdmissionControl | None = None
+		
+		if admission:
+			if admission_available():
+				self.admission = AdmissionControl()
+			else:
+				LOGGER.warn("psutil is not installed, images are started without waiting for memory and idle cores")
+		
+		self.clients: int = 0
+		self.last_client: float = monotonic()
+		
+		self._factories: dict[tuple[OptimizationMode, bool], OptimizerFactory] = { }
+		self._submissions: list[Submission] = []
+		# manifests of the submissions which are running, a directory may only be worked on once
+		self._manifests: set[Path] = set()
+		self._running: int = 0
+		self._stopping: bool = False
+		self._condition: Condition = Condition()
+		# never queues, the dispatcher only starts as many images as there are threads
+		self._executor: ThreadPoolExecutor = ThreadPoolExecutor(threads, thread_name_prefix="opti-dir2-worker")
+		self._dispatcher: Thread = Thread(target=self._dispatch, name="opti-dir2-dispatcher", daemon=True)
+		self._dispatcher.start()
+	
+	# the thresholds of the quality guard are the ones of the server
+	def factory(self, mode: OptimizationMode, verify: bool = False) -> OptimizerFactory:
+		from python_scripts.opti_dir2.quality import QualityGuard
+		
+		with self._condition:
+			if (mode, verify) not in self._factories:
+				try:
+					quality_guard: QualityGuard | None = QualityGuard() if verify else None
+				except ImportError as exc:
+					raise ServerError(str(exc)) from exc
+				
+				self._factories[mode, verify] = create_factory(mode, self.history, quality_guard=quality_guard)
+			
+			return self._factories[mode, verify]
+	
+	def _dispatch(self) -> None:
+		while True:
+			with self._condition:
+				self._condition.wait_for(
+					lambda: self._stopping
+					or (self._running < self.threads and any(s.pending for s in self._submissions))
+				)
+				
+				if self._stopping:
+					return
+				
+				submission: Submission = min(
+					(s for s in self._submissions if s.pending),
+					key=lambda s: (s.running, s.served)
+				)
+				image: Path = submission.pending.popleft()
+				submission.running += 1
+				submission.served = monotonic()
+				self._running += 1
+			
+			self.budget.queue()
+			self._executor.submit(self._work, submission, image)
+	
+	def _optimize(self, submission: Submission, image: Path) -> OptimizedImage:
+		with self.budget.image():
+			if submission.cancelled:
+				raise ServerError("cancelled")
+			
+			return optimize_image(
+				image,
+				submission.factory,
+				self.budget,
+				submission.journal,
+				submission.timeout,
+				submission.deleted_images
+			)
+	
+	def _work(self, submission: Submission, image: Path) -> None:
+		try:
+			if self.admission is None:
+				result: OptimizedImage = self._optimize(submission, image)
+			else:
+				with self.admission.image(image, submission.memory_model) as pixels:
+					result: OptimizedImage = self._optimize(submission, image)
+				
+				submission.memory_model.record(result, pixels)
+			
+			if submission.cost_model is not None:
+				submission.cost_model.record(result)
+			
+			submission.manifest.record(result)
+		except ServerError:
+			result: OptimizedImage = OptimizedImage(image, 0, 0, False, image)
+		except Exception as exc:
+			# the image is reported as failed, the server keeps running
+			LOGGER.error(f"{CLEAR_LINE}'{image}': {exc}")
+			result: OptimizedImage = OptimizedImage(image, 0, 0, False, image)
+		
+		with self._condition:
+			submission.running -= 1
+			self._running -= 1
+			self._condition.notify_all()
+		
+		submission.results.put(result)
+	
+	def images(self, request: Request, factory: OptimizerFactory, manifest: Manifest) -> list[Path]:
+		directory: Path = Path(request.directory)
+		file_types: set[str] = factory.get_registered_file_types()
+		include: tuple[str, ...] = tuple(request.include)
+		exclude: tuple[str, ...] = tuple(request.exclude)
+		
+		if request.by_extension:
+			images = scan_directory(directory, tuple(file_types), request.recursive, include, exclude)
+		else:
+			images = detect_images(
+				scan_directory(directory, None, request.recursive, include, exclude),
+				file_types,
+				self.threads
+			)
+		
+		return list(manifest.filter(images))
+	
+	def serve_request(self, request: Request, connection: socket.socket, stream: BinaryIO) -> None:
+		factory: OptimizerFactory = self.factory(OptimizationMode[request.mode.upper()], request.verify)
+		directory: Path = Path(request.directory)
+		# after the factory, which registers the settings of its steps
+		differences: list[str] = differing_settings(
+			run_settings(self.threads, self.priority, self.cpu_quota, self.admission is not None),
+			request.settings
+		)
+		
+		if differences:
+			raise ServerError(
+				f"the server runs with other settings, {", ".join(differences)}; "
+				f"run without --server or wait until the server stopped"
+			)
+		
+		manifest_file: Path = Path(request.manifest) if request.manifest is not None else directory / MANIFEST_NAME
+		deleted_images: DeletedImages = DeletedImages(
+			Path(request.deleted_images) if request.deleted_images is not None else DELETED_IMAGE_FOLDER.absolute(),
+			directory
+		)
+		
+		with self._condition:
+			if manifest_file in self._manifests:
+				raise ServerError(f"'{directory}' is already being optimized")
+			
+			self._manifests.add(manifest_file)
+		
+		try:
+			journal: Journal = Journal(manifest_file.with_name(JOURNAL_NAME))
+			unfinished: int = len(journal.unfinished())
+			
+			if unfinished > 0 and not request.resume:
+				raise ServerError(f"an interrupted run left {unfinished} images unfinished, continue it with --resume")
+			
+			with Manifest(manifest_file, factory.get_profile(), request.force) as manifest, journal:
+				if unfinished > 0:
+					finished, rolled_back = journal.recover(manifest, deleted_images)
+					LOGGER.info(f"resuming: finished {finished} interrupted commits, rolled back {rolled_back} images")
+				
+				self._run(request, connection, stream, factory, manifest, journal, deleted_images)
+		finally:
+			with self._condition:
+				self._manifests.discard(manifest_file)
+			
+			self.history.save()
+	
+	def _run(
+		self,
+		request: Request,
+		connection: socket.socket,
+		stream: BinaryIO,
+		factory: OptimizerFactory,
+		manifest: Manifest,
+		journal: Journal,
+		deleted_images: DeletedImages
+	) -> None:
+		cost_model: CostModel | None = None if request.unordered else CostModel(factory, self.history)
+		
+		images: list[Path] = self.images(request, factory, manifest)
+		if cost_model is not None:
+			images = cost_model.schedule(images)
+		
+		send(stream, { "event": "queued", "images": [str(image) for image in images], "skipped": manifest.skipped })
+		
+		submission: Submission = Submission(
+			images,
+			factory,
+			manifest,
+			journal,
+			MemoryModel(factory, self.history),
+			cost_model,
+			request.step_timeout,
+			deleted_images
+		)
+		
+		with self._condition:
+			self._submissions.append(submission)
+			self._condition.notify_all()
+		
+		try:
+			sent: int = 0
+			
+			while sent < len(images):
+				try:
+					result: OptimizedImage | None = submission.results.get(timeout=POLL_INTERVAL)
+				except Empty:
+					# otherwise it is only noticed when the next result cannot be sent
+					if client_gone(connection):
+						raise ConnectionResetError()
+					continue
+				
+				if result is None:
+					raise ServerError("the server is stopping")
+				
+				send(stream, { "event": "result", **encode_image(result) })
+				sent += 1
+			
+			send(stream, { "event": "done" })
+		except OSError:
+			LOGGER.warn(f"the client of '{request.directory}' went away, finishing its running images")
+		finally:
+			# the manifest and journal are closed after this, nothing of this submission may run any more
+			with self._condition:
+				submission.cancelled = True
+				submission.pending.clear()
+				self._condition.wait_for(lambda: submission.running == 0)
+				self._submissions.remove(submission)
+	
+	def stop(self) -> None:
+		with self._condition:
+			self._stopping = True
+			
+			for submission in self._submissions:
+				submission.cancelled = True
+				submission.pending.clear()
+				submission.results.put(None)
+			
+			self._condition.notify_all()
+		
+		self.shutdown()
+		self._executor.shutdown()
+	
+	def connected(self) -> None:
+		with self._condition:
+			self.clients += 1
+	
+	def disconnected(self) -> None:
+		with self._condition:
+			self.clients -= 1
+			self.last_client = monotonic()
+	
+	# seconds since the last client left, 0 while there are clients
+	def idle_time(self) -> float:
+		with self._condition:
+			return monotonic() - self.last_client if self.clients == 0 else 0.0
+
+
+class JobHandler(StreamRequestHandler):
+	server: JobServer
+	
+	def handle(self) -> None:
+		self.server.connected()
+		
+		try:
+			line: bytes = self.rfile.readline()
+			
+			try:
+				self.server.serve_request(Request(**json.loads(line)), self.connection, self.wfile)
+			except (ValueError, TypeError, KeyError, ServerError, OSError) as exc:
+				send(self.wfile, { "event": "error", "message": str(exc) })
+		except OSError:
+			pass
+		finally:
+			self.server.disconnected()
+
+
+# Runs the server until it was idle for SERVER_IDLE_TIMEOUT seconds or receives SIGTERM. Only one server runs
+# per socket; a second one exits right away. The priority and the quota are already applied, they are only
+# compared with the ones of the requests.
+def serve(
+	threads: int,
+	priority: str = "normal",
+	cpu_quota: int | None = None,
+	admission: bool = True,
+	path: Path = SOCKET_PATH
+) -> None:
+	with open(path.with_name(f"{path.name}.lock"), "w") as lock:
+		try:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			LOGGER.info("a server is already running")
+			return
+		
+		# left behind by a server which was killed
+		path.unlink(missing_ok=True)
+		
+		server: JobServer = JobServer(path, threads, priority, cpu_quota, admission)
+		stop: Event = Event()
+		
+		signal(SIGTERM, lambda *_: stop.set())
+		signal(SIGINT, lambda *_: stop.set())
+		
+		serving: Thread = Thread(target=server.serve_forever, args=(POLL_INTERVAL,), name="opti-dir2-server")
+		serving.start()
+		
+		LOGGER.info(f"serving on '{path}' with {threads} threads")
+		
+		try:
+			while not stop.wait(POLL_INTERVAL):
+				if server.idle_time() > float(SERVER_IDLE_TIMEOUT.value()):
+					LOGGER.info("no clients, stopping")
+					break
+		finally:
+			server.stop()
+			serving.join()
+			server.server_close()
+			path.unlink(missing_ok=True)
+
+
+# the last thing a server which did not start printed, usually the error
+def last_output(log: Path) -> str:
+	lines: list[str] = [line.strip() for line in log.read_text(errors="replace").splitlines() if line.strip()]
+	
+	return lines[-1] if lines else "it printed nothing"
+
+
+# a server started here gets the threads, priority, quota and admission of this run
+def connect(
+	threads: int,
+	priority: str = "normal",
+	cpu_quota: int | None = None,
+	admission: bool = True,
+	path: Path = SOCKET_PATH
+) -> socket.socket:
+	# everything the server prints, so a client can tell why it did not start
+	log: Path = path.with_name(f"{path.name}.log")
+	server: subprocess.Popen | None = None
+	deadline: float | None = None
+	
+	while True:
+		client: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		
+		try:
+			client.connect(str(path))
+			return client
+		except (FileNotFoundError, ConnectionRefusedError):
+			client.close()
+		
+		if server is None:
+			LOGGER.verbose_log(f"starting a server on '{path}'")
+			
+			# detached, so it outlives this client; every request brings its own deleted images folder
+			try:
+				with open(log, "w") as output:
+					server = subprocess.Popen(
+						[
+							sys.executable,
+							"-m",
+							"python_scripts.opti_dir2",
+							"--serve",
+							"-t",
+							str(threads),
+							*([f"--{priority}"] if priority != "normal" else []),
+							*(["--cpu-quota", str(cpu_quota)] if cpu_quota is not None else []),
+							*([] if admission else ["--no-admission"])
+						],
+						stdin=subprocess.DEVNULL,
+						stdout=output,
+						stderr=subprocess.STDOUT,
+						start_new_session=True
+					)
+			except OSError as exc:
+				raise ServerError(f"could not start a server on '{path}': {exc}") from exc
+			deadline = monotonic() + STARTUP_TIMEOUT
+		elif server.poll() not in (None, 0):
+			# 0 is a server which found another one starting up at the same time, that one is waited for
+			raise ServerError(f"the server on '{path}' could not start: {last_output(log)}")
+		elif monotonic() > deadline:
+			raise ServerError(f"the server on '{path}' did not start, see '{log}'")
+		
+		sleep(0.05)
+
+
+# submits the directory to the server, starting it if needed, and shows its results like a local run would
+def optimize_on_server(
+	request: Request,
+	threads: int,
+	do_progress_bar: bool = True,
+	report: RunReport | None = None,
+	priority: str = "normal",
+	cpu_quota: int | None = None,
+	admission: bool = True
+) -> list[OptimizedImage]:
+	bar: ProgressBar | None = ProgressBar() if do_progress_bar else None
+	processed_images: list[OptimizedImage] = []
+	
+	with connect(threads, priority, cpu_quota, admission) as client, client.makefile("rwb") as stream:
+		send(stream, asdict(request))
+		
+		for line in stream:
+			message: dict[str, Any] = json.loads(line)
+			event: str = message.pop("event")
+			
+			if event == "error":
+				raise ServerError(message["message"])
+			
+			if event == "done":
+				break
+			
+			if event == "queued":
+				if message["skipped"] > 0:
+					LOGGER.info(f"skipping {message["skipped"]} already optimized images")
+				
+				if bar is not None:
+					for image in message["images"]:
+						bar.add(Path(image))
+				continue
+			
+			image: OptimizedImage = decode_image(message)
+			processed_images.append(image)
+			
+			if report is not None:
+				report.add(image)
+			
+			if bar is not None:
+				bar.completed(image)
+		else:
+			raise ServerError("the server went away")
+	
+	if bar is not None:
+		bar.finish()
+	
+	return processed_images
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from python_scripts.opti_dir2.dedup import DedupMethod, Duplicate, find_duplicates, replicate
+from python_scripts.opti_dir2.opti_dir2 import DeletedImages, OptimizedImage
+
+
+class DedupTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+		self.deleted_images: DeletedImages = DeletedImages(self.directory / "deleted-images", self.directory)
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	def write(self, name: str, content: bytes) -> Path:
+		path: Path = self.directory / name
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_bytes(content)
+		
+		return path
+	
+	def test_groups_images_with_the_same_content(self):
+		first: Path = self.write("first.png", b"same content")
+		unique: Path = self.write("unique.png", b"other")
+		# the same size, but not the same
+		similar: Path = self.write("similar.png", b"SAME CONTENT")
+		copy: Path = self.write("sub/copy.png", b"same content")
+		
+		representatives, duplicates = find_duplicates([first, unique, similar, copy], 2)
+		
+		self.assertEqual(representatives, [first, unique, similar])
+		self.assertEqual(duplicates, { first: [Duplicate(copy)] })
+	
+	def test_hardlinks_stay_hardlinks(self):
+		first: Path = self.write("first.png", b"same content")
+		link: Path = self.directory / "link.png"
+		os.link(first, link)
+		copy: Path = self.write("copy.png", b"same content")
+		copy_link: Path = self.directory / "copy-link.png"
+		os.link(copy, copy_link)
+		
+		representatives, duplicates = find_duplicates([first, link, copy, copy_link], 1)
+		
+		self.assertEqual(representatives, [first])
+		self.assertEqual(
+			duplicates,
+			{ first: [Duplicate(link, first), Duplicate(copy), Duplicate(copy_link, copy)] }
+		)
+	
+	def test_copies_the_result(self):
+		image: Path = self.write("image.png", b"original image")
+		duplicate: Path = self.write("duplicate.png", b"original image")
+		image.write_bytes(b"smaller")
+		
+		for method in DedupMethod:
+			with self.subTest(method.name):
+				duplicate.unlink()
+				duplicate.write_bytes(b"original image")
+				
+				result: OptimizedImage = replicate(
+					OptimizedImage(image, 14, 7, True, image),
+					Duplicate(duplicate),
+					method,
+					self.deleted_images
+				)
+				
+				self.assertEqual((result.image, result.old_size, result.new_size), (duplicate, 14, 7))
+				self.assertEqual(duplicate.read_bytes(), b"smaller")
+				self.assertEqual(os.path.samefile(image, duplicate), method == DedupMethod.HARDLINK)
+		
+		self.assertEqual(sorted(path.name for path in self.directory.iterdir()), ["duplicate.png", "image.png"])
+	
+	def test_converts_the_duplicate_like_its_representative(self):
+		source: Path = self.write("image.png", b"original image")
+		duplicate: Path = self.write("sub/duplicate.png", b"original image")
+		image: Path = self.write("image.jxl", b"smaller")
+		source.unlink()
+		
+		result: OptimizedImage = replicate(
+			OptimizedImage(image, 14, 7, True, source),
+			Duplicate(duplicate),
+			DedupMethod.COPY,
+			self.deleted_images
+		)
+		
+		self.assertEqual(result.image, self.directory / "sub" / "duplicate.jxl")
+		self.assertEqual(result.image.read_bytes(), b"smaller")
+		self.assertFalse(duplicate.exists())
+		self.assertEqual((self.directory / "deleted-images" / "sub" / "duplicate.png").read_bytes(), b"original image")
+	
+	def test_leaves_duplicates_of_kept_or_failed_images_alone(self):
+		image: Path = self.write("image.png", b"original image")
+		duplicate: Path = self.write("duplicate.png", b"original image")
+		
+		for result in [OptimizedImage(image, 14, 14, True, image), OptimizedImage(image, 14, 14, False, image)]:
+			with self.subTest(success=result.success):
+				replicated: OptimizedImage = replicate(result, Duplicate(duplicate), DedupMethod.COPY)
+				
+				self.assertEqual((replicated.image, replicated.success), (duplicate, result.success))
+				self.assertEqual(duplicate.read_bytes(), b"original image")
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from PIL import Image
+
+from python_scripts.opti_dir2.detect import detect_images, detect_type, fix_extension
+
+
+class DetectTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	def write_image(self, name: str, file_format: str) -> Path:
+		path: Path = self.directory / name
+		Image.new("RGB", (16, 16), (10, 20, 30)).save(path, file_format)
+		
+		return path
+	
+	def test_detects_types_by_their_header(self):
+		for file_format, file_type in [("JPEG", "jpeg"), ("PNG", "png"), ("WEBP", "webp"), ("GIF", "gif")]:
+			with self.subTest(file_format):
+				path: Path = self.write_image(f"image.{file_format.lower()}", file_format)
+				
+				self.assertEqual(detect_type(path.read_bytes()[:32]), file_type)
+		
+		self.assertEqual(detect_type(b"\x00\x00\x00\x1Cftypavif\x00\x00\x00\x00avifmif1miaf"), "avif")
+		self.assertEqual(detect_type(b"\x00\x00\x00\x1Cftypmp42\x00\x00\x00\x00isommp42"), None)
+		self.assertEqual(detect_type(b"\xFF\x0A"), "jxl")
+		self.assertEqual(detect_type(b"not an image"), None)
+	
+	def test_fixes_a_wrong_extension(self):
+		path: Path = self.write_image("photo.png", "JPEG")
+		
+		self.assertEqual(fix_extension(path, "jpeg"), self.directory / "photo.jpg")
+		self.assertFalse(path.exists())
+		self.assertTrue((self.directory / "photo.jpg").is_file())
+	
+	def test_keeps_a_matching_extension(self):
+		path: Path = self.write_image("photo.jpg", "JPEG")
+		
+		self.assertEqual(fix_extension(path, "jpeg"), path)
+		self.assertTrue(path.is_file())
+	
+	def test_does_not_rename_onto_another_file(self):
+		path: Path = self.write_image("photo.png", "JPEG")
+		other: Path = self.write_image("photo.jpg", "JPEG")
+		content: bytes = other.read_bytes()
+		
+		self.assertEqual(fix_extension(path, "jpeg"), path)
+		self.assertTrue(path.is_file())
+		self.assertEqual(other.read_bytes(), content)
+	
+	def test_detect_images_renames_and_filters(self):
+		self.write_image("jpeg.png", "JPEG")
+		self.write_image("png.png", "PNG")
+		self.write_image("webp.webp", "WEBP")
+		(self.directory / "notes.png").write_text("not an image")
+		# each would be renamed onto the other, so both keep their wrong extension and are left out
+		self.write_image("taken.png", "JPEG")
+		self.write_image("taken.jpg", "PNG")
+		
+		images: list[Path] = list(detect_images(sorted(self.directory.iterdir()), { "jpeg", "png" }, 2))
+		
+		self.assertEqual(sorted(path.name for path in images), ["jpeg.jpg", "png.png"])
+		self.assertTrue((self.directory / "taken.png").is_file())
+	
+	def test_detect_images_without_renaming(self):
+		path: Path = self.write_image("jpeg.png", "JPEG")
+		
+		self.assertEqual(list(detect_images([path], { "jpeg" }, 1, rename=False)), [path])
+		self.assertTrue(path.is_file())
+
+
+if __name__ == '__main__':
+	unittest.main()
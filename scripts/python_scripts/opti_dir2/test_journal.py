@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import os
+import shutil
+import sys
+import unittest
+from pathlib import Path
+from subprocess import CompletedProcess, run
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from PIL import Image
+
+from python_scripts.opti_dir2.journal import Journal, JOURNAL_NAME
+from python_scripts.opti_dir2.manifest import Manifest, MANIFEST_NAME
+from python_scripts.opti_dir2.opti_dir2 import DeletedImages, ImageJob, STAGING_PREFIX
+
+
+# what a killed process does: nothing after the point it died at
+class Killed(BaseException):
+	pass
+
+
+def write_image(path: Path) -> None:
+	Image.new("RGB", (64, 64), (200, 100, 50)).save(path, "PNG", compress_level=0)
+
+
+class JournalTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+		self.file: Path = self.directory / JOURNAL_NAME
+		self.deleted_images: DeletedImages = DeletedImages(self.directory / "deleted-images", self.directory)
+		
+		self.image: Path = self.directory / "image.png"
+		write_image(self.image)
+		self.original: bytes = self.image.read_bytes()
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	# stages the image and replaces the staged copy with `result`, like the steps would
+	def staged_job(self, journal: Journal, result: bytes, name: str = "image.png") -> ImageJob:
+		job: ImageJob = ImageJob(self.image, journal, self.deleted_images)
+		job.stage()
+		
+		job.staged_image.unlink()
+		job.staged_image = job.staged_image.with_name(name)
+		job.staged_image.write_bytes(result)
+		
+		return job
+	
+	# the staging directory of the job, which may be in the scratch directory, and the landing files
+	def leftovers(self, job: ImageJob) -> list[Path]:
+		return [
+			path
+			for path in [job.staging_directory, *self.directory.iterdir()]
+			if path.exists() and path.name.startswith(STAGING_PREFIX) and path.name not in (MANIFEST_NAME, JOURNAL_NAME)
+		]
+	
+	def test_finished_jobs_leave_nothing_behind(self):
+		with Journal(self.file) as journal:
+			job: ImageJob = self.staged_job(journal, b"smaller")
+			job.commit()
+			job.cleanup()
+			
+			self.assertEqual(journal.unfinished(), [])
+		
+		self.assertFalse(self.file.exists())
+		self.assertEqual(self.leftovers(job), [])
+	
+	def test_rolls_back_jobs_killed_before_the_commit(self):
+		with Journal(self.file) as journal:
+			job: ImageJob = self.staged_job(journal, b"smaller")
+		
+		self.assertEqual(len(Journal(self.file).unfinished()), 1)
+		self.assertEqual(Journal(self.file).recover(), (0, 1))
+		
+		self.assertEqual(self.image.read_bytes(), self.original)
+		self.assertEqual(self.leftovers(job), [])
+		self.assertFalse(self.file.exists())
+	
+	def test_finishes_commits_killed_before_the_replace(self):
+		with Journal(self.file) as journal:
+			job: ImageJob = self.staged_job(journal, b"smaller")
+			
+			with mock.patch.object(Path, "replace", side_effect=Killed), self.assertRaises(Killed):
+				job.commit()
+		
+		with Manifest(self.directory / MANIFEST_NAME, { }) as manifest:
+			self.assertEqual(Journal(self.file).recover(manifest, self.deleted_images), (1, 0))
+			self.assertTrue(manifest.is_optimized(self.image))
+		
+		self.assertEqual(self.image.read_bytes(), b"smaller")
+		self.assertEqual(self.leftovers(job), [])
+		self.assertFalse(self.file.exists())
+	
+	def test_finishes_converting_commits(self):
+		with Journal(self.file) as journal:
+			job: ImageJob = self.staged_job(journal, b"converted", "image.jxl")
+			
+			# killed after the replace, the original is still there
+			with mock.patch("python_scripts.opti_dir2.opti_dir2.delete_file", side_effect=Killed):
+				with self.assertRaises(Killed):
+					job.commit()
+		
+		self.assertEqual(Journal(self.file).recover(None, self.deleted_images), (1, 0))
+		
+		self.assertEqual((self.directory / "image.jxl").read_bytes(), b"converted")
+		self.assertFalse(self.image.exists())
+		self.assertEqual((self.directory / "deleted-images" / "image.png").read_bytes(), self.original)
+	
+	def test_rolls_back_commits_which_would_replace_another_image(self):
+		with Journal(self.file) as journal:
+			job: ImageJob = self.staged_job(journal, b"converted", "image.jxl")
+			
+			with mock.patch.object(Path, "replace", side_effect=Killed), self.assertRaises(Killed):
+				job.commit()
+		
+		# appeared while the run was down
+		(self.directory / "image.jxl").write_bytes(b"another image")
+		
+		self.assertEqual(Journal(self.file).recover(None, self.deleted_images), (0, 1))
+		
+		self.assertEqual(self.image.read_bytes(), self.original)
+		self.assertEqual((self.directory / "image.jxl").read_bytes(), b"another image")
+		self.assertEqual(self.leftovers(job), [])
+	
+	def test_compacts_while_jobs_are_running(self):
+		with Journal(self.file) as journal:
+			running: ImageJob = self.staged_job(journal, b"smaller")
+			
+			for _ in range(3):
+				journal.begin(self.directory / ".opti-dir2-other", self.image, 0)
+				journal.done(self.directory / ".opti-dir2-other", self.image)
+			
+			with mock.patch("python_scripts.opti_dir2.journal.COMPACT_LINES", 2):
+				journal.begin(self.directory / ".opti-dir2-other", self.image, 0)
+				journal.done(self.directory / ".opti-dir2-other", self.image)
+			
+			with open(self.file, "r") as f:
+				self.assertEqual(len(f.readlines()), 1)
+			
+			self.assertEqual([entry.staging for entry in journal.unfinished()], [str(running.staging_directory)])
+			
+			running.cleanup()
+
+
+# a directory with an interrupted run, through the CLI
+@unittest.skipUnless(shutil.which("oxipng") and shutil.which("jpegoptim"), "safe mode needs oxipng and jpegoptim")
+class ResumeTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+		
+		self.image: Path = self.directory / "image.png"
+		write_image(self.image)
+		
+		with Journal(self.directory / JOURNAL_NAME) as journal:
+			job: ImageJob = ImageJob(self.image, journal)
+			job.stage()
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	def opti_dir2(self, *arguments: str) -> CompletedProcess:
+		return run(
+			[sys.executable, "-m", "python_scripts.opti_dir2", "-m", "safe", *arguments, str(self.directory)],
+			cwd=self.directory,
+			env={ **os.environ, "PYTHONPATH": os.pathsep.join(sys.path) },
+			capture_output=True,
+			text=True
+		)
+	
+	def test_refuses_to_run_without_resume(self):
+		process: CompletedProcess = self.opti_dir2()
+		
+		self.assertEqual(process.returncode, 1)
+		self.assertIn("continue it with --resume", process.stdout)
+		self.assertTrue((self.directory / JOURNAL_NAME).exists())
+	
+	def test_resume_recovers_and_runs(self):
+		process: CompletedProcess = self.opti_dir2("--resume")
+		
+		self.assertEqual(process.returncode, 0, process.stdout + process.stderr)
+		self.assertIn("rolled back 1 images", process.stdout)
+		self.assertFalse((self.directory / JOURNAL_NAME).exists())
+		self.assertEqual(
+			[path.name for path in self.directory.iterdir() if path.name.startswith(STAGING_PREFIX)],
+			[MANIFEST_NAME]
+		)
+
+
+if __name__ == '__main__':
+	unittest.main()
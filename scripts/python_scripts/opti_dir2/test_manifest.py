@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import json
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from python_scripts.opti_dir2.manifest import Manifest, MANIFEST_NAME
+from python_scripts.opti_dir2.opti_dir2 import OptimizedImage
+
+PROFILE: dict[str, str] = { "mode": "QUALITY" }
+
+
+class ManifestTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+		self.file: Path = self.directory / MANIFEST_NAME
+		
+		self.image: Path = self.directory / "image.png"
+		self.image.write_bytes(b"optimized")
+		
+		# as if an earlier run optimized the image
+		with Manifest(self.file, PROFILE) as manifest:
+			manifest.record(OptimizedImage(self.image, 20, 9))
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	def test_skips_recorded_images(self):
+		other: Path = self.directory / "other.png"
+		other.write_bytes(b"new")
+		
+		with Manifest(self.file, PROFILE) as manifest:
+			self.assertEqual(list(manifest.filter([self.image, other])), [other])
+			self.assertEqual(manifest.skipped, 1)
+	
+	def test_does_not_record_failed_images(self):
+		failed: Path = self.directory / "failed.png"
+		failed.write_bytes(b"failed")
+		
+		with Manifest(self.file, PROFILE) as manifest:
+			manifest.record(OptimizedImage(failed, 6, 6, False))
+		
+		with Manifest(self.file, PROFILE) as manifest:
+			self.assertFalse(manifest.is_optimized(failed))
+	
+	def test_rehashes_touched_images(self):
+		stat: os.stat_result = self.image.stat()
+		os.utime(self.image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+		
+		with Manifest(self.file, PROFILE) as manifest:
+			self.assertTrue(manifest.is_optimized(self.image))
+		
+		# the new mtime was written back, the next run does not hash it again
+		with open(self.file, "r") as f:
+			self.assertEqual(json.loads(f.readline())["mtime"], self.image.stat().st_mtime_ns)
+	
+	def test_optimizes_changed_images_again(self):
+		stat: os.stat_result = self.image.stat()
+		# the same size, only the content tells
+		self.image.write_bytes(b"OPTIMIZED")
+		os.utime(self.image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+		
+		with Manifest(self.file, PROFILE) as manifest:
+			self.assertFalse(manifest.is_optimized(self.image))
+		
+		self.image.write_bytes(b"larger than before")
+		
+		with Manifest(self.file, PROFILE) as manifest:
+			self.assertFalse(manifest.is_optimized(self.image))
+	
+	def test_another_profile_or_force_optimizes_again(self):
+		with Manifest(self.file, { "mode": "JXL" }) as manifest:
+			self.assertFalse(manifest.is_optimized(self.image))
+		
+		with Manifest(self.file, PROFILE, force=True) as manifest:
+			self.assertFalse(manifest.is_optimized(self.image))
+	
+	def test_ignores_a_broken_last_line(self):
+		with open(self.file, "a") as f:
+			f.write('{"path": "/cut')
+		
+		with Manifest(self.file, PROFILE) as manifest:
+			self.assertTrue(manifest.is_optimized(self.image))
+
+
+if __name__ == '__main__':
+	unittest.main()
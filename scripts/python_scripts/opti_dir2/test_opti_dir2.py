@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import os
+import unittest
+from pathlib import Path
+from subprocess import CompletedProcess
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from python_scripts.opti_dir2.opti_dir2 import (DeletedImages, ImageOptimizer, MAX_SIZE_RATIO, optimize_image,
+	OptimizationResult, OptimizedImage, OptimizerFactory, STAGING_PREFIX)
+
+ORIGINAL: bytes = b"original image"
+# long ago, so a commit which does not keep the mtime shows
+MTIME: int = 1_700_000_000
+
+
+# writes `content` as the result, with the extension of `file_type`
+class WritingStep(ImageOptimizer):
+	def __init__(self, content: bytes, file_type: str | None = None):
+		self.content = content
+		self.file_type = file_type
+		
+		self.images: list[Path] = []
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		self.images.append(image)
+		target: Path = image.with_suffix(f".{self.file_type}") if self.file_type is not None else image
+		
+		target.write_bytes(self.content)
+		
+		return OptimizationResult(target, image if target != image else None, CompletedProcess([], 0))
+
+
+class FailingStep(ImageOptimizer):
+	def optimize(self, image: Path) -> OptimizationResult:
+		image.write_bytes(b"half written")
+		
+		return OptimizationResult(image, None, CompletedProcess([], 1, "", "broken"))
+
+
+class ImageJobTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+		self.deleted_images: DeletedImages = DeletedImages(self.directory / "deleted-images", self.directory)
+		
+		self.image: Path = self.directory / "image.png"
+		self.image.write_bytes(ORIGINAL)
+		os.utime(self.image, (MTIME, MTIME))
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	def optimize(self, *steps: ImageOptimizer) -> OptimizedImage:
+		factory: OptimizerFactory = OptimizerFactory()
+		
+		for step in steps:
+			factory.register_processor("png", step)
+		
+		return optimize_image(self.image, factory, deleted_images=self.deleted_images)
+	
+	def files(self) -> list[str]:
+		return sorted(path.name for path in self.directory.iterdir())
+	
+	def test_replaces_the_image_with_a_smaller_result(self):
+		step: WritingStep = WritingStep(b"smaller")
+		result: OptimizedImage = self.optimize(step)
+		
+		self.assertEqual((result.success, result.old_size, result.new_size), (True, len(ORIGINAL), 7))
+		self.assertEqual(self.image.read_bytes(), b"smaller")
+		self.assertEqual(self.image.stat().st_mtime, MTIME)
+		# the steps work on a staged copy, never on the image itself
+		self.assertNotEqual(step.images[0], self.image)
+		self.assertTrue(step.images[0].parent.name.startswith(STAGING_PREFIX))
+		self.assertFalse(step.images[0].parent.exists())
+		self.assertEqual(self.files(), ["image.png"])
+	
+	def test_keeps_the_image_unless_the_result_is_smaller(self):
+		for content in [b"a larger result than the image", b"x" * len(ORIGINAL)]:
+			with self.subTest(size=len(content)):
+				result: OptimizedImage = self.optimize(WritingStep(content))
+				
+				self.assertEqual((result.success, result.image, result.new_size), (True, self.image, len(ORIGINAL)))
+				self.assertEqual(self.image.read_bytes(), ORIGINAL)
+				self.assertEqual(self.files(), ["image.png"])
+	
+	def test_max_size_ratio_keeps_results_which_are_barely_smaller(self):
+		with mock.patch.dict(os.environ, { MAX_SIZE_RATIO.name: "0.5" }):
+			result: OptimizedImage = self.optimize(WritingStep(b"a bit smaller"))
+		
+		self.assertEqual(result.new_size, len(ORIGINAL))
+		self.assertEqual(self.image.read_bytes(), ORIGINAL)
+	
+	def test_a_converted_image_replaces_the_original(self):
+		result: OptimizedImage = self.optimize(WritingStep(b"small", "jxl"))
+		
+		self.assertEqual((result.image, result.source), (self.directory / "image.jxl", self.image))
+		self.assertEqual(result.image.read_bytes(), b"small")
+		self.assertEqual((self.directory / "deleted-images" / "image.png").read_bytes(), ORIGINAL)
+		self.assertEqual(self.files(), ["deleted-images", "image.jxl"])
+	
+	def test_does_not_convert_onto_another_image(self):
+		(self.directory / "image.jxl").write_bytes(b"another image")
+		
+		result: OptimizedImage = self.optimize(WritingStep(b"small", "jxl"))
+		
+		self.assertFalse(result.success)
+		self.assertEqual(self.image.read_bytes(), ORIGINAL)
+		self.assertEqual((self.directory / "image.jxl").read_bytes(), b"another image")
+	
+	def test_a_failed_step_leaves_the_image_alone(self):
+		step: WritingStep = WritingStep(b"small")
+		result: OptimizedImage = self.optimize(FailingStep(), step)
+		
+		self.assertFalse(result.success)
+		self.assertEqual(step.images, [])
+		self.assertEqual(self.image.read_bytes(), ORIGINAL)
+		self.assertEqual(self.files(), ["image.png"])
+
+
+if __name__ == '__main__':
+	unittest.main()
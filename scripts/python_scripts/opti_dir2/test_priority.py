@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import os
+import sys
+import unittest
+from subprocess import PIPE, Popen
+
+from python_scripts.opti_dir2 import priority
+from python_scripts.opti_dir2.priority import describe_priority, RunPriority
+
+# applies the priority, tells it is done and then becomes a tool, the way a step would start one
+CHILD: str = """
+import os, sys
+from python_scripts.opti_dir2.priority import apply_priority, RunPriority
+
+apply_priority(RunPriority[sys.argv[1]])
+print("ready", flush=True)
+os.execvp("sleep", ["sleep", "30"])
+"""
+
+
+class PriorityTest(unittest.TestCase):
+	def start_child(self, run_priority: RunPriority) -> int:
+		child: Popen = Popen(
+			[sys.executable, "-c", CHILD, run_priority.name],
+			stdout=PIPE,
+			text=True,
+			env={ **os.environ, "PYTHONPATH": os.pathsep.join(sys.path) }
+		)
+		self.addCleanup(child.wait)
+		self.addCleanup(child.kill)
+		
+		self.assertEqual(child.stdout.readline().strip(), "ready")
+		
+		return child.pid
+	
+	def assert_io_class(self, pid: int, io_class: str) -> None:
+		if priority.psutil is None:
+			self.skipTest("the I/O class needs psutil")
+		
+		self.assertIn(f"I/O {io_class}", describe_priority(pid))
+	
+	def test_background(self):
+		pid: int = self.start_child(RunPriority.BACKGROUND)
+		
+		self.assertEqual(os.getpriority(os.PRIO_PROCESS, pid), 19)
+		self.assertEqual(os.sched_getscheduler(pid), os.SCHED_IDLE)
+		self.assert_io_class(pid, "idle")
+	
+	def test_interactive(self):
+		pid: int = self.start_child(RunPriority.INTERACTIVE)
+		
+		# only ever lowered
+		self.assertEqual(os.getpriority(os.PRIO_PROCESS, pid), max(10, os.getpriority(os.PRIO_PROCESS, 0)))
+		self.assertEqual(os.sched_getscheduler(pid), os.SCHED_BATCH)
+		self.assert_io_class(pid, "best-effort 7")
+	
+	def test_normal_changes_nothing(self):
+		pid: int = self.start_child(RunPriority.NORMAL)
+		
+		self.assertEqual(os.getpriority(os.PRIO_PROCESS, pid), os.getpriority(os.PRIO_PROCESS, 0))
+		self.assertEqual(os.sched_getscheduler(pid), os.sched_getscheduler(0))
+		self.assertEqual(describe_priority(pid), describe_priority())
+
+
+if __name__ == '__main__':
+	unittest.main()
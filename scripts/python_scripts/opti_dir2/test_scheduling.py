@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from python_scripts.opti_dir2.history import History
+from python_scripts.opti_dir2.opti_dir2 import (ImageOptimizer, OptimizationResult, OptimizedImage,
+	OptimizerFactory)
+from python_scripts.opti_dir2.scheduling import CostModel, MEGABYTE, MIN_SAMPLES
+
+
+# only the cost of a step matters, the model never runs it
+class CheapStep(ImageOptimizer):
+	RELATIVE_COST = 0.1
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		raise NotImplementedError
+
+
+class ExpensiveStep(CheapStep):
+	RELATIVE_COST = 4.0
+
+
+class CostModelTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+		
+		factory: OptimizerFactory = OptimizerFactory()
+		factory.register_processor("png", CheapStep())
+		factory.register_processor("jpeg", ExpensiveStep())
+		factory.register_alias("jpeg", "jpg")
+		
+		self.model: CostModel = CostModel(factory, History(None))
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	def image(self, name: str, size: int) -> Path:
+		path: Path = self.directory / name
+		path.write_bytes(b"\0" * size)
+		
+		return path
+	
+	def record(self, image: Path, duration: float) -> None:
+		size: int = image.stat().st_size
+		self.model.record(OptimizedImage(image, size, size, True, image, duration))
+	
+	def test_without_timings_the_largest_and_most_expensive_go_first(self):
+		small_png: Path = self.image("small.png", 1000)
+		large_png: Path = self.image("large.png", 100_000)
+		small_jpg: Path = self.image("small.jpg", 10_000)
+		
+		self.assertEqual(self.model.schedule([small_png, large_png, small_jpg]), [small_jpg, large_png, small_png])
+	
+	def test_learns_a_fixed_cost_per_image(self):
+		images: list[Path] = [self.image(f"{i}.png", (i + 1) * MEGABYTE // 4) for i in range(MIN_SAMPLES)]
+		
+		# two seconds plus one per megabyte
+		for image in images:
+			self.record(image, 2.0 + image.stat().st_size / MEGABYTE)
+		
+		self.assertAlmostEqual(self.model.estimate(images[0], 0), 2.0, places=6)
+		self.assertAlmostEqual(self.model.estimate(images[0], 3 * MEGABYTE), 5.0, places=6)
+		# the other chain still goes by the prior
+		self.assertLess(self.model.estimate(self.image("small.jpg", 1000)), 1.0)
+	
+	def test_learned_timings_change_the_order(self):
+		png: Path = self.image("image.png", 100_000)
+		jpg: Path = self.image("image.jpg", 100_000)
+		self.assertEqual(self.model.schedule([png, jpg]), [jpg, png])
+		
+		# the PNGs turned out to be the slow ones
+		for _ in range(MIN_SAMPLES):
+			self.record(png, 30.0)
+		
+		self.assertEqual(self.model.schedule([png, jpg]), [png, jpg])
+	
+	def test_schedules_streams_within_a_window(self):
+		sizes: list[int] = [1, 2, 3, 4, 9]
+		images: list[Path] = [self.image(f"{i}.png", size * 1000) for i, size in enumerate(sizes)]
+		
+		scheduled: list[Path] = list(self.model.schedule_stream(iter(images), window=2))
+		
+		# the largest of the window goes first; the last image comes too late to be the first one
+		self.assertEqual([sizes[int(image.stem)] for image in scheduled], [3, 4, 9, 2, 1])
+		# with a window as large as the stream, it is the same as for a list
+		self.assertEqual(list(self.model.schedule_stream(iter(images), window=len(images))), self.model.schedule(images))
+
+
+if __name__ == '__main__':
+	unittest.main()
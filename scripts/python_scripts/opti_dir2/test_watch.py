@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import unittest
+from pathlib import Path
+from subprocess import CompletedProcess
+from tempfile import TemporaryDirectory
+from threading import Condition, Event, Lock, Thread
+from unittest import mock
+
+from PIL import Image
+
+from python_scripts.opti_dir2 import watch
+from python_scripts.opti_dir2.journal import Journal, JOURNAL_NAME
+from python_scripts.opti_dir2.manifest import Manifest, MANIFEST_NAME
+from python_scripts.opti_dir2.opti_dir2 import (current_image, ImageOptimizer, OptimizationResult, OptimizedImage,
+	OptimizerFactory)
+from python_scripts.opti_dir2.watch import watch_directory
+
+DEBOUNCE: float = 0.1
+# the longest a result may take to arrive
+TIMEOUT: float = 10.0
+
+
+# recompresses the PNG in place, so every result replaces its image and shows up as an event of the watcher
+class CountingStep(ImageOptimizer):
+	def __init__(self):
+		self.images: list[Path] = []
+		
+		self._lock: Lock = Lock()
+	
+	def optimize(self, image: Path) -> OptimizationResult:
+		with self._lock:
+			self.images.append(current_image.get())
+		
+		with Image.open(image) as opened:
+			opened.load()
+		opened.save(image, "PNG", compress_level=9)
+		
+		return OptimizationResult(image, None, CompletedProcess([], 0))
+
+
+# like an image which was deleted while it was waiting for its job
+class VanishingStep(CountingStep):
+	def optimize(self, image: Path) -> OptimizationResult:
+		if current_image.get().name.startswith("vanishing"):
+			current_image.get().unlink()
+			image.unlink()
+		
+		return super().optimize(image)
+
+
+def write_image(path: Path) -> None:
+	# stored without compression, the step always makes it smaller
+	Image.new("RGB", (64, 64), (200, 100, 50)).save(path, "PNG", compress_level=0)
+
+
+# a watcher in the background, until stop() was called
+class RunningWatcher:
+	def __init__(self, directory: Path, factory: OptimizerFactory, manifest: Manifest, journal: Journal | None = None):
+		self.results: list[OptimizedImage] = []
+		self.stop_event: Event = Event()
+		
+		self._condition: Condition = Condition()
+		self._thread: Thread = Thread(
+			target=watch_directory,
+			args=(directory, 2, factory, manifest),
+			kwargs={ "debounce": DEBOUNCE, "journal": journal, "stop": self.stop_event, "on_result": self._on_result }
+		)
+		self._thread.start()
+	
+	def _on_result(self, image: OptimizedImage) -> None:
+		with self._condition:
+			self.results.append(image)
+			self._condition.notify_all()
+	
+	def wait_for(self, count: int) -> bool:
+		with self._condition:
+			return self._condition.wait_for(lambda: len(self.results) >= count, TIMEOUT)
+	
+	def stop(self) -> None:
+		self.stop_event.set()
+		self._thread.join(TIMEOUT)
+
+
+@mock.patch.object(watch, "POLL_INTERVAL", 0.05)
+class WatchTest(unittest.TestCase):
+	def setUp(self):
+		self._directory: TemporaryDirectory = TemporaryDirectory()
+		self.directory: Path = Path(self._directory.name)
+		
+		self.step: CountingStep = CountingStep()
+		self.factory: OptimizerFactory = OptimizerFactory()
+		self.factory.register_processor("png", self.step)
+	
+	def tearDown(self):
+		self._directory.cleanup()
+	
+	def manifest(self) -> Manifest:
+		return Manifest(self.directory / MANIFEST_NAME, self.factory.get_profile())
+	
+	# long enough for the events of a replaced image to be picked up, if they would be
+	@staticmethod
+	def settle() -> None:
+		Event().wait(DEBOUNCE * 5)
+	
+	def test_optimizes_new_images_once(self):
+		write_image(self.directory / "existing.png")
+		
+		with self.manifest() as manifest:
+			watcher: RunningWatcher = RunningWatcher(self.directory, self.factory, manifest)
+			
+			try:
+				self.assertTrue(watcher.wait_for(1))
+				
+				write_image(self.directory / "new.png")
+				self.assertTrue(watcher.wait_for(2))
+				
+				self.settle()
+			finally:
+				watcher.stop()
+		
+		self.assertCountEqual(
+			self.step.images,
+			[self.directory / "existing.png", self.directory / "new.png"]
+		)
+		self.assertEqual(len(watcher.results), 2)
+		self.assertTrue(all(result.success and result.size_delta < 0 for result in watcher.results))
+	
+	def test_skips_images_in_the_manifest(self):
+		write_image(self.directory / "optimized.png")
+		
+		with self.manifest() as manifest:
+			watcher: RunningWatcher = RunningWatcher(self.directory, self.factory, manifest)
+			
+			try:
+				self.assertTrue(watcher.wait_for(1))
+			finally:
+				watcher.stop()
+		
+		# a restart with the manifest of the first run
+		with self.manifest() as manifest:
+			watcher = RunningWatcher(self.directory, self.factory, manifest)
+			
+			try:
+				write_image(self.directory / "new.png")
+				self.assertTrue(watcher.wait_for(1))
+				
+				self.settle()
+			finally:
+				watcher.stop()
+		
+		self.assertEqual(self.step.images, [self.directory / "optimized.png", self.directory / "new.png"])
+		self.assertEqual([result.image for result in watcher.results], [self.directory / "new.png"])
+	
+	def test_keeps_going_after_an_image_vanished(self):
+		self.factory = OptimizerFactory()
+		self.factory.register_processor("png", VanishingStep())
+		
+		write_image(self.directory / "vanishing.png")
+		
+		with self.manifest() as manifest, Journal(self.directory / JOURNAL_NAME) as journal:
+			watcher: RunningWatcher = RunningWatcher(self.directory, self.factory, manifest, journal)
+			
+			try:
+				self.assertTrue(watcher.wait_for(1))
+				
+				write_image(self.directory / "new.png")
+				self.assertTrue(watcher.wait_for(2))
+				
+				self.settle()
+				
+				# nothing is running, so nothing is left in the journal
+				self.assertEqual((self.directory / JOURNAL_NAME).stat().st_size, 0)
+			finally:
+				watcher.stop()
+		
+		self.assertEqual(
+			[(result.image.name, result.success) for result in watcher.results],
+			[("vanishing.png", False), ("new.png", True)]
+		)
+		self.assertFalse((self.directory / JOURNAL_NAME).exists())
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from pathlib import Path
+from threading import Event
+from time import monotonic
+from typing import Callable, Iterator, TYPE_CHECKING
+
+from python_scripts.logger import Logger
+from python_scripts.opti_dir2.detect import detect_images
+from python_scripts.opti_dir2.opti_dir2 import (DELETED_IMAGE_FOLDER, DeletedImages, iter_optimize_files,
+	OptimizedImage, OptimizerFactory, scan_directory)
+
+if TYPE_CHECKING:
+	from python_scripts.opti_dir2.admission import MemoryModel
+	from python_scripts.opti_dir2.journal import Journal
+	from python_scripts.opti_dir2.manifest import Manifest
+
+LOGGER: Logger = Logger("opti-dir2")
+
+# from sys/inotify.h
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_DELETE_SELF: int = 0x00000400
+IN_Q_OVERFLOW: int = 0x00004000
+IN_IGNORED: int = 0x00008000
+IN_ISDIR: int = 0x40000000
+IN_NONBLOCK: int = os.O_NONBLOCK
+IN_CLOEXEC: int = os.O_CLOEXEC
+
+WATCH_MASK: int = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+# struct inotify_event without the name
+EVENT_HEADER: struct.Struct = struct.Struct("iIII")
+
+# a file is only picked up once it was left alone for this many seconds
+DEBOUNCE: float = 2.0
+# how often a stop is noticed while nothing happens
+POLL_INTERVAL: float = 1.0
+
+
+class Inotify:
+	def __init__(self):
+		self._libc: ctypes.CDLL = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd: int = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+	
+	def add_watch(self, path: Path, mask: int) -> int:
+		wd: int = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for '{path}'")
+		
+		return wd
+	
+	# wd, mask and name of every queued event
+	def read(self) -> list[tuple[int, int, str]]:
+		try:
+			buffer: bytes = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return []
+		
+		events: list[tuple[int, int, str]] = []
+		offset: int = 0
+		
+		while offset < len(buffer):
+			wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+			offset += EVENT_HEADER.size
+			
+			events.append((wd, mask, os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))))
+			offset += length
+		
+		return events
+	
+	def close(self) -> None:
+		os.close(self.fd)
+
+
+# Turns the events of a directory into batches of files which are done being written. The first batch holds
+# what is already there, everything after it what arrived since. Hidden files are never reported, which also
+# keeps the staging directories of running jobs out.
+class Watcher:
+	def __init__(self, directory: Path, recursive: bool = False, debounce: float = DEBOUNCE, stop: Event | None = None):
+		self.directory = directory
+		self.recursive = recursive
+		self.debounce = debounce
+		self.stop = stop or Event()
+		
+		self._inotify: Inotify = Inotify()
+		self._directories: dict[int, Path] = { }
+		# path and the time of its last event
+		self._pending: dict[Path, float] = { }
+	
+	@staticmethod
+	def _ignored(name: str) -> bool:
+		return name.startswith(".") or name == DELETED_IMAGE_FOLDER.name
+	
+	def _watch(self, directory: Path) -> None:
+		self._directories[self._inotify.add_watch(directory, WATCH_MASK)] = directory
+		
+		if not self.recursive:
+			return
+		
+		with os.scandir(directory) as entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False) and not self._ignored(entry.name):
+					self._watch(Path(entry.path))
+	
+	def _handle(self, wd: int, mask: int, name: str) -> None:
+		if mask & IN_Q_OVERFLOW:
+			LOGGER.warn("too many events at once, rescanning")
+			self._pending.update(dict.fromkeys(scan_directory(self.directory, None, self.recursive), monotonic()))
+			return
+		
+		if mask & IN_IGNORED:
+			self._directories.pop(wd, None)
+			return
+		
+		directory: Path | None = self._directories.get(wd)
+		
+		if mask & IN_DELETE_SELF and directory == self.directory:
+			LOGGER.warn(f"'{self.directory}' was removed, stopping")
+			self.stop.set()
+			return
+		
+		if directory is None or self._ignored(name):
+			return
+		
+		path: Path = directory / name
+		
+		if mask & IN_ISDIR:
+			# a new or moved in directory may already have files in it
+			if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+				self._watch(path)
+				self._pending.update(dict.fromkeys(scan_directory(path, None, True), monotonic()))
+			return
+		
+		if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+			self._pending[path] = monotonic()
+	
+	def _ready(self) -> list[Path]:
+		now: float = monotonic()
+		ready: list[Path] = [path for path, last_event in self._pending.items() if now - last_event >= self.debounce]
+		
+		for path in ready:
+			del self._pending[path]
+		
+		# it may have been moved away again
+		return [path for path in ready if path.is_file()]
+	
+	def batches(self) -> Iterator[list[Path]]:
+		# watched before the scan, so nothing falls in between
+		self._watch(self.directory)
+		
+		try:
+			yield list(scan_directory(self.directory, None, self.recursive))
+			
+			poll: select.poll = select.poll()
+			poll.register(self._inotify.fd, select.POLLIN)
+			
+			while not self.stop.is_set():
+				timeout: float = POLL_INTERVAL
+				
+				if self._pending:
+					timeout = min(timeout, max(min(self._pending.values()) + self.debounce - monotonic(), 0))
+				
+				if poll.poll(timeout * 1000):
+					for event in self._inotify.read():
+						self._handle(*event)
+				
+				ready: list[Path] = self._ready()
+				if ready:
+					yield ready
+		finally:
+			self._inotify.close()
+
+
+# Optimizes everything in the directory and then every image which arrives, until `stop` is set. The manifest
+# is the state between runs: images which were optimized before a restart are skipped, the rest is caught up.
+def watch_directory(
+	directory: Path,
+	threads: int,
+	factory: OptimizerFactory,
+	manifest: Manifest,
+	recursive: bool = False,
+	debounce: float = DEBOUNCE,
+	journal: Journal | None = None,
+	stop: Event | None = None,
+	on_result: Callable[[OptimizedImage], None] | None = None,
+	memory_model: MemoryModel | None = None,
+	timeout: float | None = None,
+	deleted_images: DeletedImages | None = None
+) -> None:
+	watcher: Watcher = Watcher(directory, recursive, debounce, stop)
+	file_types: set[str] = factory.get_registered_file_types()
+	
+	def images() -> Iterator[Path]:
+		for batch in watcher.batches():
+			# results of earlier jobs arrive as events as well, the manifest knows them
+			yield from manifest.filter(detect_images(batch, file_types, threads))
+	
+	LOGGER.info(f"watching '{directory}'")
+	
+	try:
+		for image in iter_optimize_files(
+			images(),
+			threads,
+			factory,
+			manifest,
+			journal=journal,
+			memory_model=memory_model,
+			timeout=timeout,
+			deleted_images=deleted_images
+		):
+			if on_result is not None:
+				on_result(image)
+	finally:
+		watcher.stop.set()